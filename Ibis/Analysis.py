@@ -1,5 +1,5 @@
 import os
-from typing import List
+from typing import List, Optional
 
 from Ibis import (
     DomainDecoder,
@@ -14,6 +14,7 @@ from Ibis import (
     SecondaryMetabolismEmbedder,
     SecondaryMetabolismPredictor,
 )
+from Ibis.Utilities.Qdrant.cache import use_knn_cache
 
 
 def setup_working_directories(
@@ -32,8 +33,13 @@ def run_ibis_on_genomes(
     output_dir: str,
     gpu_id: int = 0,
     cpu_cores: int = 1,
+    embedding_cache_dir: Optional[str] = None,
+    knn_cache_dir: Optional[str] = None,
 ):
     # this function will be used to model airflow pipeline
+    # reuse knn results across genomes (and runs)
+    if knn_cache_dir is not None:
+        use_knn_cache(knn_cache_dir)
     # setup working directories
     basenames = setup_working_directories(
         filenames=nuc_fasta_filenames, output_dir=output_dir
@@ -50,23 +56,19 @@ def run_ibis_on_genomes(
         output_dir=output_dir,
         prodigal_preds_created=prodigal_preds_created,
         gpu_id=gpu_id,
+        save_residue_predictions=True,
+        cache_dir=embedding_cache_dir,
     )
 
-    # compute ec predictions
-    ec_preds_created = ProteinDecoder.run_on_files(
+    # compute ec and ko predictions (single pass over embeddings)
+    ec_preds_created = ko_preds_created = ProteinDecoder.fused_run_on_files(
         filenames=basenames,
         output_dir=output_dir,
         protein_embs_created=protein_embs_created,
-        decode_fn=ProteinDecoder.decode_ec,
-        decode_name="ec",
-    )
-    # compute ko predictions
-    ko_preds_created = ProteinDecoder.run_on_files(
-        filenames=basenames,
-        output_dir=output_dir,
-        protein_embs_created=protein_embs_created,
-        decode_fn=ProteinDecoder.decode_ko,
-        decode_name="ko",
+        decoders={
+            "ec": ProteinDecoder.decode_ec,
+            "ko": ProteinDecoder.decode_ko,
+        },
     )
     # compute primary metabolism predictions
     primary_metab_preds_created = (
@@ -118,35 +120,22 @@ def run_ibis_on_genomes(
         mibig_orf_annos_prepared=mibig_orf_annos_prepared,
         cpu_cores=cpu_cores,
     )
-    # compute gene family predictions
-    gene_family_preds_created = ProteinDecoder.trimmed_run_on_files(
-        filenames=basenames,
-        output_dir=output_dir,
-        prodigal_preds_created=prodigal_preds_created,
-        protein_embs_created=protein_embs_created,
-        bgc_preds_created=bgc_preds_created,
-        decode_fn=ProteinDecoder.decode_gene_family,
-        decode_name="gene_family",
-    )
-    # compute gene predictions
-    gene_preds_created = ProteinDecoder.trimmed_run_on_files(
-        filenames=basenames,
-        output_dir=output_dir,
-        prodigal_preds_created=prodigal_preds_created,
-        protein_embs_created=protein_embs_created,
-        bgc_preds_created=bgc_preds_created,
-        decode_fn=ProteinDecoder.decode_gene,
-        decode_name="gene",
-    )
-    # compute molecule predictions (ripps and bacteriocins)
-    mol_preds_created = ProteinDecoder.trimmed_run_on_files(
-        filenames=basenames,
-        output_dir=output_dir,
-        prodigal_preds_created=prodigal_preds_created,
-        protein_embs_created=protein_embs_created,
-        bgc_preds_created=bgc_preds_created,
-        decode_fn=ProteinDecoder.decode_molecule,
-        decode_name="molecule",
+    # compute gene family, gene and molecule (ripps and bacteriocins)
+    # predictions for bgc proteins (single pass over embeddings)
+    gene_family_preds_created = gene_preds_created = mol_preds_created = (
+        ProteinDecoder.fused_run_on_files(
+            filenames=basenames,
+            output_dir=output_dir,
+            protein_embs_created=protein_embs_created,
+            decoders={
+                "gene_family": ProteinDecoder.decode_gene_family,
+                "gene": ProteinDecoder.decode_gene,
+                "molecule": ProteinDecoder.decode_molecule,
+            },
+            trimmed=True,
+            prodigal_preds_created=prodigal_preds_created,
+            bgc_preds_created=bgc_preds_created,
+        )
     )
     # compute domain predictions
     domain_preds_created = DomainPredictor.run_on_files(
@@ -156,6 +145,7 @@ def run_ibis_on_genomes(
         bgc_preds_created=bgc_preds_created,
         gpu_id=gpu_id,
         cpu_cores=cpu_cores,
+        residue_preds_created=protein_embs_created,
     )
     # compute domain embeddings
     domain_embs_created = DomainEmbedder.run_on_files(
@@ -229,6 +219,7 @@ def run_ibis_on_genomes(
         mol_preds_created=mol_preds_created,
         gpu_id=gpu_id,
         cpu_cores=cpu_cores,
+        residue_preds_created=protein_embs_created,
     )
     # compute metabolism embeddings
     bgc_embs_created = SecondaryMetabolismEmbedder.run_on_files(
@@ -1,6 +1,5 @@
 import json
 import os
-import pickle
 from functools import partial
 from typing import Callable, List
 
@@ -16,6 +15,8 @@ from Ibis.DomainDecoder.databases import (
     IbisKetosynthase,
     IbisThiolation,
 )
+from Ibis.Utilities.genome_store import get_embedding_lookup
+from Ibis.Utilities.Qdrant.cache import get_knn_cache
 from Ibis.Utilities.Qdrant.classification import (
     KNNClassification,
     neighborhood_classification,
@@ -114,7 +115,6 @@ def run_on_files(
     if domain_embs_created == False:
         raise ValueError("Domain embeddings not created")
     for name in tqdm(filenames, leave=False, desc="Running DomainDecoder"):
-        embedding_fp = f"{output_dir}/{name}/domain_embedding.pkl"
         export_fp = f"{output_dir}/{name}/{target_domain}_predictions.json"
         if os.path.exists(export_fp) == False:
             # find domains to analyze
@@ -125,10 +125,16 @@ def run_on_files(
                     if region["label"] == target_domain:
                         domains_to_run.add(region["domain_id"])
             # analysis
+            embedding_lookup = get_embedding_lookup(
+                output_dir,
+                name,
+                "domain_embeddings",
+                "domain_id",
+                ids=list(domains_to_run),
+            )
             data_queries = [
-                {"query_id": p["domain_id"], "embedding": p["embedding"]}
-                for p in pickle.load(open(embedding_fp, "rb"))
-                if p["domain_id"] in domains_to_run
+                {"query_id": k, "embedding": v}
+                for k, v in embedding_lookup.items()
             ]
             if len(data_queries) == 0:
                 out = []
@@ -136,6 +142,9 @@ def run_on_files(
                 out = decode_fn(data_queries)
             with open(export_fp, "w") as f:
                 json.dump(out, f)
+    cache = get_knn_cache()
+    if cache is not None:
+        print(f"KNN cache: {cache.stats}")
     return True
 
 
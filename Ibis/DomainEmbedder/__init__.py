@@ -7,6 +7,8 @@ from tqdm import tqdm
 
 from Ibis.DomainEmbedder.datastructs import PipelineOutput
 from Ibis.DomainEmbedder.pipeline import DomainEmbedderPipeline
+from Ibis.Prodigal import load_unique_proteins
+from Ibis.Utilities.genome_store import embeddings_created, write_embeddings
 
 ########################################################################
 # General functions
@@ -41,17 +43,20 @@ def run_on_files(
     # analysis
     for name in tqdm(filenames, leave=False, desc="Running Domain Embedder"):
         domain_pred_fp = f"{output_dir}/{name}/domain_predictions.json"
-        prodigal_pred_fp = f"{output_dir}/{name}/prodigal.json"
-        export_filename = f"{output_dir}/{name}/domain_embedding.pkl"
-        if os.path.exists(export_filename) == False:
-            # load protein sequences
+        if embeddings_created(output_dir, name, "domain_embeddings") == False:
+            domain_preds = json.load(open(domain_pred_fp))
+            # load protein sequences (only proteins with domains)
             seq_lookup = {
                 p["protein_id"]: p["sequence"]
-                for p in json.load(open(prodigal_pred_fp))
+                for p in load_unique_proteins(
+                    output_dir,
+                    name,
+                    protein_ids=[p["protein_id"] for p in domain_preds],
+                )
             }
             # trime domain sequences
             sequences = set()
-            for protein in json.load(open(domain_pred_fp)):
+            for protein in domain_preds:
                 protein_id = protein["protein_id"]
                 for domain in protein["regions"]:
                     domain_label = domain["label"]
@@ -63,8 +68,9 @@ def run_on_files(
                         domain_sequence = seq_lookup[protein_id][start:stop]
                         sequences.add(domain_sequence)
             out = pipeline.run(list(sequences))
-            with open(export_filename, "wb") as f:
-                pickle.dump(out, f)
+            write_embeddings(
+                output_dir, name, "domain_embeddings", out, ["domain_id"]
+            )
     # delete pipeline
     del pipeline
     return True
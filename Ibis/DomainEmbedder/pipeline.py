@@ -2,7 +2,6 @@ from typing import List, Optional
 
 import numpy as np
 import xxhash
-from tqdm import tqdm
 from transformers import PreTrainedTokenizerFast
 
 from Ibis import curdir
@@ -14,7 +13,10 @@ from Ibis.ProteinEmbedder.datastructs import (
 from Ibis.Utilities.onnx import get_onnx_base_model, get_onnx_head
 from Ibis.Utilities.preprocess import (
     batchify_tokenized_inputs,
+    forward_bucketed_windows,
     get_indices,
+    pool_protein_windows,
+    restore_bucket_order,
     slice_proteins,
 )
 from Ibis.Utilities.tokenizers import get_protbert_tokenizer
@@ -36,8 +38,30 @@ class DomainEmbedderPipeline:
         model_outputs = self._forward(model_inputs)
         return self.postprocess(model_outputs)
 
-    def run(self, sequences: List[str]):
-        return [self(s) for s in tqdm(sequences, leave=False)]
+    def run(
+        self,
+        sequences: List[str],
+        max_tokens: int = 16384,
+        batch_size: int = 32,
+    ) -> List[PipelineOutput]:
+        if len(sequences) == 0:
+            return []
+        # pool windows across domains (each onnx call sees a full batch)
+        windows, offsets = pool_protein_windows(sequences)
+        pooler_output = self._forward_windows(
+            windows, max_tokens=max_tokens, batch_size=batch_size
+        )
+        # scatter window outputs back to domains
+        out = []
+        for idx, sequence in enumerate(sequences):
+            start, stop = offsets[idx], offsets[idx + 1]
+            model_outputs = {
+                "sequence": sequence,
+                "lengths": [len(w) for w in windows[start:stop]],
+                "cls_window_embeddings": pooler_output[start:stop],
+            }
+            out.append(self.postprocess(model_outputs))
+        return out
 
     def preprocess(self, sequence: str) -> ModelInput:
         windows = slice_proteins(sequence)
@@ -68,6 +92,28 @@ class DomainEmbedderPipeline:
             "cls_window_embeddings": pooler_output,
         }
 
+    def _forward_windows(
+        self,
+        windows: List[str],
+        max_tokens: int = 16384,
+        batch_size: int = 32,
+    ) -> np.array:
+        buckets = []
+        bucket_pooler_output = []
+        for bucket, model_out in forward_bucketed_windows(
+            windows,
+            self.tokenizer,
+            self.model,
+            ["pooler_output"],
+            max_tokens=max_tokens,
+            max_bs=batch_size,
+            desc="Running DomainEmbedder on window batches",
+        ):
+            buckets.append(bucket)
+            bucket_pooler_output.append(model_out["pooler_output"])
+        # restore window order
+        return np.stack(restore_bucket_order(buckets, bucket_pooler_output))
+
     def postprocess(self, model_outputs: ModelOutput) -> PipelineOutput:
         # parameters
         sequence = model_outputs["sequence"]
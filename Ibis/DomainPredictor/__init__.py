@@ -5,6 +5,8 @@ from typing import List
 from tqdm import tqdm
 
 from Ibis.DomainPredictor.pipeline import DomainPredictorPipeline
+from Ibis.Prodigal import load_unique_proteins
+from Ibis.ProteinEmbedder import load_residue_lookup
 
 ########################################################################
 # General functions
@@ -15,7 +17,9 @@ def run_on_protein_sequences(
     sequences: List[str], gpu_id: int = 0, cpu_cores: int = 1
 ):
     pipeline = DomainPredictorPipeline(gpu_id=gpu_id, cpu_cores=cpu_cores)
-    return pipeline.run(sequences)
+    out = pipeline.run(sequences)
+    pipeline.close()
+    return out
 
 
 ########################################################################
@@ -30,6 +34,7 @@ def run_on_files(
     bgc_preds_created: bool,
     gpu_id: int,
     cpu_cores: int = 1,
+    residue_preds_created: bool = False,
 ) -> bool:
     if prodigal_preds_created == False:
         raise ValueError("Prodigal predictions not created")
@@ -42,14 +47,10 @@ def run_on_files(
         export_fp = f"{output_dir}/{name}/domain_predictions.json"
         if os.path.exists(export_fp) == False:
             # load sequence lookup
-            prodigal_fp = f"{output_dir}/{name}/prodigal.json"
             sequence_lookup = {}
-            for protein in json.load(open(prodigal_fp)):
-                contig_id = protein["contig_id"]
-                contig_start = protein["contig_start"]
-                contig_stop = protein["contig_stop"]
-                orf_id = f"{contig_id}_{contig_start}_{contig_stop}"
-                sequence_lookup[orf_id] = protein["sequence"]
+            for protein in load_unique_proteins(output_dir, name):
+                for orf_id in protein["orf_ids"]:
+                    sequence_lookup[orf_id] = protein["sequence"]
             # find orfs from modular systems
             bgc_fp = f"{output_dir}/{name}/bgc_predictions.json"
             sequences_to_run = set()
@@ -63,11 +64,18 @@ def run_on_files(
                         sequences_to_run.add(sequence_lookup[orf_id])
             # analysis
             if len(sequences_to_run) > 0:
-                out = pipeline.run(list(sequences_to_run))
+                residue_lookup = load_residue_lookup(
+                    f"{output_dir}/{name}/residue_predictions.pkl",
+                    residue_preds_created=residue_preds_created,
+                )
+                out = pipeline.run(
+                    list(sequences_to_run), residue_lookup=residue_lookup
+                )
             else:
                 out = []
             with open(export_fp, "w") as f:
                 json.dump(out, f)
+    pipeline.close()
     del pipeline
     return True
 
@@ -26,10 +26,17 @@ class TokenOutput(TypedDict):
     score: float
 
 
+class ResidueClassification(TypedDict):
+    # residues passing the score threshold (aligned arrays)
+    pos: np.array
+    label: np.array
+    score: np.array
+
+
 class PipelineIntermediateOutput(TypedDict):
     protein_id: int
     sequence: str
-    residue_classification: List[TokenOutput]
+    residue_classification: ResidueClassification
 
 
 class TokenRegionOutput(TypedDict):
@@ -0,0 +1,23 @@
+import os
+from typing import List
+
+from tqdm import tqdm
+
+from Ibis import Prodigal
+from Ibis.Utilities.genome_store import export_embeddings
+
+
+def export_genome_files(nuc_fasta_filenames: List[str], output_dir: str):
+    # restore the original per stage file layout from the genome stores
+    # (e.g. prodigal.json and embedding pickles for uploads or external tools)
+    for filename in tqdm(
+        nuc_fasta_filenames, leave=False, desc="Exporting genome files"
+    ):
+        name = os.path.basename(filename)
+        Prodigal.export_to_files(output_dir=output_dir, name=name)
+        for table_name in [
+            "protein_embeddings",
+            "domain_embeddings",
+            "bgc_embeddings",
+        ]:
+            export_embeddings(output_dir, name, table_name)
@@ -1,27 +1,16 @@
-import os
 from glob import glob
 
-import requests
-from dotenv import find_dotenv, get_key
-from tqdm import tqdm
-
 from Ibis import curdir
+from Ibis.Utilities.Qdrant.ingest import restore_snapshots
 
 
-def setup_qdrant_docker():
+def setup_qdrant_docker(max_workers: int = 4):
     # docker commands
     # docker run -it -d -p 6333:6333 -v $(pwd)/qdrant_storage:/qdrant/storage qdrant/qdrant
-    host = get_key(find_dotenv(), "QDRANT_HOST")
-    port = get_key(find_dotenv(), "QDRANT_PORT")
-    node_url = f"http://{host}:{port}"
+    # snapshots are uploaded in parallel (streamed from disk) and each
+    # collection is polled until it is ready
     local_snapshot_paths = glob(f"{curdir}/QdrantSnapshots/*")
-    for snapshot_path in tqdm(local_snapshot_paths):
-        snapshot_name = snapshot_path.split("/")[-1]
-        collection_name = snapshot_name.split("-")[0]
-        requests.post(
-            f"{node_url}/collections/{collection_name}/snapshots/upload?priority=snapshot",
-            files={"snapshot": (snapshot_name, open(snapshot_path, "rb"))},
-        )
+    restore_snapshots(local_snapshot_paths, max_workers=max_workers)
 
 
 if __name__ == "__main__":
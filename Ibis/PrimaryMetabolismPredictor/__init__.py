@@ -13,6 +13,7 @@ from Ibis.PrimaryMetabolismPredictor.annotation import (
 from Ibis.PrimaryMetabolismPredictor.preprocess import (
     merge_protein_annotations,
 )
+from Ibis.Prodigal import load_orfs
 
 ########################################################################
 # Airflow inference functions
@@ -31,12 +32,11 @@ def run_on_single_file(
         output_dir, filename, "primary_metabolism_predictions.json"
     )
     if os.path.exists(export_fp) == False:
-        prodigal_fp = os.path.join(output_dir, filename, "prodigal.json")
         ec_pred_fp = os.path.join(output_dir, filename, "ec_predictions.json")
         ko_pred_fp = os.path.join(output_dir, filename, "ko_predictions.json")
         # do things.
         annots = merge_protein_annotations(
-            prodigal_fp=prodigal_fp,
+            orfs=load_orfs(output_dir, filename),
             ko_pred_fp=ko_pred_fp,
             ec_pred_fp=ec_pred_fp,
         )
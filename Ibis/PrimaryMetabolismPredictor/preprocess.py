@@ -2,14 +2,14 @@ import json
 from typing import List
 
 from Ibis.PrimaryMetabolismPredictor.datastructs import EnzymeKOData
+from Ibis.Prodigal.datastructs import OrfOutput
 
 
 def merge_protein_annotations(
-    prodigal_fp: str,
+    orfs: List[OrfOutput],
     ko_pred_fp: str,
     ec_pred_fp: str,
 ) -> List[EnzymeKOData]:
-    prots = json.load(open(prodigal_fp, "r"))
     ko_lookup = {
         x["query_id"]: x["predictions"][0]
         for x in json.load(open(ko_pred_fp, "r"))
@@ -21,7 +21,7 @@ def merge_protein_annotations(
         if len(x["predictions"]) > 0
     }
     merged = []
-    for annot in prots:
+    for annot in orfs:
         # set defaults
         ec_num = None
         ec_homol = None
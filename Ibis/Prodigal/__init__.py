@@ -1,67 +1,199 @@
+import gzip
 import json
 import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
 from multiprocessing import Pool
-from typing import Dict, List, Union
+from typing import Dict, Iterable, Iterator, List, Optional, Union
 
 import pyrodigal
 import xxhash
 from Bio import SeqIO
+from Bio.SeqRecord import SeqRecord
 from tqdm import tqdm
 
-from Ibis.Prodigal.datastructs import ProdigalOutput
+from Ibis.Prodigal.datastructs import (
+    OrfOutput,
+    ProdigalOutput,
+    UniqueProteinOutput,
+)
+from Ibis.Utilities.genome_store import TableWriter, read_rows, table_exists
 
 ########################################################################
 # General functions
 ########################################################################
 
 
-def run_prodigal(nuc_fasta_fp: str) -> List[ProdigalOutput]:
+def iter_fasta_records(nuc_fasta_fp: str) -> Iterator[SeqRecord]:
+    # lazily parse records (plain, gzip or bgzip compressed fasta)
+    with open(nuc_fasta_fp, "rb") as f:
+        is_gzip = f.read(2) == b"\x1f\x8b"
+    opener = gzip.open if is_gzip else open
+    with opener(nuc_fasta_fp, "rt") as f:
+        for record in SeqIO.parse(f, "fasta"):
+            yield record
+
+
+def find_contig_genes(
+    seq: str, orf_finder: pyrodigal.OrfFinder
+) -> List[ProdigalOutput]:
     proteins = []
-    for record in SeqIO.parse(nuc_fasta_fp, "fasta"):
-        seq_length = len(record.seq)
-        seq_input = bytes(record.seq)
-        contig_id = xxhash.xxh32(str(record.seq)).intdigest()
-        # always run meta procedure
-        orf_finder = pyrodigal.OrfFinder(meta=True)
-        genes = orf_finder.find_genes(seq_input)
-        for gene in genes:
-            prot_seq = gene.translate().replace("*", "")
-            prot_id = xxhash.xxh32(str(prot_seq)).intdigest()
-            contig_start = gene.begin
-            contig_stop = gene.end
-            proteins.append(
-                {
-                    "protein_id": prot_id,
-                    "contig_id": contig_id,
-                    "contig_start": contig_start,
-                    "contig_stop": contig_stop,
-                    "sequence": prot_seq,
-                }
-            )
+    contig_id = xxhash.xxh32(seq).intdigest()
+    genes = orf_finder.find_genes(seq.encode())
+    for gene in genes:
+        prot_seq = gene.translate().replace("*", "")
+        prot_id = xxhash.xxh32(str(prot_seq)).intdigest()
+        contig_start = gene.begin
+        contig_stop = gene.end
+        proteins.append(
+            {
+                "protein_id": prot_id,
+                "contig_id": contig_id,
+                "contig_start": contig_start,
+                "contig_stop": contig_stop,
+                "sequence": prot_seq,
+            }
+        )
+    return proteins
+
+
+def iter_prodigal(
+    nuc_fasta_fp: str, threads: int = 1
+) -> Iterator[List[ProdigalOutput]]:
+    # yields proteins contig by contig (in fasta order)
+    # meta mode finder has no training state, one instance is shared by
+    # all threads (find_genes is thread safe and releases the gil)
+    orf_finder = pyrodigal.OrfFinder(meta=True)
+    records = (str(r.seq) for r in iter_fasta_records(nuc_fasta_fp))
+    if threads == 1:
+        for seq in records:
+            yield find_contig_genes(seq, orf_finder)
+        return
+    with ThreadPoolExecutor(threads) as executor:
+        # bound the number of contigs held in memory
+        queue = deque()
+        for seq in records:
+            queue.append(executor.submit(find_contig_genes, seq, orf_finder))
+            if len(queue) >= threads * 2:
+                yield queue.popleft().result()
+        while len(queue) > 0:
+            yield queue.popleft().result()
+
+
+def run_prodigal(nuc_fasta_fp: str, threads: int = 1) -> List[ProdigalOutput]:
+    proteins = []
+    for contig_proteins in iter_prodigal(nuc_fasta_fp, threads=threads):
+        proteins.extend(contig_proteins)
     return proteins
 
 
+def write_to_store(
+    proteins: Iterable[List[ProdigalOutput]], output_dir: str, name: str
+):
+    # proteins are written incrementally (batches of orfs, e.g. per contig)
+    # orfs reference unique proteins (paralogs, repeated transposases etc.)
+    # by protein_id, sequences are only stored once
+    protein_writer = TableWriter(output_dir, name, "proteins")
+    orf_writer = TableWriter(output_dir, name, "orfs")
+    seen = set()
+    for batch in proteins:
+        unique_batch = []
+        for p in batch:
+            if p["protein_id"] not in seen:
+                seen.add(p["protein_id"])
+                unique_batch.append(
+                    {"protein_id": p["protein_id"], "sequence": p["sequence"]}
+                )
+        protein_writer.write(unique_batch)
+        orf_writer.write(
+            [{k: p[k] for k in OrfOutput.__annotations__} for p in batch]
+        )
+    protein_writer.close()
+    # orf table is closed last (marks the store as complete)
+    orf_writer.close()
+
+
+def load_store(output_dir: str, name: str):
+    # convert prodigal outputs created before the genome store
+    if table_exists(output_dir, name, "orfs") == False:
+        prodigal_fp = f"{output_dir}/{name}/prodigal.json"
+        write_to_store([json.load(open(prodigal_fp))], output_dir, name)
+
+
+def load_orfs(
+    output_dir: str,
+    name: str,
+    columns: Optional[List[str]] = None,
+    protein_ids: Optional[List[int]] = None,
+) -> List[OrfOutput]:
+    load_store(output_dir, name)
+    return read_rows(
+        output_dir, name, "orfs", columns=columns, protein_ids=protein_ids
+    )
+
+
+def load_unique_proteins(
+    output_dir: str,
+    name: str,
+    protein_ids: Optional[List[int]] = None,
+) -> List[UniqueProteinOutput]:
+    load_store(output_dir, name)
+    proteins = read_rows(output_dir, name, "proteins", protein_ids=protein_ids)
+    orf_lookup = {p["protein_id"]: [] for p in proteins}
+    for o in load_orfs(output_dir, name, protein_ids=protein_ids):
+        orf_id = f"{o['contig_id']}_{o['contig_start']}_{o['contig_stop']}"
+        orf_lookup[o["protein_id"]].append(orf_id)
+    for p in proteins:
+        p["orf_ids"] = orf_lookup[p["protein_id"]]
+    return proteins
+
+
+def export_to_files(output_dir: str, name: str) -> bool:
+    # restore the original file layout (prodigal.json) from the genome store
+    prodigal_fp = f"{output_dir}/{name}/prodigal.json"
+    if os.path.exists(prodigal_fp) == False:
+        sequences = {
+            p["protein_id"]: p["sequence"]
+            for p in read_rows(output_dir, name, "proteins")
+        }
+        proteins = load_orfs(output_dir, name)
+        for p in proteins:
+            p["sequence"] = sequences[p["protein_id"]]
+        with open(prodigal_fp, "w") as f:
+            json.dump(proteins, f)
+    return True
+
+
 ########################################################################
 # Airflow inference functions
 ########################################################################
 
 
-def run_on_single_file(nuc_fasta_fp: str, output_dir: str = None) -> bool:
+def run_on_single_file(
+    nuc_fasta_fp: str, output_dir: str = None, threads: int = 1
+) -> bool:
     basename = os.path.basename(nuc_fasta_fp)
-    output_fp = f"{output_dir}/{basename}/prodigal.json"
-    if os.path.exists(output_fp) == False:
-        proteins = run_prodigal(nuc_fasta_fp)
-        with open(output_fp, "w") as f:
-            json.dump(proteins, f)
+    prodigal_fp = f"{output_dir}/{basename}/prodigal.json"
+    if table_exists(output_dir, basename, "orfs"):
+        pass
+    elif os.path.exists(prodigal_fp):
+        load_store(output_dir, basename)
+    else:
+        proteins = iter_prodigal(nuc_fasta_fp, threads=threads)
+        write_to_store(proteins, output_dir, basename)
     return True
 
 
 def parallel_run_on_files(
     filenames: List[str], output_dir: str, cpu_cores: int = 1
 ) -> bool:
-    funct = partial(run_on_single_file, output_dir=output_dir)
-    pool = Pool(cpu_cores)
+    # split cores between files (processes) and contigs (threads)
+    # so a single large assembly still uses all cores
+    processes = max(1, min(cpu_cores, len(filenames)))
+    threads = max(1, cpu_cores // processes)
+    funct = partial(run_on_single_file, output_dir=output_dir, threads=threads)
+    pool = Pool(processes)
     process = pool.imap_unordered(funct, filenames)
     out = [
         p
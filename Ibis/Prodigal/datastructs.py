@@ -1,4 +1,4 @@
-from typing import TypedDict
+from typing import List, TypedDict
 
 
 class ProdigalOutput(TypedDict):
@@ -7,3 +7,16 @@ class ProdigalOutput(TypedDict):
     contig_start: int
     contig_stop: int
     sequence: str
+
+
+class OrfOutput(TypedDict):
+    protein_id: int
+    contig_id: int
+    contig_start: int
+    contig_stop: int
+
+
+class UniqueProteinOutput(TypedDict):
+    protein_id: int
+    sequence: str
+    orf_ids: List[str]  # {contig_id}_{contig_start}_{contig_stop}
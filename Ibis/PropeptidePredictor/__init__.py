@@ -4,7 +4,9 @@ from typing import List, Optional
 
 from tqdm import tqdm
 
+from Ibis.Prodigal import load_unique_proteins
 from Ibis.PropeptidePredictor.pipeline import PropeptidePredictorPipeline
+from Ibis.ProteinEmbedder import load_residue_lookup
 
 ########################################################################
 # General functions
@@ -15,7 +17,9 @@ def run_propeptide_predictor_on_proteins(
     protein_sequences: List[str], gpu_id: Optional[int] = None
 ):
     propeptide_predictor = PropeptidePredictorPipeline(gpu_id=gpu_id)
-    return propeptide_predictor.run(protein_sequences)
+    out = propeptide_predictor.run(protein_sequences)
+    propeptide_predictor.close()
+    return out
 
 
 ########################################################################
@@ -30,6 +34,7 @@ def run_on_files(
     mol_preds_created: bool,
     gpu_id: Optional[int] = None,
     cpu_cores: int = 1,
+    residue_preds_created: bool = False,
 ) -> bool:
     if prodigal_preds_created == False:
         raise ValueError("Prodigal predictions not created")
@@ -54,15 +59,22 @@ def run_on_files(
                     proteins_to_run.add(query["query_id"])
             if len(proteins_to_run) > 0:
                 sequences = set()
-                prodigal_fp = f"{output_dir}/{name}/prodigal.json"
-                for p in json.load(open(prodigal_fp)):
-                    if p["protein_id"] in proteins_to_run:
-                        sequences.add(p["sequence"])
-                out = pipeline.run(list(sequences))
+                for p in load_unique_proteins(
+                    output_dir, name, protein_ids=list(proteins_to_run)
+                ):
+                    sequences.add(p["sequence"])
+                residue_lookup = load_residue_lookup(
+                    f"{output_dir}/{name}/residue_predictions.pkl",
+                    residue_preds_created=residue_preds_created,
+                )
+                out = pipeline.run(
+                    list(sequences), residue_lookup=residue_lookup
+                )
             else:
                 out = []
             with open(export_fp, "w") as f:
                 json.dump(out, f)
+    pipeline.close()
     del pipeline
     return True
 
@@ -1,9 +1,7 @@
-import functools
-from typing import List, Optional
+from typing import Dict, Iterator, List, Optional, Tuple
 
 import numpy as np
 import xxhash
-from tqdm import tqdm
 from transformers import PreTrainedTokenizerFast
 
 from Ibis import curdir
@@ -13,11 +11,21 @@ from Ibis.PropeptidePredictor.datastructs import (
     PipelineIntermediateOutput,
     PipelineOutput,
 )
+from Ibis.ProteinEmbedder.datastructs import ResiduePredictionOutput
 from Ibis.Utilities.class_dicts import get_class_dict
 from Ibis.Utilities.onnx import get_onnx_base_model, get_onnx_head
-from Ibis.Utilities.preprocess import batchify_tokenized_inputs, slice_proteins
+from Ibis.Utilities.preprocess import (
+    batchify_tokenized_inputs,
+    collect_protein_windows,
+    forward_bucketed_windows,
+    pool_protein_windows,
+    slice_proteins,
+    stack_window_outputs,
+)
 from Ibis.Utilities.RegionCalling.postprocess import (
-    parallel_pipeline_token_region_calling,
+    RegionCallingPool,
+    get_residue_classification,
+    get_residue_predictions,
 )
 from Ibis.Utilities.tokenizers import get_protbert_tokenizer
 
@@ -40,20 +48,63 @@ class PropeptidePredictorPipeline:
         )
         self.propeptide_cls_dict = get_class_dict(propeptide_cls_dict_fp)
         self.cpu_cores = cpu_cores
+        # workers are kept between run calls (see close)
+        self.region_calling_pool = RegionCallingPool(cpu_cores=cpu_cores)
 
     def __call__(self, sequence: str) -> PipelineIntermediateOutput:
         model_inputs = self.preprocess(sequence)
         model_outputs = self._forward(model_inputs)
         return self.postprocess(model_outputs)
 
-    def run(self, sequences: List[str]) -> List[PipelineOutput]:
-        out = [
-            self(s)
-            for s in tqdm(sequences, leave=False, desc="PropeptidePredictor")
-        ]
-        out = parallel_pipeline_token_region_calling(
-            pipeline_outputs=out, cpu_cores=self.cpu_cores
-        )
+    def close(self):
+        # stops region calling workers
+        self.region_calling_pool.close()
+
+    def run(
+        self,
+        sequences: List[str],
+        max_tokens: int = 16384,
+        batch_size: int = 32,
+        residue_lookup: Optional[Dict[int, ResiduePredictionOutput]] = None,
+    ) -> List[PipelineOutput]:
+        if len(sequences) == 0:
+            return []
+        # reuse residue predictions from the shared protein embedder pass
+        sequences_to_run = []
+        for sequence in sequences:
+            protein_id = xxhash.xxh32(sequence).intdigest()
+            if residue_lookup is not None and protein_id in residue_lookup:
+                p = residue_lookup[protein_id]
+                # scores are stored as percentages
+                self.region_calling_pool.submit(
+                    self.postprocess_residue_predictions(
+                        sequence,
+                        p["propeptide_labels"],
+                        p["propeptide_scores"] / 100,
+                    )
+                )
+            else:
+                sequences_to_run.append(sequence)
+        # pool windows across proteins (each onnx call sees a full batch)
+        # region calling of finished proteins overlaps with later batches
+        if len(sequences_to_run) > 0:
+            windows, offsets = pool_protein_windows(sequences_to_run)
+            for idx, window_predictions in collect_protein_windows(
+                self._forward_windows(
+                    windows, max_tokens=max_tokens, batch_size=batch_size
+                ),
+                offsets,
+            ):
+                model_outputs = {
+                    "sequence": sequences_to_run[idx],
+                    "propeptide_window_predictions": stack_window_outputs(
+                        window_predictions
+                    ),
+                }
+                self.region_calling_pool.submit(
+                    self.postprocess(model_outputs)
+                )
+        out = self.region_calling_pool.collect()
         final = []
         for p in out:
             prop_regions = [r for r in p["regions"] if r["label"] == "prop"]
@@ -107,47 +158,43 @@ class PropeptidePredictorPipeline:
             "propeptide_window_predictions": propeptide_predictions,
         }
 
+    def _forward_windows(
+        self,
+        windows: List[str],
+        max_tokens: int = 16384,
+        batch_size: int = 32,
+    ) -> Iterator[Tuple[List[int], List[np.array]]]:
+        # yields window indices of each batch with their predictions
+        for bucket, model_out in forward_bucketed_windows(
+            windows,
+            self.tokenizer,
+            self.model,
+            ["last_hidden_state"],
+            residue_heads={"propeptide": self.propeptide_head},
+            max_tokens=max_tokens,
+            max_bs=batch_size,
+            desc="Running PropeptidePredictor on window batches",
+        ):
+            yield bucket, model_out["propeptide"]
+
     def postprocess(
         self, model_outputs: ModelOutput
     ) -> PipelineIntermediateOutput:
         sequence = model_outputs["sequence"]
-        logits = model_outputs["propeptide_window_predictions"]
-        # average logits
-        logits = self.softmax(
-            functools.reduce(self.merge_overlap_average, logits)
+        labels, scores = get_residue_predictions(
+            model_outputs["propeptide_window_predictions"], len(sequence)
+        )
+        return self.postprocess_residue_predictions(sequence, labels, scores)
+
+    def postprocess_residue_predictions(
+        self, sequence: str, labels: np.array, scores: np.array
+    ) -> PipelineIntermediateOutput:
+        residue_classification = get_residue_classification(
+            labels, scores, self.propeptide_cls_dict
         )
-        # remove pad tokens
-        residue_classification = []
-        logits = logits[: len(sequence)]
-        for pos, scores in enumerate(logits):
-            # take top prediction that passes threshold
-            top = int(scores.argmax())
-            top_score = round(float(scores[top]), 2)
-            if top_score >= 0.5:
-                residue_classification.append(
-                    {
-                        "pos": pos,
-                        "label": self.propeptide_cls_dict.get(top),
-                        "score": top_score,
-                    }
-                )
         # return output
         return {
             "protein_id": xxhash.xxh32(sequence).intdigest(),
             "sequence": sequence,
             "residue_classification": residue_classification,
         }
-
-    def merge_overlap_average(self, a, b, step=256):
-        overlapping_length = b.shape[0] - step
-        overlapping_arr_a = a[-overlapping_length:]
-        overlapping_arr_b = b[:overlapping_length]
-        a[-overlapping_length:] = np.mean(
-            [overlapping_arr_a, overlapping_arr_b], axis=0
-        )
-        out_arr = np.concatenate([a, b[overlapping_length:]], axis=0)
-        return out_arr
-
-    @staticmethod
-    def softmax(x):
-        return np.exp(x) / np.exp(x).sum(-1, keepdims=True)
@@ -1,11 +1,13 @@
 import json
 import os
-import pickle
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from typing import Callable, List
+from typing import Callable, Dict, List
 
+import numpy as np
 from tqdm import tqdm
 
+from Ibis.Prodigal import load_orfs
 from Ibis.ProteinDecoder.databases import (
     IbisEC,
     IbisGene,
@@ -13,11 +15,18 @@ from Ibis.ProteinDecoder.databases import (
     IbisKO,
     IbisMolecule,
 )
+from Ibis.Utilities.genome_store import (
+    get_embedding_lookup,
+    load_legacy_embeddings,
+    read_table,
+)
+from Ibis.Utilities.Qdrant.cache import get_knn_cache
 from Ibis.Utilities.Qdrant.classification import (
     KNNClassification,
     neighborhood_classification,
     ontology_neighborhood_classification,
 )
+from Ibis.Utilities.Qdrant.datastructs import DataQuery
 
 ########################################################################
 # General functions
@@ -77,6 +86,66 @@ decode_gene = partial(
     apply_cutoff_after_homology=False,
 )
 
+
+def get_protein_ids_to_decode(
+    output_dir: str, name: str, decode_names: List[str], trimmed: bool = False
+) -> Dict[str, List[int]]:
+    # genome data is read once and shared by all decoders
+    if trimmed == False:
+        # run on all proteins (legacy pickles are converted first)
+        load_legacy_embeddings(output_dir, name, "protein_embeddings")
+        table = read_table(
+            output_dir,
+            name,
+            "protein_embeddings",
+            columns=["protein_id", "ec1"],
+        )
+        protein_ids = table["protein_id"].to_pylist()
+        # only consider enzymes for ec predictions
+        enzyme_ids = [
+            p
+            for p, ec1 in zip(protein_ids, table["ec1"].to_pylist())
+            if ec1 != "EC:-"
+        ]
+        return {
+            k: enzyme_ids if k == "ec" else protein_ids for k in decode_names
+        }
+    # run on only proteins in bgc
+    bgc_fp = f"{output_dir}/{name}/bgc_predictions.json"
+    # connect orfs to proteins
+    orf_lookup = {}
+    for p in load_orfs(output_dir, name):
+        contig_id = p["contig_id"]
+        contig_start = p["contig_start"]
+        contig_stop = p["contig_stop"]
+        orf_id = f"{contig_id}_{contig_start}_{contig_stop}"
+        orf_lookup[orf_id] = p["protein_id"]
+    bgc_orfs = []
+    ripp_orfs = []
+    for cluster in json.load(open(bgc_fp)):
+        bgc_orfs.extend(cluster["orfs"])
+        internal_chemotypes = cluster["internal_chemotypes"]
+        if (
+            "Bacteriocin" in internal_chemotypes
+            or "Ripp" in internal_chemotypes
+        ):
+            ripp_orfs.extend(cluster["orfs"])
+    out = {}
+    for k in decode_names:
+        orfs_to_run = ripp_orfs if k == "molecule" else bgc_orfs
+        # decode each unique protein once
+        out[k] = list(dict.fromkeys(orf_lookup[o] for o in orfs_to_run))
+    return out
+
+
+def get_data_queries(
+    protein_ids: List[int], embedding_lookup: Dict[int, np.ndarray]
+) -> List[DataQuery]:
+    return [
+        {"query_id": p, "embedding": embedding_lookup[p]} for p in protein_ids
+    ]
+
+
 ########################################################################
 # Airflow inference functions
 ########################################################################
@@ -89,38 +158,12 @@ def run_on_files(
     decode_fn: Callable,
     decode_name: str,
 ) -> bool:
-    if protein_embs_created == False:
-        raise ValueError("Protein embeddings not created")
-    # run on all proteins
-    for name in tqdm(
-        filenames, leave=False, desc=f"Running {decode_name} Decoder"
-    ):
-        export_fp = f"{output_dir}/{name}/{decode_name}_predictions.json"
-        if os.path.exists(export_fp) == False:
-            embedding_fp = f"{output_dir}/{name}/protein_embedding.pkl"
-            data_queries = []
-            if decode_name == "ec":
-                for p in pickle.load(open(embedding_fp, "rb")):
-                    # only consider enzymes for ec predictions
-                    if p["ec1"] != "EC:-":
-                        data_queries.append(
-                            {
-                                "query_id": p["protein_id"],
-                                "embedding": p["embedding"],
-                            }
-                        )
-            else:
-                for p in pickle.load(open(embedding_fp, "rb")):
-                    data_queries.append(
-                        {
-                            "query_id": p["protein_id"],
-                            "embedding": p["embedding"],
-                        }
-                    )
-            out = decode_fn(data_queries)
-            with open(export_fp, "w") as f:
-                json.dump(out, f)
-    return True
+    return fused_run_on_files(
+        filenames=filenames,
+        output_dir=output_dir,
+        protein_embs_created=protein_embs_created,
+        decoders={decode_name: decode_fn},
+    )
 
 
 def trimmed_run_on_files(
@@ -132,59 +175,72 @@ def trimmed_run_on_files(
     decode_fn: Callable,
     decode_name: str,
 ) -> bool:
-    if prodigal_preds_created == False:
-        raise ValueError("Prodigal predictions not created")
+    return fused_run_on_files(
+        filenames=filenames,
+        output_dir=output_dir,
+        protein_embs_created=protein_embs_created,
+        decoders={decode_name: decode_fn},
+        trimmed=True,
+        prodigal_preds_created=prodigal_preds_created,
+        bgc_preds_created=bgc_preds_created,
+    )
+
+
+def fused_run_on_files(
+    filenames: List[str],
+    output_dir: str,
+    protein_embs_created: bool,
+    decoders: Dict[str, Callable],  # decode_name -> decode_fn
+    trimmed: bool = False,
+    prodigal_preds_created: bool = True,
+    bgc_preds_created: bool = True,
+) -> bool:
+    # embeddings are loaded once per genome and the queries are sent to
+    # all collections concurrently
     if protein_embs_created == False:
         raise ValueError("Protein embeddings not created")
-    if bgc_preds_created == False:
-        raise ValueError("BGC predictions not created")
-    # run on only proteins in bgc
+    if trimmed:
+        if prodigal_preds_created == False:
+            raise ValueError("Prodigal predictions not created")
+        if bgc_preds_created == False:
+            raise ValueError("BGC predictions not created")
+    decode_names = ", ".join(decoders)
     for name in tqdm(
-        filenames, leave=False, desc=f"Running {decode_name} Decoder"
+        filenames, leave=False, desc=f"Running {decode_names} Decoder"
     ):
-        export_fp = f"{output_dir}/{name}/{decode_name}_predictions.json"
-        if os.path.exists(export_fp) == False:
-            embedding_fp = f"{output_dir}/{name}/protein_embedding.pkl"
-            prodigal_fp = f"{output_dir}/{name}/prodigal.json"
-            bgc_fp = f"{output_dir}/{name}/bgc_predictions.json"
-            # load embeddings
-            hash_embedding_lookup = {}
-            for p in pickle.load(open(embedding_fp, "rb")):
-                protein_id = p["protein_id"]
-                embedding = p["embedding"]
-                hash_embedding_lookup[protein_id] = embedding
-            # connect embeddings to orfs
-            orf_embedding_lookup = {}
-            for p in json.load(open(prodigal_fp)):
-                contig_id = p["contig_id"]
-                contig_start = p["contig_start"]
-                contig_stop = p["contig_stop"]
-                protein_id = p["protein_id"]
-                orf_id = f"{contig_id}_{contig_start}_{contig_stop}"
-                embedding = hash_embedding_lookup[protein_id]
-                orf_embedding_lookup[orf_id] = {
-                    "query_id": protein_id,
-                    "embedding": embedding,
-                }
-            # build data queries
-            data_queries = []
-            if decode_name == "molecule":
-                for cluster in json.load(open(bgc_fp)):
-                    internal_chemotypes = cluster["internal_chemotypes"]
-                    if (
-                        "Bacteriocin" in internal_chemotypes
-                        or "Ripp" in internal_chemotypes
-                    ):
-                        for orf_id in cluster["orfs"]:
-                            data_queries.append(orf_embedding_lookup[orf_id])
-            else:
-                for cluster in json.load(open(bgc_fp)):
-                    for orf_id in cluster["orfs"]:
-                        data_queries.append(orf_embedding_lookup[orf_id])
-            # analysis
-            out = decode_fn(data_queries)
-            with open(export_fp, "w") as f:
-                json.dump(out, f)
+        export_fps = {
+            k: f"{output_dir}/{name}/{k}_predictions.json" for k in decoders
+        }
+        to_run = [
+            k for k, v in export_fps.items() if os.path.exists(v) == False
+        ]
+        if len(to_run) == 0:
+            continue
+        protein_ids = get_protein_ids_to_decode(
+            output_dir, name, to_run, trimmed=trimmed
+        )
+        embedding_lookup = get_embedding_lookup(
+            output_dir,
+            name,
+            "protein_embeddings",
+            "protein_id",
+            ids=set().union(*protein_ids.values()),
+        )
+        # analysis
+        with ThreadPoolExecutor(len(to_run)) as executor:
+            futures = {
+                k: executor.submit(
+                    decoders[k],
+                    get_data_queries(protein_ids[k], embedding_lookup),
+                )
+                for k in to_run
+            }
+            for k, future in futures.items():
+                with open(export_fps[k], "w") as f:
+                    json.dump(future.result(), f)
+    cache = get_knn_cache()
+    if cache is not None:
+        print(f"KNN cache: {cache.stats}")
     return True
 
 
@@ -1,12 +1,22 @@
 import json
 import os
 import pickle
-from typing import List
+from typing import Dict, List, Optional
 
 from tqdm import tqdm
 
-from Ibis.ProteinEmbedder.datastructs import PipelineOutput
+from Ibis import curdir
+from Ibis.Prodigal import load_unique_proteins
+from Ibis.ProteinEmbedder.cache import ProteinEmbeddingCache
+from Ibis.ProteinEmbedder.datastructs import (
+    PipelineOutput,
+    ResiduePredictionOutput,
+)
 from Ibis.ProteinEmbedder.pipeline import ProteinEmbedderPipeline
+from Ibis.Utilities.genome_store import (
+    embeddings_created,
+    write_embeddings,
+)
 
 ########################################################################
 # General functions
@@ -20,6 +30,15 @@ def run_on_protein_sequences(
     return pipeline.run(sequences)
 
 
+def load_residue_lookup(
+    residue_fp: str, residue_preds_created: bool
+) -> Optional[Dict[int, ResiduePredictionOutput]]:
+    # residue predictions are only saved in multi-head mode
+    if residue_preds_created == False or os.path.exists(residue_fp) == False:
+        return None
+    return {p["protein_id"]: p for p in pickle.load(open(residue_fp, "rb"))}
+
+
 ########################################################################
 # Airflow inference functions
 ########################################################################
@@ -30,20 +49,45 @@ def run_on_files(
     output_dir: str,
     prodigal_preds_created: bool,
     gpu_id: int = 0,
+    save_residue_predictions: bool = False,
+    cache_dir: Optional[str] = None,
 ) -> bool:
     if prodigal_preds_created == False:
         raise ValueError("Prodigal predictions not created")
     # load pipeline
-    pipeline = ProteinEmbedderPipeline(gpu_id=gpu_id)
+    # domain and propeptide heads share the protein embedder pass
+    # residue predictions are reused by DomainPredictor and PropeptidePredictor
+    if save_residue_predictions:
+        pipeline = ProteinEmbedderPipeline(
+            domain_head_fp=f"{curdir}/Models/domain_predictor.onnx",
+            propeptide_head_fp=f"{curdir}/Models/propeptide_predictor.onnx",
+            gpu_id=gpu_id,
+        )
+    else:
+        pipeline = ProteinEmbedderPipeline(gpu_id=gpu_id)
+    # embeddings shared across genomes (keyed by protein_id)
+    cache = None
+    if cache_dir is not None:
+        cache = ProteinEmbeddingCache(
+            cache_dir, model_fingerprint=pipeline.model_fingerprint
+        )
     # analysis
     for name in tqdm(filenames, leave=False, desc="Running Protein Embedder"):
-        export_filename = f"{output_dir}/{name}/protein_embedding.pkl"
-        if os.path.exists(export_filename) == False:
-            prodigal_fp = f"{output_dir}/{name}/prodigal.json"
-            sequences = [p["sequence"] for p in json.load(open(prodigal_fp))]
-            out = pipeline.run(sequences)
-            with open(export_filename, "wb") as f:
-                pickle.dump(out, f)
+        if embeddings_created(output_dir, name, "protein_embeddings") == False:
+            # only embed unique proteins (orfs reference them by protein_id)
+            sequences = [
+                p["sequence"] for p in load_unique_proteins(output_dir, name)
+            ]
+            out, residue_out = pipeline.run_multi_head(sequences, cache=cache)
+            if save_residue_predictions:
+                residue_fp = f"{output_dir}/{name}/residue_predictions.pkl"
+                with open(residue_fp, "wb") as f:
+                    pickle.dump(residue_out, f)
+            write_embeddings(
+                output_dir, name, "protein_embeddings", out, ["protein_id"]
+            )
+    if cache is not None:
+        print(f"Protein embedding cache: {cache.stats}")
     # delete pipeline
     del pipeline
     return True
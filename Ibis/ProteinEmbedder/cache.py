@@ -0,0 +1,303 @@
+import fcntl
+import json
+import os
+from contextlib import contextmanager
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import xxhash
+
+from Ibis.ProteinEmbedder.datastructs import PipelineOutput
+
+
+def get_model_fingerprint(fps: List[Optional[str]]) -> str:
+    # content hash of the model files (and class dicts) that produce the
+    # cached outputs, missing heads are passed as None
+    h = xxhash.xxh64()
+    for fp in fps:
+        h.update(f"{None if fp is None else os.path.basename(fp)}:".encode())
+        if fp is None:
+            continue
+        with open(fp, "rb") as f:
+            for chunk in iter(lambda: f.read(16 * 1024**2), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class ProteinEmbeddingCache:
+    """Persistent protein embedding store keyed by protein_id (xxh32)
+    1. Embeddings are appended to a float32 matrix (memory mapped by readers)
+    2. Index lines are appended only after their rows are on disk
+    3. Compaction (eviction) writes a new generation and swaps CURRENT
+    A 64-bit sequence hash is kept in the index to catch xxh32 collisions.
+    CURRENT also records the fingerprint of the models the embeddings were
+    computed with (see get_model_fingerprint), a pipeline with other models
+    starts a new (empty) generation instead of reading stale embeddings.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str,
+        embedding_dim: int = 1024,
+        max_size: int = 10 * 1024**3,  # bytes of embedding data
+        model_fingerprint: Optional[str] = None,
+    ):
+        self.cache_dir = cache_dir
+        self.embedding_dim = embedding_dim
+        self.row_bytes = embedding_dim * 4
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.used = set()
+        self.generation = None
+        self.fingerprint = None
+        self.model_fingerprint = None
+        self.index = {}
+        self.index_offset = 0
+        os.makedirs(cache_dir, exist_ok=True)
+        self.lock_fp = f"{cache_dir}/.lock"
+        self.current_fp = f"{cache_dir}/CURRENT"
+        with self.lock():
+            if os.path.exists(self.current_fp) == False:
+                self._set_generation(0, model_fingerprint)
+        self.refresh()
+        if model_fingerprint is not None:
+            self.set_model_fingerprint(model_fingerprint)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    @property
+    def stats(self) -> Dict[str, float]:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total > 0 else 0.0,
+            "entries": len(self.index),
+            "size": self.num_rows * self.row_bytes,
+        }
+
+    @contextmanager
+    def lock(self):
+        with open(self.lock_fp, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _get_generation(self) -> Tuple[int, Optional[str]]:
+        # "{generation} {model fingerprint}" (older stores have no
+        # fingerprint)
+        fields = open(self.current_fp).read().split()
+        fingerprint = fields[1] if len(fields) > 1 else None
+        return int(fields[0]), fingerprint
+
+    def _set_generation(self, generation: int, fingerprint: Optional[str]):
+        tmp_fp = f"{self.current_fp}.tmp"
+        with open(tmp_fp, "w") as f:
+            if fingerprint is None:
+                f.write(str(generation))
+            else:
+                f.write(f"{generation} {fingerprint}")
+        os.replace(tmp_fp, self.current_fp)
+
+    def set_model_fingerprint(self, model_fingerprint: str):
+        # the store is (re)started for these models if it holds embeddings
+        # of other models
+        self.model_fingerprint = model_fingerprint
+        if self.fingerprint == model_fingerprint:
+            return
+        with self.lock():
+            self.refresh()
+            if self.fingerprint != model_fingerprint:
+                self._start_generation()
+
+    def _start_generation(self):
+        # called with the lock held, empty generation for the own models
+        old_fps = self._get_filepaths(self.generation)
+        self._set_generation(self.generation + 1, self.model_fingerprint)
+        for fp in old_fps:
+            if os.path.exists(fp):
+                os.remove(fp)
+        self.used = set()
+        self.refresh()
+
+    def _get_filepaths(self, generation: int) -> Tuple[str, str]:
+        return (
+            f"{self.cache_dir}/embeddings.{generation}.f32",
+            f"{self.cache_dir}/index.{generation}.jsonl",
+        )
+
+    def refresh(self):
+        # load index lines appended since the last refresh (the whole index
+        # if the generation was swapped), retry if it is swapped mid-read
+        while True:
+            generation, fingerprint = self._get_generation()
+            data_fp, index_fp = self._get_filepaths(generation)
+            try:
+                if generation != self.generation or (
+                    os.path.exists(index_fp)
+                    and os.path.getsize(index_fp) < self.index_offset
+                ):
+                    self.index = {}
+                    self.index_offset = 0
+                    self.generation = generation
+                    self.fingerprint = fingerprint
+                if os.path.exists(index_fp):
+                    with open(index_fp, "rb") as f:
+                        f.seek(self.index_offset)
+                        for line in f:
+                            # skip partially written lines
+                            if line.endswith(b"\n") == False:
+                                break
+                            self.index_offset += len(line)
+                            entry = json.loads(line)
+                            self.index[entry["protein_id"]] = entry
+                self._load_embeddings(data_fp)
+                return
+            except FileNotFoundError:
+                # generation was swapped, reload from the start
+                self.generation = None
+                continue
+
+    def _load_embeddings(self, data_fp: str):
+        size = os.path.getsize(data_fp) if os.path.exists(data_fp) else 0
+        self.num_rows = size // self.row_bytes
+        if self.num_rows == 0:
+            self.embeddings = None
+        else:
+            self.embeddings = np.memmap(
+                data_fp,
+                dtype=np.float32,
+                mode="r",
+                shape=(self.num_rows, self.embedding_dim),
+            )
+
+    @staticmethod
+    def get_sequence_hash(sequence: str) -> int:
+        return xxhash.xxh64(sequence).intdigest()
+
+    def get(self, sequence: str) -> Optional[PipelineOutput]:
+        protein_id = xxhash.xxh32(sequence).intdigest()
+        entry = self.index.get(protein_id)
+        if (
+            entry is None
+            or entry["sequence_hash"] != self.get_sequence_hash(sequence)
+            or entry["row"] >= self.num_rows
+        ):
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.used.add(protein_id)
+        out = {
+            "protein_id": protein_id,
+            "embedding": np.array(self.embeddings[entry["row"]]),
+        }
+        for k, v in entry.items():
+            if k not in ["protein_id", "sequence_hash", "row"]:
+                out[k] = v
+        return out
+
+    def lookup(
+        self, sequences: List[str]
+    ) -> Tuple[Dict[int, PipelineOutput], List[int]]:
+        # returns cached outputs (by sequence index) and indices of misses
+        # new index lines of concurrent writers are loaded first (no lock)
+        self.refresh()
+        hits = {}
+        misses = []
+        if (
+            self.model_fingerprint is not None
+            and self.fingerprint != self.model_fingerprint
+        ):
+            # another process restarted the store for other models
+            self.misses += len(sequences)
+            return hits, list(range(len(sequences)))
+        for idx, sequence in enumerate(sequences):
+            out = self.get(sequence)
+            if out is None:
+                misses.append(idx)
+            else:
+                hits[idx] = out
+        return hits, misses
+
+    def add(self, sequences: List[str], outputs: List[PipelineOutput]):
+        if len(sequences) == 0:
+            return
+        with self.lock():
+            # catch up with other writers before appending
+            self.refresh()
+            if (
+                self.model_fingerprint is not None
+                and self.fingerprint != self.model_fingerprint
+            ):
+                self._start_generation()
+            data_fp, index_fp = self._get_filepaths(self.generation)
+            entries = []
+            with open(data_fp, "ab") as f:
+                # drop trailing bytes of an interrupted write
+                f.truncate(self.num_rows * self.row_bytes)
+                for sequence, out in zip(sequences, outputs):
+                    sequence_hash = self.get_sequence_hash(sequence)
+                    entry = self.index.get(out["protein_id"])
+                    if entry is not None and entry["sequence_hash"] == (
+                        sequence_hash
+                    ):
+                        continue
+                    f.write(np.asarray(out["embedding"], np.float32).tobytes())
+                    entry = {k: v for k, v in out.items() if k != "embedding"}
+                    entry["sequence_hash"] = sequence_hash
+                    entry["row"] = self.num_rows + len(entries)
+                    entries.append(entry)
+                    self.index[entry["protein_id"]] = entry
+                f.flush()
+                os.fsync(f.fileno())
+            with open(index_fp, "ab") as f:
+                f.truncate(self.index_offset)
+                for entry in entries:
+                    line = (json.dumps(entry) + "\n").encode()
+                    f.write(line)
+                    self.index_offset += len(line)
+                    # same values as entries read back by refresh
+                    self.index[entry["protein_id"]] = json.loads(line)
+                f.flush()
+                os.fsync(f.fileno())
+            # own entries are already in the index, only remap embeddings
+            self._load_embeddings(data_fp)
+            if self.num_rows * self.row_bytes > self.max_size:
+                self._compact()
+
+    def _compact(self, fill: float = 0.8):
+        # called with the lock held
+        # evict oldest entries first, entries used by this process are kept
+        # longest (they are moved behind the unused entries)
+        entries = sorted(self.index.values(), key=lambda x: x["row"])
+        entries = [e for e in entries if e["protein_id"] not in self.used] + [
+            e for e in entries if e["protein_id"] in self.used
+        ]
+        max_rows = int(self.max_size * fill) // self.row_bytes
+        entries = entries[-max_rows:] if max_rows > 0 else []
+        entries = sorted(entries, key=lambda x: x["row"])
+        # write new generation
+        old_data_fp, old_index_fp = self._get_filepaths(self.generation)
+        generation = self.generation + 1
+        data_fp, index_fp = self._get_filepaths(generation)
+        with open(data_fp, "wb") as data_f, open(index_fp, "wb") as index_f:
+            for row, entry in enumerate(entries):
+                data_f.write(
+                    np.asarray(self.embeddings[entry["row"]]).tobytes()
+                )
+                entry = dict(entry, row=row)
+                index_f.write((json.dumps(entry) + "\n").encode())
+            data_f.flush()
+            os.fsync(data_f.fileno())
+            index_f.flush()
+            os.fsync(index_f.fileno())
+        self._set_generation(generation, self.fingerprint)
+        # readers with the old generation open keep their mapping
+        for fp in [old_data_fp, old_index_fp]:
+            if os.path.exists(fp):
+                os.remove(fp)
+        self.refresh()
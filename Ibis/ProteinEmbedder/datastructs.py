@@ -27,3 +27,12 @@ class PipelineOutput(TypedDict):
     embedding: np.array
     ec1: str
     ec1_score: float
+
+
+class ResiduePredictionOutput(TypedDict, total=False):
+    protein_id: int
+    # top label id and score (as a percentage) for every residue
+    domain_labels: np.array
+    domain_scores: np.array
+    propeptide_labels: np.array
+    propeptide_scores: np.array
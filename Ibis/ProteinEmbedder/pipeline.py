@@ -1,23 +1,33 @@
-from typing import List, Optional
+from typing import Dict, List, Optional, Tuple
 
 import numpy as np
 import xxhash
-from tqdm import tqdm
 from transformers import PreTrainedTokenizerFast
 
 from Ibis import curdir
+from Ibis.ProteinEmbedder.cache import (
+    ProteinEmbeddingCache,
+    get_model_fingerprint,
+)
 from Ibis.ProteinEmbedder.datastructs import (
     ModelInput,
     ModelOutput,
     PipelineOutput,
+    ResiduePredictionOutput,
 )
 from Ibis.Utilities.class_dicts import get_class_dict
 from Ibis.Utilities.onnx import get_onnx_base_model, get_onnx_head
 from Ibis.Utilities.preprocess import (
+    batchify,
     batchify_tokenized_inputs,
+    forward_bucketed_windows,
     get_indices,
+    pool_protein_windows,
+    restore_bucket_order,
     slice_proteins,
+    stack_window_outputs,
 )
+from Ibis.Utilities.RegionCalling.postprocess import get_residue_predictions
 from Ibis.Utilities.tokenizers import get_protbert_tokenizer
 
 
@@ -35,6 +45,8 @@ class ProteinEmbedderPipeline:
         ec3_cls_dict_fp: str = None,
         ec4_head_fp: str = None,
         ec4_cls_dict_fp: str = None,
+        domain_head_fp: str = None,
+        propeptide_head_fp: str = None,
         gpu_id: Optional[int] = None,
     ):
         self.model = get_onnx_base_model(model_fp=model_fp, gpu_id=gpu_id)
@@ -50,14 +62,106 @@ class ProteinEmbedderPipeline:
         if ec4_head_fp:
             self.ec4_head = get_onnx_head(model_fp=ec4_head_fp, gpu_id=gpu_id)
             self.ec4_cls_dict = get_class_dict(ec4_cls_dict_fp)
+        # residue heads share the protein embedder pass (multi-head mode)
+        self.residue_heads = {}
+        if domain_head_fp:
+            self.residue_heads["domain"] = get_onnx_head(
+                model_fp=domain_head_fp, gpu_id=gpu_id
+            )
+        if propeptide_head_fp:
+            self.residue_heads["propeptide"] = get_onnx_head(
+                model_fp=propeptide_head_fp, gpu_id=gpu_id
+            )
+        # identity of the cached outputs (embeddings and ec predictions),
+        # residue predictions are not cached
+        self.model_fingerprint = get_model_fingerprint(
+            [
+                model_fp,
+                ec1_head_fp,
+                ec1_cls_dict_fp,
+                ec2_head_fp,
+                ec2_cls_dict_fp,
+                ec3_head_fp,
+                ec3_cls_dict_fp,
+                ec4_head_fp,
+                ec4_cls_dict_fp,
+            ]
+        )
 
     def __call__(self, sequence: str):
         model_inputs = self.preprocess(sequence)
         model_outputs = self._forward(model_inputs)
         return self.postprocess(model_outputs)
 
-    def run(self, sequences: List[str]) -> PipelineOutput:
-        return [self(s) for s in tqdm(sequences, leave=False)]
+    def run(
+        self,
+        sequences: List[str],
+        max_tokens: int = 16384,
+        batch_size: int = 32,
+        cache: Optional[ProteinEmbeddingCache] = None,
+    ) -> List[PipelineOutput]:
+        out, _ = self.run_multi_head(
+            sequences,
+            max_tokens=max_tokens,
+            batch_size=batch_size,
+            cache=cache,
+        )
+        return out
+
+    def run_multi_head(
+        self,
+        sequences: List[str],
+        max_tokens: int = 16384,
+        batch_size: int = 32,
+        cache: Optional[ProteinEmbeddingCache] = None,
+    ) -> Tuple[List[PipelineOutput], List[ResiduePredictionOutput]]:
+        if len(sequences) == 0:
+            return [], []
+        if cache is not None:
+            # only run onnx on cache misses
+            # residue predictions are not cached (only returned for misses)
+            if cache.model_fingerprint != self.model_fingerprint:
+                cache.set_model_fingerprint(self.model_fingerprint)
+            hits, misses = cache.lookup(sequences)
+            miss_sequences = [sequences[idx] for idx in misses]
+            miss_out, residue_out = self.run_multi_head(
+                miss_sequences, max_tokens=max_tokens, batch_size=batch_size
+            )
+            cache.add(miss_sequences, miss_out)
+            hits.update(zip(misses, miss_out))
+            return [hits[idx] for idx in range(len(sequences))], residue_out
+        # pool windows across proteins (each onnx call sees a full batch)
+        windows, offsets = pool_protein_windows(sequences)
+        window_outputs, residue_window_outputs = self._forward_windows(
+            windows, max_tokens=max_tokens, batch_size=batch_size
+        )
+        # scatter window outputs back to proteins
+        out = []
+        residue_out = []
+        for idx, sequence in enumerate(sequences):
+            start, stop = offsets[idx], offsets[idx + 1]
+            model_outputs = {
+                "sequence": sequence,
+                "lengths": [len(w) for w in windows[start:stop]],
+            }
+            for k, v in window_outputs.items():
+                model_outputs[k] = v[start:stop]
+            out.append(self.postprocess(model_outputs))
+            # residue heads (only if loaded)
+            if len(residue_window_outputs) == 0:
+                continue
+            residue_predictions = {"protein_id": out[-1]["protein_id"]}
+            for head_name, v in residue_window_outputs.items():
+                labels, scores = get_residue_predictions(
+                    stack_window_outputs(v[start:stop]), len(sequence)
+                )
+                residue_predictions[f"{head_name}_labels"] = labels
+                # scores are rounded to 2 decimals, store as percentages
+                residue_predictions[f"{head_name}_scores"] = np.rint(
+                    scores * 100
+                ).astype(np.uint8)
+            residue_out.append(residue_predictions)
+        return out, residue_out
 
     def preprocess(self, sequence: str) -> ModelInput:
         windows = slice_proteins(sequence)
@@ -82,46 +186,75 @@ class ProteinEmbedderPipeline:
             batch_pooler_output.append(po[0])
         # concatenate outputs
         pooler_output = np.concatenate(batch_pooler_output)
-        # EC1 sequence classification head prediction
-        ec1_predictions = np.concatenate(
-            [
-                self.ec1_head.run(["output"], {"input": inp})[0]
-                for inp in batch_pooler_output
-            ]
-        )
         # Generate output
         output = {
             "sequence": model_inputs["sequence"],
             "lengths": model_inputs["lengths"],
             "cls_window_embeddings": pooler_output,
-            "ec1_window_predictions": ec1_predictions,
         }
-        # Optionally annotate with additional heads if instantiated
-        if hasattr(self, "ec2_head"):
-            ec2_predictions = np.concatenate(
-                [
-                    self.ec2_head.run(["output"], {"input": inp})[0]
-                    for inp in batch_pooler_output
-                ]
-            )
-            output["ec2_window_predictions"] = ec2_predictions
-        if hasattr(self, "ec3_head"):
-            ec3_predictions = np.concatenate(
-                [
-                    self.ec3_head.run(["output"], {"input": inp})[0]
-                    for inp in batch_pooler_output
-                ]
-            )
-            output["ec3_window_predictions"] = ec3_predictions
-        if hasattr(self, "ec4_head"):
-            ec4_predictions = np.concatenate(
+        # EC sequence classification head predictions
+        output.update(self._run_ec_heads(batch_pooler_output))
+        # return output
+        return output
+
+    def _forward_windows(
+        self,
+        windows: List[str],
+        max_tokens: int = 16384,
+        batch_size: int = 32,
+    ) -> Tuple[Dict[str, np.array], Dict[str, List[np.array]]]:
+        # hidden states are only requested if residue heads are loaded
+        output_names = ["pooler_output"]
+        if len(self.residue_heads) > 0:
+            output_names.append("last_hidden_state")
+        buckets = []
+        bucket_pooler_output = []
+        bucket_residue_predictions = {k: [] for k in self.residue_heads}
+        for bucket, model_out in forward_bucketed_windows(
+            windows,
+            self.tokenizer,
+            self.model,
+            output_names,
+            residue_heads=self.residue_heads,
+            max_tokens=max_tokens,
+            max_bs=batch_size,
+            desc="Running ProteinEmbedder on window batches",
+        ):
+            buckets.append(bucket)
+            bucket_pooler_output.append(model_out["pooler_output"])
+            for head_name in self.residue_heads:
+                bucket_residue_predictions[head_name].append(
+                    model_out[head_name]
+                )
+        # restore window order
+        pooler_output = np.stack(
+            restore_bucket_order(buckets, bucket_pooler_output)
+        )
+        output = {"cls_window_embeddings": pooler_output}
+        output.update(
+            self._run_ec_heads(batchify(pooler_output, bs=batch_size))
+        )
+        residue_output = {
+            k: restore_bucket_order(buckets, v)
+            for k, v in bucket_residue_predictions.items()
+        }
+        return output, residue_output
+
+    def _run_ec_heads(
+        self, batch_pooler_output: List[np.array]
+    ) -> Dict[str, np.array]:
+        # ec1 head is always loaded, ec2-ec4 heads are optional
+        output = {}
+        for ec_level in ["ec1", "ec2", "ec3", "ec4"]:
+            if hasattr(self, f"{ec_level}_head") == False:
+                continue
+            head = getattr(self, f"{ec_level}_head")
+            output[f"{ec_level}_window_predictions"] = np.concatenate(
                 [
-                    self.ec4_head.run(["output"], {"input": inp})[0]
+                    head.run(["output"], {"input": inp})[0]
                     for inp in batch_pooler_output
                 ]
             )
-            output["ec4_window_predictions"] = ec4_predictions
-        # return output
         return output
 
     def postprocess(self, model_outputs: ModelOutput) -> PipelineOutput:
@@ -7,6 +7,7 @@ import xxhash
 from Bio import SeqIO
 from tqdm import tqdm
 
+from Ibis.Prodigal import load_orfs
 from Ibis.SecondaryMetabolismEmbedder.datastructs import (
     ClusterEmbeddingOutput,
     ClusterInput,
@@ -14,6 +15,11 @@ from Ibis.SecondaryMetabolismEmbedder.datastructs import (
 from Ibis.SecondaryMetabolismEmbedder.pipeline import (
     MetabolismEmbedderPipeline,
 )
+from Ibis.Utilities.genome_store import (
+    embeddings_created,
+    get_embedding_lookup,
+    write_embeddings,
+)
 
 ########################################################################
 # General functions
@@ -66,18 +72,15 @@ def run_on_files(
     for name in tqdm(
         filenames, leave=False, desc="Running MetabolismEmbedder"
     ):
-        export_fp = f"{output_dir}/{name}/bgc_embedding.pkl"
-        if os.path.exists(export_fp) == False:
-            dom_emb_fp = f"{output_dir}/{name}/domain_embedding.pkl"
+        if embeddings_created(output_dir, name, "bgc_embeddings") == False:
             # load domain embeddings
-            dom_emb_lookup = {}
-            for d in pickle.load(open(dom_emb_fp, "rb")):
-                dom_emb_lookup[d["domain_id"]] = d["embedding"]
+            dom_emb_lookup = get_embedding_lookup(
+                output_dir, name, "domain_embeddings", "domain_id"
+            )
             # load protein embeddings
-            prot_emb_fp = f"{output_dir}/{name}/protein_embedding.pkl"
-            prot_emb_lookup = {}
-            for p in pickle.load(open(prot_emb_fp, "rb")):
-                prot_emb_lookup[p["protein_id"]] = p["embedding"]
+            prot_emb_lookup = get_embedding_lookup(
+                output_dir, name, "protein_embeddings", "protein_id"
+            )
             # load domains
             dom_pred_fp = f"{output_dir}/{name}/domain_predictions.json"
             domain_lookup = {}
@@ -89,9 +92,8 @@ def run_on_files(
                     r["embedding"] = dom_emb_lookup.get(domain_id)
                     domain_lookup[protein_id].append(r)
             # load orf data
-            prodigal_fp = f"{output_dir}/{name}/prodigal.json"
             orf_lookup = {}
-            for o in json.load(open(prodigal_fp)):
+            for o in load_orfs(output_dir, name):
                 contig_id = o["contig_id"]
                 contig_start = o["contig_start"]
                 contig_stop = o["contig_stop"]
@@ -125,8 +127,13 @@ def run_on_files(
                 )
             # analysis
             out = [pipeline(c) for c in tqdm(cluster_inputs)]
-            with open(export_fp, "wb") as f:
-                pickle.dump(out, f)
+            write_embeddings(
+                output_dir,
+                name,
+                "bgc_embeddings",
+                out,
+                ["contig_id", "contig_start", "contig_stop"],
+            )
     del pipeline
     return True
 
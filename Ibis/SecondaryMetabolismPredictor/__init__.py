@@ -10,13 +10,16 @@ import xxhash
 from Bio import SeqIO
 from tqdm import tqdm
 
+from Ibis.Prodigal import load_orfs
 from Ibis.SecondaryMetabolismPredictor.datastructs import (
     ClusterOutput,
+    GenomeTensors,
     OrfInput,
 )
 from Ibis.SecondaryMetabolismPredictor.pipeline import (
     InternalMetabolismPredictorPipeline,
     MibigMetabolismPredictorPipeline,
+    batchify,
 )
 from Ibis.SecondaryMetabolismPredictor.postprocess import (
     add_orfs_to_bgcs,
@@ -24,8 +27,14 @@ from Ibis.SecondaryMetabolismPredictor.postprocess import (
     call_bgcs_by_proximity,
 )
 from Ibis.SecondaryMetabolismPredictor.preprocess import (
-    get_tensors_from_genome,
+    get_contig_tensors_from_genome,
+    get_genome_tensors,
+    get_tensors_from_bgcs,
+    get_tensors_from_contigs,
+    load_genome_tensors,
+    save_genome_tensors,
 )
+from Ibis.Utilities.genome_store import get_embedding_lookup
 
 ########################################################################
 # General functions
@@ -51,18 +60,20 @@ def run_on_orfs(
         orf_traceback[idx] = (
             f"{o['contig_id']}_{o['contig_start']}_{o['contig_stop']}"
         )
+    # orf graphs are shared by the internal and mibig windows
+    contig_to_tensors = get_contig_tensors_from_genome(orfs)
     # boundary predictions with secondary metabolism
-    orf_meta = {o["orf_id"]: o for o in orfs}
-    internal_annotated_orfs = internal_pipeline(orfs=orfs)
+    internal_annotated_orfs = internal_pipeline(
+        orfs=orfs, batched_data=get_tensors_from_contigs(contig_to_tensors)
+    )
     # call bgcs
     proximity_based_bgcs = call_bgcs_by_proximity(
         all_orfs=internal_annotated_orfs, min_threshold=min_threshold
     )
     # get batched data - each batch should correspond to called bgc
-    batched_data = []
-    for bgc in proximity_based_bgcs:
-        bgc = [orf_meta[o] for o in bgc]
-        batched_data.extend(get_tensors_from_genome(orfs=bgc, window_size=500))
+    batched_data = get_tensors_from_bgcs(
+        contig_to_tensors, proximity_based_bgcs, window_size=500
+    )
     # chemotype predictions
     if len(batched_data) > 0:
         mibig_annotated_orfs = mibig_pipeline(
@@ -99,15 +110,13 @@ def prepare_orfs_for_pipeline_from_single_file(
     os.makedirs(export_dir, exist_ok=True)
     export_fp = f"{export_dir}/input.pkl"
     if os.path.exists(export_fp) == False:
-        prodigal_fp = f"{output_dir}/{name}/prodigal.json"
-        embedding_fp = f"{output_dir}/{name}/protein_embedding.pkl"
         # create embedding lookup
-        embedding_lookup = {}
-        for protein in pickle.load(open(embedding_fp, "rb")):
-            embedding_lookup[protein["protein_id"]] = protein["embedding"]
+        embedding_lookup = get_embedding_lookup(
+            output_dir, name, "protein_embeddings", "protein_id"
+        )
         # create input data
         orfs = []
-        for orf in json.load(open(prodigal_fp)):
+        for orf in load_orfs(output_dir, name):
             protein_id = orf["protein_id"]
             if protein_id not in embedding_lookup:
                 continue
@@ -158,24 +167,63 @@ def parallel_prepare_orfs_for_pipeline_from_files(
     return True
 
 
+def load_prepared_genome_tensors(export_dir: str) -> GenomeTensors:
+    # orf graphs cached by the internal pass (built from input.pkl for
+    # genomes annotated before the cache existed)
+    tensors_fp = f"{export_dir}/genome_tensors.pt"
+    if os.path.exists(tensors_fp):
+        return load_genome_tensors(tensors_fp)
+    orfs = pickle.load(open(f"{export_dir}/input.pkl", "rb"))
+    return get_genome_tensors(orfs)
+
+
 def run_internal_metabolism_pipeline_on_files(
-    filenames: List[str], output_dir: str, orfs_prepared: bool, gpu_id: int = 0
+    filenames: List[str],
+    output_dir: str,
+    orfs_prepared: bool,
+    gpu_id: int = 0,
+    cpu_threads: Optional[int] = None,
+    genomes_per_batch: int = 8,
 ) -> bool:
     if orfs_prepared == False:
         raise ValueError("Orfs not prepared for cluster caller")
-    internal_pipeline = InternalMetabolismPredictorPipeline(gpu_id=gpu_id)
-    for name in tqdm(
-        filenames, leave=False, desc="Annotate orfs with internal metabolism"
-    ):
+    internal_pipeline = InternalMetabolismPredictorPipeline(
+        gpu_id=gpu_id, cpu_threads=cpu_threads
+    )
+    # genomes without internal annotations
+    names_to_run = []
+    for name in filenames:
         final_fp = f"{output_dir}/{name}/bgc_predictions.json"
-        if os.path.exists(final_fp):
+        export_fp = f"{output_dir}/{name}/bgc_predictions_tmp/internal_annotated_orfs.pkl"
+        if os.path.exists(final_fp) or os.path.exists(export_fp):
             continue
-        export_dir = f"{output_dir}/{name}/bgc_predictions_tmp"
-        export_fp = f"{export_dir}/internal_annotated_orfs.pkl"
-        if os.path.exists(export_fp) == False:
-            prepared_orfs_fp = f"{export_dir}/input.pkl"
-            orfs = pickle.load(open(prepared_orfs_fp, "rb"))
-            internal_annotated_orfs = internal_pipeline(orfs=orfs)
+        names_to_run.append(name)
+    # windows of several genomes share forward passes
+    for names in tqdm(
+        batchify(names_to_run, bs=genomes_per_batch),
+        leave=False,
+        desc="Annotate orfs with internal metabolism",
+    ):
+        genome_orfs = []
+        genome_batched_data = []
+        for name in names:
+            export_dir = f"{output_dir}/{name}/bgc_predictions_tmp"
+            orfs = pickle.load(open(f"{export_dir}/input.pkl", "rb"))
+            # orf graphs are cached for the mibig pass (embeddings are
+            # only read from input.pkl once)
+            genome_tensors = get_genome_tensors(orfs)
+            save_genome_tensors(
+                genome_tensors, f"{export_dir}/genome_tensors.pt"
+            )
+            genome_orfs.append(orfs)
+            genome_batched_data.append(
+                get_tensors_from_contigs(genome_tensors["contigs"])
+            )
+        genome_annotated_orfs = internal_pipeline.run(
+            genome_orfs, genome_batched_data=genome_batched_data
+        )
+        for name, internal_annotated_orfs in zip(names, genome_annotated_orfs):
+            export_fp = f"{output_dir}/{name}/bgc_predictions_tmp/internal_annotated_orfs.pkl"
             with open(export_fp, "wb") as f:
                 pickle.dump(internal_annotated_orfs, f)
     del internal_pipeline
@@ -234,42 +282,68 @@ def run_mibig_metabolism_pipeline_on_files(
     orfs_prepared: bool,
     proximity_based_bgcs_prepared: bool,
     gpu_id: int = 0,
+    cpu_threads: Optional[int] = None,
+    genomes_per_batch: int = 8,
 ) -> bool:
     if orfs_prepared == False:
         raise ValueError("Orfs not prepared for cluster caller")
     if proximity_based_bgcs_prepared == False:
         raise ValueError("Proximity based bgcs not prepared")
-    mibig_pipeline = MibigMetabolismPredictorPipeline(gpu_id=gpu_id)
-    for name in tqdm(
-        filenames, leave=False, desc="Annotate orfs with mibig metabolism"
-    ):
+    mibig_pipeline = MibigMetabolismPredictorPipeline(
+        gpu_id=gpu_id, cpu_threads=cpu_threads
+    )
+    # genomes without mibig annotations
+    names_to_run = []
+    for name in filenames:
         final_fp = f"{output_dir}/{name}/bgc_predictions.json"
-        if os.path.exists(final_fp):
+        export_fp = (
+            f"{output_dir}/{name}/bgc_predictions_tmp/mibig_annotated_orfs.pkl"
+        )
+        if os.path.exists(final_fp) or os.path.exists(export_fp):
             continue
-        export_dir = f"{output_dir}/{name}/bgc_predictions_tmp"
-        export_fp = f"{export_dir}/mibig_annotated_orfs.pkl"
-        if os.path.exists(export_fp) == False:
+        names_to_run.append(name)
+    # windows of several genomes share forward passes
+    for names in tqdm(
+        batchify(names_to_run, bs=genomes_per_batch),
+        leave=False,
+        desc="Annotate orfs with mibig metabolism",
+    ):
+        mibig_lookups = {}
+        genome_names = []
+        genome_orfs = []
+        genome_batched_data = []
+        for name in names:
+            export_dir = f"{output_dir}/{name}/bgc_predictions_tmp"
             proximity_based_bgcs = pickle.load(
                 open(f"{export_dir}/proximity_based_bgcs.pkl", "rb")
             )
-            orfs = pickle.load(open(f"{export_dir}/input.pkl", "rb"))
-            orf_meta = {o["orf_id"]: o for o in orfs}
-            batched_data = []
-            for bgc in proximity_based_bgcs:
-                bgc = [orf_meta[o] for o in bgc]
-                batched_data.extend(
-                    get_tensors_from_genome(orfs=bgc, window_size=500)
-                )
-            # chemotype predictions
+            # bgc windows are sliced from the cached orf graphs
+            genome_tensors = load_prepared_genome_tensors(export_dir)
+            batched_data = get_tensors_from_bgcs(
+                genome_tensors["contigs"],
+                proximity_based_bgcs,
+                window_size=500,
+            )
             if len(batched_data) > 0:
-                mibig_annotated_orfs = mibig_pipeline(
-                    orfs=orfs, batched_data=batched_data
-                )
-                mibig_lookup = {o["orf_id"]: o for o in mibig_annotated_orfs}
+                genome_names.append(name)
+                genome_orfs.append(genome_tensors["orfs"])
+                genome_batched_data.append(batched_data)
             else:
-                mibig_lookup = {}
+                mibig_lookups[name] = {}
+        # chemotype predictions
+        genome_annotated_orfs = mibig_pipeline.run(
+            genome_orfs, genome_batched_data=genome_batched_data
+        )
+        for name, mibig_annotated_orfs in zip(
+            genome_names, genome_annotated_orfs
+        ):
+            mibig_lookups[name] = {
+                o["orf_id"]: o for o in mibig_annotated_orfs
+            }
+        for name in names:
+            export_fp = f"{output_dir}/{name}/bgc_predictions_tmp/mibig_annotated_orfs.pkl"
             with open(export_fp, "wb") as f:
-                pickle.dump(mibig_lookup, f)
+                pickle.dump(mibig_lookups[name], f)
     del mibig_pipeline
     return True
 
@@ -287,7 +361,7 @@ def call_bgcs_by_chemotype_from_single_file(
         mibig_lookup = pickle.load(
             open(f"{export_dir}/mibig_annotated_orfs.pkl", "rb")
         )
-        orfs = pickle.load(open(f"{export_dir}/input.pkl", "rb"))
+        orfs = load_prepared_genome_tensors(export_dir)["orfs"]
         orf_traceback = {}
         for o in orfs:
             orf_id = o["orf_id"]
@@ -0,0 +1,145 @@
+import time
+from typing import Dict, List, Set
+
+import networkx as nx
+import numpy as np
+
+from Ibis.SecondaryMetabolismPredictor.datastructs import (
+    InternalAnnotatedOrfDictWithMeta,
+)
+from Ibis.SecondaryMetabolismPredictor.postprocess import (
+    call_bgcs_by_proximity,
+)
+
+# regression benchmark of call_bgcs_by_proximity against the pairwise scan
+# it replaced (bgcs must be identical)
+# usage: python -m Ibis.SecondaryMetabolismPredictor.benchmark
+
+
+def sample_annotated_orfs(
+    num_orfs: int = 10000,
+    num_contigs: int = 10,
+    core_fraction: float = 0.1,
+    seed: int = 0,
+) -> List[InternalAnnotatedOrfDictWithMeta]:
+    # orfs of ~1kb with short gaps, core orfs are clustered in bgc like runs
+    rng = np.random.default_rng(seed)
+    contig_ids = np.sort(rng.integers(0, num_contigs, size=num_orfs))
+    lengths = rng.integers(100, 3000, size=num_orfs)
+    gaps = rng.integers(-50, 2000, size=num_orfs)
+    seeds = rng.random(num_orfs) < core_fraction / 5
+    is_core = np.convolve(seeds, np.ones(5), mode="same") > 0
+    orfs = []
+    contig_start = 0
+    for orf_id in range(num_orfs):
+        if orf_id > 0 and contig_ids[orf_id] != contig_ids[orf_id - 1]:
+            contig_start = 0
+        contig_start = max(0, contig_start + int(gaps[orf_id]))
+        contig_stop = contig_start + int(lengths[orf_id])
+        orfs.append(
+            {
+                "orf_id": orf_id,
+                "contig_id": int(contig_ids[orf_id]),
+                "contig_start": contig_start,
+                "contig_stop": contig_stop,
+                "secondary": {
+                    "label": "core" if is_core[orf_id] else "peripheral",
+                    "score": 0.9,
+                },
+            }
+        )
+        contig_start = contig_stop
+    # pipeline outputs are not sorted
+    return [orfs[idx] for idx in rng.permutation(num_orfs)]
+
+
+def call_bgcs_by_proximity_scan(
+    all_orfs: List[InternalAnnotatedOrfDictWithMeta],
+    min_threshold: int = 10000,
+) -> List[Set[int]]:
+    # previous implementation (orf membership compared by orf id)
+    all_orfs = sorted(
+        all_orfs, key=lambda x: (x["contig_id"], x["contig_start"])
+    )
+    secondary_metabolism_orfs = []
+    secondary_metabolism_orf_ids = []
+    unknown_metabolism_orf_ids = []
+    for o in all_orfs:
+        if o["secondary"]["label"] == "core":
+            secondary_metabolism_orfs.append(o)
+            secondary_metabolism_orf_ids.append(o["orf_id"])
+        else:
+            unknown_metabolism_orf_ids.append(o["orf_id"])
+    G = nx.Graph()
+    for idx, o1 in enumerate(secondary_metabolism_orfs):
+        G.add_node(o1["orf_id"])
+        for o2 in secondary_metabolism_orfs[idx + 1 :]:
+            if o2["contig_id"] != o1["contig_id"]:
+                break
+            if o2["contig_start"] - o1["contig_stop"] > min_threshold:
+                break
+            G.add_edge(o1["orf_id"], o2["orf_id"])
+    for idx, o1 in enumerate(all_orfs):
+        if o1["orf_id"] not in unknown_metabolism_orf_ids:
+            continue
+        closest = {}
+        left_slice = all_orfs[:idx]
+        left_slice.reverse()
+        for side, orf_slice in [
+            ("right", all_orfs[idx + 1 :]),
+            ("left", left_slice),
+        ]:
+            for o2 in orf_slice:
+                if o2["orf_id"] not in secondary_metabolism_orf_ids:
+                    continue
+                if o2["contig_id"] != o1["contig_id"]:
+                    break
+                if side == "right":
+                    distance = o2["contig_start"] - o1["contig_stop"]
+                else:
+                    distance = o1["contig_start"] - o2["contig_stop"]
+                if distance <= min_threshold:
+                    closest[side] = (distance, o2["orf_id"])
+                break
+        if len(closest) == 0:
+            continue
+        elif "right" not in closest or (
+            "left" in closest and closest["left"][0] < closest["right"][0]
+        ):
+            G.add_edge(o1["orf_id"], closest["left"][1])
+        else:
+            G.add_edge(o1["orf_id"], closest["right"][1])
+    return list(nx.connected_components(G))
+
+
+def benchmark_proximity(
+    orf_counts: List[int] = [1000, 5000, 10000],
+) -> Dict[int, Dict[str, float]]:
+    # seconds per genome for both implementations
+    report = {}
+    for num_orfs in orf_counts:
+        orfs = sample_annotated_orfs(num_orfs=num_orfs)
+        report[num_orfs] = {}
+        outputs = {}
+        for name, funct in [
+            ("scan", call_bgcs_by_proximity_scan),
+            ("bisect", call_bgcs_by_proximity),
+        ]:
+            start = time.time()
+            outputs[name] = funct(orfs)
+            report[num_orfs][name] = round(time.time() - start, 4)
+        if outputs["scan"] != outputs["bisect"]:
+            raise AssertionError(
+                f"bgcs of the two implementations differ ({num_orfs} orfs)"
+            )
+    return report
+
+
+if __name__ == "__main__":
+    report = benchmark_proximity()
+    for num_orfs, results in report.items():
+        speedup = round(results["scan"] / results["bisect"], 1)
+        print(
+            f"{num_orfs} orfs: scan {results['scan']} s, "
+            f"bisect {results['bisect']} s ({speedup}x)"
+        )
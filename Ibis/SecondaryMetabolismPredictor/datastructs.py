@@ -1,6 +1,7 @@
-from typing import List, Literal, Optional, TypedDict
+from typing import Dict, List, Literal, Optional, TypedDict
 
 import numpy as np
+import torch
 
 
 class DomainInput(TypedDict):
@@ -17,6 +18,23 @@ class OrfInput(TypedDict):
     embedding: np.array
 
 
+class ContigTensors(TypedDict):
+    # orfs of one contig sorted by contig_start (aligned rows)
+    ids: torch.Tensor
+    x: torch.Tensor
+    # edges (n1 < n2) sorted by (n1, n2)
+    # edges of node n1 are edge_ptr[n1]:edge_ptr[n1 + 1]
+    edge_index: torch.Tensor
+    edge_attr: torch.Tensor
+    edge_ptr: np.array
+
+
+class GenomeTensors(TypedDict):
+    # orfs (without embeddings) and the orf graph of every contig
+    orfs: List[OrfInput]
+    contigs: Dict[int, ContigTensors]
+
+
 class SecondaryPredictionDict(TypedDict):
     label: Literal["core", "peripheral"]
     score: float
@@ -1,6 +1,7 @@
 from glob import glob
-from typing import List, Optional, Union
+from typing import Callable, Dict, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
 from torch_geometric.data import Batch, Data
 from tqdm import tqdm
@@ -17,6 +18,7 @@ from Ibis.SecondaryMetabolismPredictor.preprocess import (
     get_tensors_from_genome,
 )
 from Ibis.Utilities.class_dicts import get_class_dict
+from Ibis.Utilities.rounding import round_values
 
 
 def batchify(l, bs=10):
@@ -41,13 +43,123 @@ def add_meta_data_to_output(
     return out
 
 
+def batchify_by_size(
+    data_list: List[Data], max_nodes: int = 2000, max_edges: int = 20000
+) -> List[List[int]]:
+    # consecutive windows packed up to a node and edge budget
+    # (a window over budget forms its own batch)
+    batches = []
+    num_nodes = 0
+    num_edges = 0
+    for idx, data in enumerate(data_list):
+        if (
+            len(batches) == 0
+            or num_nodes + data.num_nodes > max_nodes
+            or num_edges + data.num_edges > max_edges
+        ):
+            batches.append([])
+            num_nodes = 0
+            num_edges = 0
+        batches[-1].append(idx)
+        num_nodes += data.num_nodes
+        num_edges += data.num_edges
+    return batches
+
+
+def concat_node_outputs(
+    chunks: List[Dict[str, torch.Tensor]],
+) -> Dict[str, torch.Tensor]:
+    if len(chunks) == 0:
+        return {"ids": torch.zeros((0, 1), dtype=torch.long)}
+    return {k: torch.cat([c[k] for c in chunks]) for k in chunks[0]}
+
+
+def forward_genomes(
+    genome_data: List[List[Data]],
+    forward_batch: Callable[[Batch], Dict[str, torch.Tensor]],
+    gpu_id: Optional[int] = None,
+    max_nodes: int = 2000,
+    max_edges: int = 20000,
+) -> List[Dict[str, torch.Tensor]]:
+    # windows of all genomes are packed together and node outputs
+    # (ids and heads) are routed back to their genome
+    data_list = [d for data in genome_data for d in data]
+    window_genomes = [g for g, data in enumerate(genome_data) for _ in data]
+    genome_chunks = [[] for _ in genome_data]
+    batches = batchify_by_size(
+        data_list, max_nodes=max_nodes, max_edges=max_edges
+    )
+    with torch.inference_mode():
+        for batch in tqdm(
+            batches, desc="Running model on data batches", leave=False
+        ):
+            data = Batch.from_data_list([data_list[idx] for idx in batch])
+            if isinstance(gpu_id, int):
+                data = data.to(f"cuda:{gpu_id}")
+            outputs = {k: v.cpu() for k, v in forward_batch(data).items()}
+            # windows of a genome are consecutive within the batch
+            genome_sizes = []
+            for idx, num_nodes in zip(batch, data.ptr.diff().tolist()):
+                genome_id = window_genomes[idx]
+                if len(genome_sizes) > 0 and genome_sizes[-1][0] == genome_id:
+                    genome_sizes[-1][1] += num_nodes
+                else:
+                    genome_sizes.append([genome_id, num_nodes])
+            sizes = [size for _, size in genome_sizes]
+            splits = {k: v.split(sizes) for k, v in outputs.items()}
+            for chunk_idx, (genome_id, _) in enumerate(genome_sizes):
+                genome_chunks[genome_id].append(
+                    {k: v[chunk_idx] for k, v in splits.items()}
+                )
+    return [concat_node_outputs(chunks) for chunks in genome_chunks]
+
+
+def get_orf_groups(ids: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    # orf ids (in order of first occurrence) and the group of every row
+    # rows of padding nodes (orf id -1) are removed
+    ids = ids[:, 0]
+    ids = ids[ids != -1]
+    orf_ids, inverse = torch.unique(ids, return_inverse=True)
+    rows = torch.arange(len(ids))
+    first_rows = torch.full((len(orf_ids),), len(ids), dtype=torch.long)
+    first_rows = first_rows.scatter_reduce(0, inverse, rows, reduce="amin")
+    order = torch.argsort(first_rows)
+    rank = torch.empty_like(order)
+    rank[order] = torch.arange(len(order))
+    return orf_ids[order], rank[inverse]
+
+
+def get_first_max_rows(
+    values: torch.Tensor, inverse: torch.Tensor, num_groups: int
+) -> torch.Tensor:
+    # row of the first maximum of every group
+    max_values = values.new_zeros(num_groups).scatter_reduce(
+        0, inverse, values, reduce="amax", include_self=False
+    )
+    is_max = values == max_values[inverse]
+    rows = torch.arange(len(values))
+    first_rows = torch.full((num_groups,), len(values), dtype=torch.long)
+    return first_rows.scatter_reduce(
+        0, inverse[is_max], rows[is_max], reduce="amin"
+    )
+
+
 class MibigMetabolismPredictorPipeline:
 
     def __init__(
         self,
         model_dir: str = f"{curdir}/Models/mibig_metabolism_predictor",
         gpu_id: Optional[int] = None,
+        cpu_threads: Optional[int] = None,
+        max_nodes: int = 5000,
+        max_edges: int = 50000,
     ):
+        # windows are packed into batches up to a node and edge budget
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        # torch threads on cpu (process wide setting)
+        if cpu_threads != None:
+            torch.set_num_threads(cpu_threads)
         # load models (torchscript format)
         self.node_encoder = torch.jit.load(f"{model_dir}/node_encoder.pt")
         self.gnn = torch.jit.load(f"{model_dir}/gnn.pt")
@@ -72,70 +184,86 @@ class MibigMetabolismPredictorPipeline:
         batched_data: Optional[List[Data]] = None,
     ) -> List[MibigAnnotatedOrfDictWithMeta]:
         if batched_data == None:
-            batched_data = self.preprocess(orfs)
-        preds = self._forward(batched_data)
-        out = self.postprocess(preds)
-        out = add_meta_data_to_output(out, orfs)
+            return self.run([orfs])[0]
+        return self.run([orfs], genome_batched_data=[batched_data])[0]
+
+    def run(
+        self,
+        genome_orfs: List[List[OrfInput]],
+        genome_batched_data: Optional[List[List[Data]]] = None,
+    ) -> List[List[MibigAnnotatedOrfDictWithMeta]]:
+        # windows of several genomes share forward passes
+        if genome_batched_data == None:
+            genome_batched_data = [
+                self.preprocess(orfs) for orfs in genome_orfs
+            ]
+        genome_preds = self._forward(genome_batched_data)
+        out = []
+        for orfs, preds in zip(genome_orfs, genome_preds):
+            out.append(add_meta_data_to_output(self.postprocess(preds), orfs))
         return out
 
     def preprocess(self, orfs: List[OrfInput]) -> List[Data]:
         return get_tensors_from_genome(orfs)
 
-    def _forward(self, data_list: List[Data]) -> Batch:
-        out = []
-        batches = batchify(data_list)
-        for data in tqdm(
-            batches, desc="Running model on data batches", leave=False
-        ):
-            data = Batch.from_data_list(data)
-            if isinstance(self.gpu_id, int):
-                data = data.to(f"cuda:{self.gpu_id}")
-            # preprocess node and edge encoding
-            data.x = self.node_encoder(data.x)
-            # message passing
-            data.x = self.gnn(data.x, data.edge_index, data.edge_attr)
-            # transformer (global attention accross nodes)
-            data.x = self.transformer(data.x, data.batch)
-            # heads (single label node classification)
-            for head_name, head in self.heads.items():
-                setattr(data, head_name, torch.softmax(head(data.x), dim=1))
-            # detach from gpu memory
-            if isinstance(self.gpu_id, int):
-                data = data.detach()
-            out.append(data)
-        # batch output data object
-        return Batch.from_data_list(out)
-
-    def postprocess(self, data: Batch) -> List[MibigAnnotatedOrfDict]:
-        orf_to_preds = {}
-        length = data.x.shape[0]
-        # parse through all the predictions
-        for idx in tqdm(
-            range(length),
-            total=length,
-            desc="Reorganizing Predictions",
-            leave=False,
-        ):
-            orf_id = int(data.ids[idx][0])
-            if orf_id == -1:
-                continue
-            if orf_id not in orf_to_preds:
-                orf_to_preds[orf_id] = {"orf_id": orf_id}
-                for c in self.all_chemotypes:
-                    orf_to_preds[orf_id][c] = []
-            # add chemotype predictions
-            for c in self.all_chemotypes:
-                score = round(float(getattr(data, c)[idx][1]), 2)
-                if score >= 0.5:
-                    orf_to_preds[orf_id][c].append(score)
+    def _forward(
+        self, genome_data: List[List[Data]]
+    ) -> List[Dict[str, torch.Tensor]]:
+        return forward_genomes(
+            genome_data,
+            self._forward_batch,
+            gpu_id=self.gpu_id,
+            max_nodes=self.max_nodes,
+            max_edges=self.max_edges,
+        )
+
+    def _forward_batch(self, data: Batch) -> Dict[str, torch.Tensor]:
+        # preprocess node and edge encoding
+        x = self.node_encoder(data.x)
+        # message passing
+        x = self.gnn(x, data.edge_index, data.edge_attr)
+        # transformer (global attention accross nodes)
+        x = self.transformer(x, data.batch)
+        # heads (single label node classification)
+        out = {"ids": data.ids}
+        for head_name, head in self.heads.items():
+            out[head_name] = torch.softmax(head(x), dim=1)
+        return out
+
+    def postprocess(
+        self, preds: Dict[str, torch.Tensor]
+    ) -> List[MibigAnnotatedOrfDict]:
+        orf_ids, inverse = get_orf_groups(preds["ids"])
+        if len(orf_ids) == 0:
+            return []
+        keep = preds["ids"][:, 0] != -1
+        # positive class probability of every chemotype head
+        scores = torch.stack(
+            [preds[c][keep, 1] for c in self.all_chemotypes], dim=1
+        )
         # collapse predictions (by maximum)
+        max_scores = scores.new_zeros((len(orf_ids), scores.shape[1]))
+        max_scores = max_scores.scatter_reduce(
+            0,
+            inverse[:, None].expand(-1, scores.shape[1]),
+            scores,
+            reduce="amax",
+            include_self=False,
+        )
+        max_scores = round_values(max_scores.numpy().ravel(), 2).reshape(
+            max_scores.shape
+        )
+        passed = max_scores >= 0.5
         output = []
-        for orf_id, pred in orf_to_preds.items():
+        for orf_id, orf_scores, orf_passed in zip(
+            orf_ids.tolist(), max_scores.tolist(), passed.tolist()
+        ):
             row = {"orf_id": orf_id, "chemotypes": []}
-            for c in self.all_chemotypes:
-                if len(pred[c]) == 0:
-                    continue
-                row["chemotypes"].append({"label": c, "score": max(pred[c])})
+            for c, score, p in zip(
+                self.all_chemotypes, orf_scores, orf_passed
+            ):
+                if p:
+                    row["chemotypes"].append({"label": c, "score": score})
             output.append(row)
         return output
 
@@ -147,7 +275,16 @@ class InternalMetabolismPredictorPipeline:
         model_dir: str = f"{curdir}/Models/internal_metabolism_predictor",
         class_dict_fp: str = f"{curdir}/SecondaryMetabolismPredictor/tables/chemotypes.csv",
         gpu_id: Optional[int] = None,
+        cpu_threads: Optional[int] = None,
+        max_nodes: int = 2000,
+        max_edges: int = 20000,
     ):
+        # windows are packed into batches up to a node and edge budget
+        self.max_nodes = max_nodes
+        self.max_edges = max_edges
+        # torch threads on cpu (process wide setting)
+        if cpu_threads != None:
+            torch.set_num_threads(cpu_threads)
         # class dicts
         self.chemotype_class_dict = get_class_dict(class_dict_fp)
         # load models (torchscript format)
@@ -171,87 +308,102 @@ class InternalMetabolismPredictorPipeline:
         batched_data: Optional[List[Data]] = None,
     ) -> List[InternalAnnotatedOrfDictWithMeta]:
         if batched_data == None:
-            batched_data = self.preprocess(orfs)
-        preds = self._forward(batched_data)
-        out = self.postprocess(preds)
-        out = add_meta_data_to_output(out, orfs)
+            return self.run([orfs])[0]
+        return self.run([orfs], genome_batched_data=[batched_data])[0]
+
+    def run(
+        self,
+        genome_orfs: List[List[OrfInput]],
+        genome_batched_data: Optional[List[List[Data]]] = None,
+    ) -> List[List[InternalAnnotatedOrfDictWithMeta]]:
+        # windows of several genomes share forward passes
+        if genome_batched_data == None:
+            genome_batched_data = [
+                self.preprocess(orfs) for orfs in genome_orfs
+            ]
+        genome_preds = self._forward(genome_batched_data)
+        out = []
+        for orfs, preds in zip(genome_orfs, genome_preds):
+            out.append(add_meta_data_to_output(self.postprocess(preds), orfs))
         return out
 
     def preprocess(self, orfs: List[OrfInput]) -> List[Data]:
         return get_tensors_from_genome(orfs)
 
-    def _forward(self, data_list: List[Data]) -> Batch:
-        out = []
-        batches = batchify(data_list)
-        for data in tqdm(
-            batches, desc="Running model on data batches", leave=False
-        ):
-            data = Batch.from_data_list(data)
-            if isinstance(self.gpu_id, int):
-                data = data.to(f"cuda:{self.gpu_id}")
-            # preprocess node and edge encoding
-            data.x = self.node_encoder(data.x)
-            # message passing
-            data.x = self.gnn(data.x, data.edge_index, data.edge_attr)
-            # transformer (global attention accross nodes)
-            data.x = self.transformer(data.x, data.batch)
-            # heads
+    def _forward(
+        self, genome_data: List[List[Data]]
+    ) -> List[Dict[str, torch.Tensor]]:
+        return forward_genomes(
+            genome_data,
+            self._forward_batch,
+            gpu_id=self.gpu_id,
+            max_nodes=self.max_nodes,
+            max_edges=self.max_edges,
+        )
+
+    def _forward_batch(self, data: Batch) -> Dict[str, torch.Tensor]:
+        # preprocess node and edge encoding
+        x = self.node_encoder(data.x)
+        # message passing
+        x = self.gnn(x, data.edge_index, data.edge_attr)
+        # transformer (global attention accross nodes)
+        x = self.transformer(x, data.batch)
+        # heads
+        return {
+            "ids": data.ids,
             # secondary - multi label node classification
-            data.secondary = torch.sigmoid(self.secondary_head(data.x))
+            "secondary": torch.sigmoid(self.secondary_head(x)),
             # chemotype - single label node classification
-            data.chemotype = torch.softmax(self.chemotype_head(data.x), dim=1)
-            # detach from gpu memory
-            if isinstance(self.gpu_id, int):
-                data = data.detach()
-            out.append(data)
-        # batch output data object
-        return Batch.from_data_list(out)
-
-    def postprocess(self, data: Batch) -> List[InternalAnnotatedOrfDict]:
-        orf_to_preds = {}
-        length = data.x.shape[0]
-        # parse through all the predictions
-        for idx in tqdm(
-            range(length),
-            total=length,
-            desc="Reorganizing Predictions",
-            leave=False,
+            "chemotype": torch.softmax(self.chemotype_head(x), dim=1),
+        }
+
+    def postprocess(
+        self, preds: Dict[str, torch.Tensor]
+    ) -> List[InternalAnnotatedOrfDict]:
+        orf_ids, inverse = get_orf_groups(preds["ids"])
+        if len(orf_ids) == 0:
+            return []
+        num_orfs = len(orf_ids)
+        keep = preds["ids"][:, 0] != -1
+        # add secondary label (note this training task was setup as binary classification)
+        scores = round_values(preds["secondary"][keep, 0].numpy(), 2)
+        is_core = scores >= 0.5
+        # score needs to be adjusted to reflect probability for predicted label
+        scores = np.where(is_core, scores, round_values(1 - scores, 2))
+        # add chemotype label
+        chemotype = preds["chemotype"][keep]
+        top_scores, top_idx = chemotype.max(dim=1)
+        top_scores = round_values(top_scores.numpy(), 2)
+        # collapse predictions (by maximum, first occurrence on ties)
+        secondary_rows = get_first_max_rows(
+            torch.from_numpy(scores), inverse, num_orfs
+        ).tolist()
+        chemotype_rows = get_first_max_rows(
+            torch.from_numpy(top_scores), inverse, num_orfs
+        ).tolist()
+        scores = scores.tolist()
+        is_core = is_core.tolist()
+        top_scores = top_scores.tolist()
+        top_idx = top_idx.tolist()
+        # if predicted as peripheral, ignore chemotype prediction
+        out = []
+        for orf_id, sec_row, chem_row in zip(
+            orf_ids.tolist(), secondary_rows, chemotype_rows
         ):
-            orf_id = int(data.ids[idx][0])
-            if orf_id == -1:
-                continue
-            if orf_id not in orf_to_preds:
-                orf_to_preds[orf_id] = {
-                    "orf_id": orf_id,
-                    "secondary": [],
-                    "chemotype": [],
+            if is_core[sec_row]:
+                secondary = {"label": "core", "score": scores[sec_row]}
+                chemotype = {
+                    "label": self.chemotype_class_dict[top_idx[chem_row]],
+                    "score": top_scores[chem_row],
                 }
-            # add secondary label (note this training task was setup as binary classification)
-            score = round(float(data.secondary[idx][0]), 2)
-            label = "core" if score >= 0.5 else "peripheral"
-            # score needs to be adjusted to reflect probability for predicted label
-            score = 1 - score if label == "peripheral" else score
-            orf_to_preds[orf_id]["secondary"].append(
-                {"label": label, "score": round(score, 2)}
-            )
-            # add chemotype label
-            top_idx = int(torch.argmax(data.chemotype[idx]))
-            orf_to_preds[orf_id]["chemotype"].append(
+            else:
+                secondary = {"label": "peripheral", "score": scores[sec_row]}
+                chemotype = None
+            out.append(
                 {
-                    "label": self.chemotype_class_dict[top_idx],
-                    "score": round(float(data.chemotype[idx][top_idx]), 2),
+                    "orf_id": orf_id,
+                    "secondary": secondary,
+                    "chemotype": chemotype,
                 }
             )
-        # collapse predictions (by maximum)
-        # if predicted as peripheral, ignore chemotype prediction
-        for orf_id, pred in orf_to_preds.items():
-            orf_to_preds[orf_id]["secondary"] = max(
-                orf_to_preds[orf_id]["secondary"], key=lambda x: x["score"]
-            )
-            if orf_to_preds[orf_id]["secondary"]["label"] == "peripheral":
-                orf_to_preds[orf_id]["chemotype"] = None
-            else:
-                orf_to_preds[orf_id]["chemotype"] = max(
-                    orf_to_preds[orf_id]["chemotype"], key=lambda x: x["score"]
-                )
-        return list(orf_to_preds.values())
+        return out
@@ -1,5 +1,6 @@
+import bisect
 from collections import Counter
-from typing import Dict, List
+from typing import Dict, List, Set
 
 import networkx as nx
 from tqdm import tqdm
@@ -23,98 +24,76 @@ mibig_chemotype_standardization = get_mibig_chemotype_standardization()
 def call_bgcs_by_proximity(
     all_orfs: List[InternalAnnotatedOrfDictWithMeta],
     min_threshold: int = 10000,
-) -> List[List[int]]:
+) -> List[Set[int]]:
     # sort orfs
     all_orfs = sorted(
         all_orfs, key=lambda x: (x["contig_id"], x["contig_start"])
     )
-    # filter orfs annotated with secondary metabolism
-    secondary_metabolism_orfs = []
-    secondary_metabolism_orf_ids = []
-    unknown_metabolism_orf_ids = []
+    contig_to_orfs = {}
     for o in all_orfs:
-        if o["secondary"]["label"] == "core":
-            secondary_metabolism_orfs.append(o)
-            secondary_metabolism_orf_ids.append(o["orf_id"])
-        else:
-            unknown_metabolism_orf_ids.append(o["orf_id"])
-    # orf graph - add edges between adjacent orfs based on predicted metabolism
-    G = nx.Graph()
-    for idx, o1 in enumerate(secondary_metabolism_orfs):
-        o1_id = o1["orf_id"]
-        G.add_node(o1_id)
-        for o2 in secondary_metabolism_orfs[idx + 1 :]:
-            o2_id = o2["orf_id"]
-            if o2["contig_id"] != o1["contig_id"]:
-                break
-            distance = o2["contig_start"] - o1["contig_stop"]
-            if distance > min_threshold:
-                break
-            G.add_edge(o1_id, o2_id)
-    # add unassigned orfs to the closest metabolism orf (if within threshold)
-    for idx, o1 in tqdm(
-        enumerate(all_orfs),
-        total=len(all_orfs),
-        desc="Assign unannotated orfs to closest metabolism",
+        contig_to_orfs.setdefault(o["contig_id"], []).append(o)
+    bgcs = []
+    for contig_id, contig_orfs in tqdm(
+        contig_to_orfs.items(),
+        desc="Calling bgcs by proximity",
         leave=False,
     ):
-        o1_id = o1["orf_id"]
-        if o1_id not in unknown_metabolism_orf_ids:
+        # positions of orfs annotated with secondary metabolism
+        core_positions = [
+            idx
+            for idx, o in enumerate(contig_orfs)
+            if o["secondary"]["label"] == "core"
+        ]
+        if len(core_positions) == 0:
             continue
-        # profile slices
-        right_closest = {"orf_id": None, "distance": None}
-        left_closest = {"orf_id": None, "distance": None}
-        # create slices
-        right_slice = all_orfs[idx + 1 :]
-        left_slice = all_orfs[:idx]
-        left_slice.reverse()
-        # find closest metabolism match (right slice)
-        for o2 in right_slice:
-            o2_id = o2["orf_id"]
-            if o2_id not in secondary_metabolism_orfs:
+        # core orfs within threshold of a previous core orf are connected,
+        # so bgcs are runs of core orfs (a new run starts when the gap to
+        # the furthest reaching previous core orf exceeds the threshold)
+        core_bgcs = []
+        max_stop = None
+        for idx in core_positions:
+            o = contig_orfs[idx]
+            if (
+                max_stop == None
+                or o["contig_start"] - max_stop > min_threshold
+            ):
+                bgcs.append(set())
+                max_stop = o["contig_stop"]
+            max_stop = max(max_stop, o["contig_stop"])
+            bgcs[-1].add(o["orf_id"])
+            core_bgcs.append(bgcs[-1])
+        # add unassigned orfs to the closest metabolism orf (if within threshold)
+        for idx, o in enumerate(contig_orfs):
+            if o["secondary"]["label"] == "core":
                 continue
-            if o2["contig_id"] != o1["contig_id"]:
-                break
-            distance = o2["contig_start"] - o1["contig_stop"]
-            if distance > min_threshold:
-                break
-            right_closest["orf_id"] = o2_id
-            right_closest["distance"] = distance
-            break
-        # find closest metabolism match (left slice)
-        for o2 in left_slice:
-            o2_id = o2["orf_id"]
-            if o2_id not in secondary_metabolism_orfs:
+            # neighbouring core orfs on each side
+            right = bisect.bisect_left(core_positions, idx)
+            left = right - 1
+            left_distance = None
+            right_distance = None
+            if left >= 0:
+                o2 = contig_orfs[core_positions[left]]
+                distance = o["contig_start"] - o2["contig_stop"]
+                if distance <= min_threshold:
+                    left_distance = distance
+            if right < len(core_positions):
+                o2 = contig_orfs[core_positions[right]]
+                distance = o2["contig_start"] - o["contig_stop"]
+                if distance <= min_threshold:
+                    right_distance = distance
+            # ties go to the right neighbour
+            if left_distance == None and right_distance == None:
                 continue
-            if o2["contig_id"] != o1["contig_id"]:
-                break
-            distance = o1["contig_start"] - o2["contig_stop"]
-            if distance > min_threshold:
-                break
-            left_closest["orf_id"] = o2_id
-            left_closest["distance"] = distance
-            break
-        # create edge
-        if (
-            right_closest["distance"] == None
-            and left_closest["distance"] == None
-        ):
-            continue
-        elif (
-            right_closest["distance"] == None
-            and left_closest["distance"] != None
-        ):
-            G.add_edge(o1_id, left_closest["orf_id"])
-        elif (
-            left_closest["distance"] == None
-            and right_closest["distance"] != None
-        ):
-            G.add_edge(o1_id, right_closest["orf_id"])
-        elif left_closest["distance"] < right_closest["distance"]:
-            G.add_edge(o1_id, left_closest["orf_id"])
-        elif right_closest["distance"] <= left_closest["distance"]:
-            G.add_edge(o1_id, right_closest["orf_id"])
-    return list(nx.connected_components(G))
+            elif right_distance == None:
+                closest = left
+            elif left_distance == None:
+                closest = right
+            elif left_distance < right_distance:
+                closest = left
+            else:
+                closest = right
+            core_bgcs[closest].add(o["orf_id"])
+    return bgcs
 
 
 def call_bgcs_by_chemotype(
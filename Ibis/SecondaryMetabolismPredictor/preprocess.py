@@ -1,13 +1,17 @@
-from typing import Dict, List
+import os
+from typing import Dict, List, Set, Tuple
 
 import more_itertools as mit
-import networkx as nx
 import numpy as np
 import torch
 from torch_geometric.data import Data
 from tqdm import tqdm
 
-from Ibis.SecondaryMetabolismPredictor.datastructs import OrfInput
+from Ibis.SecondaryMetabolismPredictor.datastructs import (
+    ContigTensors,
+    GenomeTensors,
+    OrfInput,
+)
 
 
 def sort_orfs_by_contigs(orfs: List[OrfInput]) -> Dict[int, List[OrfInput]]:
@@ -22,70 +26,86 @@ def sort_orfs_by_contigs(orfs: List[OrfInput]) -> Dict[int, List[OrfInput]]:
     return contigs_to_orfs
 
 
-def get_orf_graphs_from_genome(
-    orfs: List[OrfInput], tolerance: int = 10000
-) -> Dict[int, nx.Graph]:
-    contig_to_G = {}
-    contig_to_orfs = sort_orfs_by_contigs(orfs)
+def get_contig_tensors(
+    contig_orfs: List[OrfInput], tolerance: int = 10000
+) -> ContigTensors:
+    # contig_orfs are sorted by contig_start (see sort_orfs_by_contigs)
+    num_orfs = len(contig_orfs)
+    nodes = np.arange(num_orfs)
+    starts = np.array([o["contig_start"] for o in contig_orfs], dtype=np.int64)
+    stops = np.array([o["contig_stop"] for o in contig_orfs], dtype=np.int64)
     # draw edges between orfs that meet distance threshold
-    for contig_id, contig_orfs in tqdm(
-        contig_to_orfs.items(), leave=False, desc="Preparing Orf Graphs"
-    ):
-        # build graph per graph
-        G = nx.Graph()
-        contig_to_G[contig_id] = G
-        for o in contig_orfs:
-            G.add_node(
-                o["orf_id"],
-                contig_start=o["contig_start"],
-                embedding=o["embedding"],
-            )
-        # add edges to capture spatial orientation
-        for idx, o1 in enumerate(contig_orfs):
-            for o2 in contig_orfs[idx + 1 :]:
-                dist = o2["contig_start"] - o1["contig_stop"]
-                if dist > tolerance:
-                    break
-                weight = round((tolerance - dist) / tolerance, 2)
-                contig_to_G[contig_id].add_edge(
-                    o1["orf_id"], o2["orf_id"], weight=weight
-                )
-    return contig_to_G
-
-
-def get_tensor_from_graph(G: nx.Graph):
-    num_nodes = len(G.nodes)
-    num_edges = len(G.edges)
-    # lookup dictionaries to form matrixes
-    orf_id_to_node_idx = {}
-    node_idx_to_orf_id = {}
-    # note that the first node corresponds to class token
-    for node_idx, orf_id in enumerate(G.nodes):
-        orf_id_to_node_idx[orf_id] = node_idx
-        node_idx_to_orf_id[node_idx] = orf_id
-    # create empty numpy matrixes
-    x = np.empty((num_nodes, 1024))
-    ids = np.zeros((num_nodes, 1))
-    edge_index = np.zeros((2, num_edges), dtype=int)
-    edge_attr = np.empty((num_edges, 1))
-    # populate x and ids
-    for idx in range(num_nodes):
-        orf_id = node_idx_to_orf_id[idx]
-        x[idx] = G.nodes[orf_id]["embedding"]
-        ids[idx][0] = orf_id
-    # populate edge_index
-    for edge_idx, (o1, o2, prop) in enumerate(G.edges(data=True)):
-        n1 = orf_id_to_node_idx[o1]
-        n2 = orf_id_to_node_idx[o2]
-        edge_index[0][edge_idx] = n1
-        edge_index[1][edge_idx] = n2
-        edge_attr[edge_idx][0] = prop["weight"]  # spatial distance
+    # starts are sorted, so the orfs within tolerance of n1 are the run
+    # of orfs after it that start before contig_stop + tolerance
+    last = np.searchsorted(starts, stops + tolerance, side="right")
+    counts = np.maximum(last - nodes - 1, 0)
+    edge_ptr = np.concatenate([[0], np.cumsum(counts)])
+    n1 = np.repeat(nodes, counts)
+    n2 = np.arange(edge_ptr[-1]) - edge_ptr[n1] + n1 + 1
+    dist = starts[n2] - stops[n1]
+    # python round (np.round can differ in the last digit)
+    weights = [round(w, 2) for w in ((tolerance - dist) / tolerance).tolist()]
+    ids = np.array([o["orf_id"] for o in contig_orfs], dtype=np.int64)
+    x = np.array([o["embedding"] for o in contig_orfs], dtype=np.float32)
+    return {
+        "ids": torch.from_numpy(ids.reshape(-1, 1)),
+        "x": torch.from_numpy(x),
+        "edge_index": torch.from_numpy(np.stack([n1, n2])),
+        "edge_attr": torch.tensor(weights, dtype=torch.float32).reshape(-1, 1),
+        "edge_ptr": edge_ptr,
+    }
+
+
+def get_window_node_order(window_ids: List[int], num_orfs: int) -> List[int]:
+    # node order of the networkx subgraphs used before (keeps the tensors
+    # identical): contig order, unless the window has less than half of
+    # the orfs of the contig, then the order of set(window_ids)
+    if 2 * len(window_ids) >= num_orfs:
+        return list(range(len(window_ids)))
+    id_to_idx = {orf_id: idx for idx, orf_id in enumerate(window_ids)}
+    return [id_to_idx[orf_id] for orf_id in set(window_ids)]
+
+
+def get_window_tensor(
+    contig_tensors: ContigTensors, start: int, stop: int
+) -> Data:
+    # orfs start:stop of a contig
+    num_nodes = stop - start
+    x = contig_tensors["x"][start:stop]
+    ids = contig_tensors["ids"][start:stop]
+    edge_start = int(contig_tensors["edge_ptr"][start])
+    edge_stop = int(contig_tensors["edge_ptr"][stop])
+    edge_index = contig_tensors["edge_index"][:, edge_start:edge_stop]
+    edge_attr = contig_tensors["edge_attr"][edge_start:edge_stop]
+    # remove edges to orfs after the window
+    keep = edge_index[1] < stop
+    edge_index = edge_index[:, keep] - start
+    edge_attr = edge_attr[keep]
+    node_order = get_window_node_order(
+        ids[:, 0].tolist(), len(contig_tensors["ids"])
+    )
+    if node_order != list(range(num_nodes)):
+        node_order = torch.LongTensor(node_order)
+        node_rank = torch.empty(num_nodes, dtype=torch.long)
+        node_rank[node_order] = torch.arange(num_nodes)
+        n1, n2 = edge_index
+        r1, r2 = node_rank[n1], node_rank[n2]
+        # edges point away from the node that comes first and are grouped
+        # by that node, neighbours are visited in contig order
+        first = torch.minimum(r1, r2)
+        second = torch.maximum(r1, r2)
+        nbr = torch.where(r1 < r2, n2, n1)
+        edge_order = torch.argsort(first * num_nodes + nbr)
+        edge_index = torch.stack([first[edge_order], second[edge_order]])
+        edge_attr = edge_attr[edge_order]
+        x = x[node_order]
+        ids = ids[node_order]
     # pytorch datapoint
     datapoint = Data(
-        x=torch.Tensor(x),
-        ids=torch.LongTensor(ids),
-        edge_index=torch.LongTensor(edge_index),
-        edge_attr=torch.Tensor(edge_attr),
+        x=x,
+        ids=ids,
+        edge_index=edge_index,
+        edge_attr=edge_attr,
     )
     return datapoint
 
@@ -98,25 +118,134 @@ def windowify(
     ]
 
 
+def get_window_bounds(
+    num_orfs: int, size: int = 200, step: int = 75
+) -> List[Tuple[int, int]]:
+    # (start, stop) of the windows of consecutive orfs made by windowify
+    windows = windowify(list(range(num_orfs)), size=size, step=step)
+    return [(w[0], w[-1] + 1) for w in windows if len(w) > 0]
+
+
+def get_contig_tensors_from_genome(
+    orfs: List[OrfInput], tolerance: int = 10000
+) -> Dict[int, ContigTensors]:
+    contig_to_orfs = sort_orfs_by_contigs(orfs)
+    return {
+        contig_id: get_contig_tensors(contig_orfs, tolerance=tolerance)
+        for contig_id, contig_orfs in tqdm(
+            contig_to_orfs.items(), leave=False, desc="Preparing Orf Graphs"
+        )
+    }
+
+
+def get_tensors_from_contigs(
+    contig_to_tensors: Dict[int, ContigTensors],
+    window_size: int = 200,
+    window_step: int = 75,
+) -> List[Data]:
+    out = []
+    for contig_id, contig_tensors in tqdm(
+        contig_to_tensors.items(), leave=False, desc="Preparing Tensors"
+    ):
+        # window graph
+        window_bounds = get_window_bounds(
+            len(contig_tensors["ids"]), size=window_size, step=window_step
+        )
+        for start, stop in window_bounds:
+            out.append(get_window_tensor(contig_tensors, start, stop))
+    return out
+
+
 def get_tensors_from_genome(
     orfs: List[OrfInput],
     tolerance: int = 10000,
     window_size: int = 200,
     window_step: int = 75,
 ) -> List[Data]:
+    contig_to_tensors = get_contig_tensors_from_genome(
+        orfs, tolerance=tolerance
+    )
+    return get_tensors_from_contigs(
+        contig_to_tensors, window_size=window_size, window_step=window_step
+    )
+
+
+def get_subgraph_tensors(
+    contig_tensors: ContigTensors, orf_ids: Set[int]
+) -> ContigTensors:
+    # orf graph of a subset of the orfs of a contig (same tensors as a
+    # graph built from the subset, edges only depend on the two orfs)
+    contig_ids = contig_tensors["ids"][:, 0]
+    rows = torch.from_numpy(
+        np.flatnonzero(np.isin(contig_ids.numpy(), list(orf_ids)))
+    )
+    num_orfs = len(rows)
+    if num_orfs > 0 and int(rows[-1]) - int(rows[0]) + 1 == num_orfs:
+        # consecutive orfs (views of the contig tensors)
+        start = int(rows[0])
+        x = contig_tensors["x"][start : start + num_orfs]
+        ids = contig_tensors["ids"][start : start + num_orfs]
+    else:
+        x = contig_tensors["x"][rows]
+        ids = contig_tensors["ids"][rows]
+    # new node index of every contig orf (-1 for orfs outside the subset)
+    node_idx = torch.full((len(contig_ids),), -1, dtype=torch.long)
+    node_idx[rows] = torch.arange(num_orfs)
+    n1, n2 = node_idx[contig_tensors["edge_index"]]
+    keep = (n1 >= 0) & (n2 >= 0)
+    n1, n2 = n1[keep], n2[keep]
+    # node indices are increasing, so edges stay sorted by (n1, n2)
+    counts = np.bincount(n1.numpy(), minlength=num_orfs)
+    return {
+        "ids": ids,
+        "x": x,
+        "edge_index": torch.stack([n1, n2]),
+        "edge_attr": contig_tensors["edge_attr"][keep],
+        "edge_ptr": np.concatenate([[0], np.cumsum(counts)]),
+    }
+
+
+def get_tensors_from_bgcs(
+    contig_to_tensors: Dict[int, ContigTensors],
+    bgcs: List[Set[int]],
+    window_size: int = 500,
+    window_step: int = 75,
+) -> List[Data]:
+    # bgc windows are sliced from the orf graphs of their contig
+    orf_to_contig = {
+        orf_id: contig_id
+        for contig_id, contig_tensors in contig_to_tensors.items()
+        for orf_id in contig_tensors["ids"][:, 0].tolist()
+    }
     out = []
-    graphs = get_orf_graphs_from_genome(orfs, tolerance=tolerance)
-    for contig_id, G in tqdm(
-        graphs.items(), leave=False, desc="Preparing Tensors"
-    ):
-        # sort orfs by nucleotide position
-        nodes = sorted(G.nodes, key=lambda n: G.nodes[n]["contig_start"])
-        # window graph
-        windows = windowify(nodes, size=window_size, step=window_step)
-        for w_nodes in windows:
-            # render subgraph
-            subG = G.subgraph(w_nodes)
-            # render tensor
-            t = get_tensor_from_graph(subG)
-            out.append(t)
+    for bgc in bgcs:
+        contig_id = orf_to_contig[next(iter(bgc))]
+        bgc_tensors = get_subgraph_tensors(contig_to_tensors[contig_id], bgc)
+        window_bounds = get_window_bounds(
+            len(bgc_tensors["ids"]), size=window_size, step=window_step
+        )
+        for start, stop in window_bounds:
+            out.append(get_window_tensor(bgc_tensors, start, stop))
     return out
+
+
+def get_genome_tensors(
+    orfs: List[OrfInput], tolerance: int = 10000
+) -> GenomeTensors:
+    return {
+        "orfs": [
+            {k: v for k, v in o.items() if k != "embedding"} for o in orfs
+        ],
+        "contigs": get_contig_tensors_from_genome(orfs, tolerance=tolerance),
+    }
+
+
+def save_genome_tensors(genome_tensors: GenomeTensors, fp: str):
+    # written to a temporary file, readers only see complete files
+    torch.save(genome_tensors, f"{fp}.tmp")
+    os.replace(f"{fp}.tmp", fp)
+
+
+def load_genome_tensors(fp: str) -> GenomeTensors:
+    # memory mapped, embeddings are only read for the sliced orfs
+    return torch.load(fp, mmap=True, weights_only=False)
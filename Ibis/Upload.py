@@ -14,6 +14,7 @@ from Ibis import (
     SecondaryMetabolismEmbedder,
     SecondaryMetabolismPredictor,
 )
+from Ibis.Export import export_genome_files
 
 
 def get_filelookup(nuc_fasta_filename: str, output_dir: str) -> Dict[str, str]:
@@ -57,6 +58,10 @@ def upload_to_knowledge_graph(
     nuc_fasta_filename: str, output_dir: str, genome_id: Optional[int] = None
 ):
     # this function will be used to model airflow pipeline
+    # restore file layout expected by uploaders
+    export_genome_files(
+        nuc_fasta_filenames=[nuc_fasta_filename], output_dir=output_dir
+    )
     # get files
     filelookup = get_filelookup(
         nuc_fasta_filename=nuc_fasta_filename, output_dir=output_dir
@@ -1,15 +1,37 @@
+import asyncio
+import functools
 import os
+import threading
 import time
-from typing import Any, Dict, List, Literal, Union
+from typing import (
+    Any,
+    AsyncIterator,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Union,
+)
 
+import grpc
 import numpy as np
 from dotenv import find_dotenv, get_key
-from qdrant_client import QdrantClient
+from qdrant_client import AsyncQdrantClient, QdrantClient
+from qdrant_client import grpc as qdrant_grpc
+from qdrant_client.conversions.conversion import GrpcToRest, RestToGrpc
 from qdrant_client.http import models
+from qdrant_client.http.exceptions import (
+    ResponseHandlingException,
+    UnexpectedResponse,
+)
 from qdrant_client.http.models import CollectionStatus, SearchRequest
 from tqdm import tqdm
 
 from Ibis.Utilities.Qdrant.datastructs import DataQuery, SearchResponse
+from Ibis.Utilities.Qdrant.local import LocalIndex, export_exists
 from Ibis.Utilities.Qdrant.parameters import (
     default_dist_metric,
     default_search_params,
@@ -22,14 +44,51 @@ def batchify(l: list, bs: int = 1000):
 
 
 # connection to client
-client = QdrantClient(
-    host=get_key(find_dotenv(), "QDRANT_HOST"),
-    port=get_key(find_dotenv(), "QDRANT_PORT"),
+qdrant_host = get_key(find_dotenv(), "QDRANT_HOST")
+qdrant_port = get_key(find_dotenv(), "QDRANT_PORT")
+qdrant_grpc_port = int(get_key(find_dotenv(), "QDRANT_GRPC_PORT") or 6334)
+client = QdrantClient(host=qdrant_host, port=qdrant_port, timeout=180)
+# searches and uploads can use the gRPC interface (vectors are sent as
+# packed float32 instead of json text), channel is opened on first use
+grpc_client = QdrantClient(
+    host=qdrant_host,
+    port=qdrant_port,
+    grpc_port=qdrant_grpc_port,
+    prefer_grpc=True,
     timeout=180,
 )
+grpc_transport = {
+    "prefer_grpc": get_key(find_dotenv(), "QDRANT_PREFER_GRPC") == "true"
+}
+
+# optional in-process knn backend (see Ibis/Utilities/Qdrant/local.py)
+# collections exported to this directory are searched without the server
+local_backend = {
+    "export_dir": get_key(find_dotenv(), "QDRANT_LOCAL_DIR"),
+    "index_type": "exact",
+}
+
+
+def use_local_backend(
+    export_dir: Optional[str],
+    index_type: Literal["exact", "hnsw"] = "exact",
+):
+    # export_dir=None switches back to the qdrant server
+    local_backend["export_dir"] = export_dir
+    local_backend["index_type"] = index_type
+    clear_db_registry()
+
+
+def use_grpc_transport(prefer_grpc: bool = True):
+    # prefer_grpc=False switches back to the REST interface
+    grpc_transport["prefer_grpc"] = prefer_grpc
+    clear_db_registry()
 
 
 class QdrantBase:
+    # seconds a green status check is trusted before polling again
+    status_ttl: float = 60.0
+
     def __init__(
         self,
         collection_name: str,
@@ -38,11 +97,28 @@ class QdrantBase:
         memory_strategy: Literal["disk", "memory", "hybrid"] = None,
         memmap_threshold: int = None,
         delete_existing: bool = False,
+        prefer_grpc: bool = None,
         **kwargs,
     ):
         self.collection_name = collection_name
+        if prefer_grpc is None:
+            prefer_grpc = grpc_transport["prefer_grpc"]
+        self.prefer_grpc = prefer_grpc
         self.embedding_dim = embedding_dim
         self.label_alias = label_alias
+        self.collection_status = None
+        self.last_status_check = 0.0
+        self.local_index = None
+        export_dir = local_backend["export_dir"]
+        if export_dir is not None and export_exists(
+            export_dir, collection_name
+        ):
+            self.local_index = LocalIndex(
+                export_dir=export_dir,
+                collection_name=collection_name,
+                index_type=local_backend["index_type"],
+            )
+            return
         collections = client.get_collections()
         collection_names = {x.name for x in collections.collections}
         if delete_existing and collection_name in collection_names:
@@ -116,8 +192,19 @@ class QdrantBase:
         self.collection_status = client.get_collection(
             collection_name=self.collection_name
         )
+        self.last_status_check = time.time()
+
+    def is_healthy(self) -> bool:
+        # cached green status (within ttl) skips the round trip
+        return (
+            self.collection_status is not None
+            and self.collection_status.status.value == "green"
+            and time.time() - self.last_status_check < self.status_ttl
+        )
 
-    def check_status(self, timeout: int = 30):
+    def check_status(self, timeout: int = 30, force: bool = False):
+        if force == False and self.is_healthy():
+            return
         self._check_status()
         start = time.time()
         while self.collection_status.status.value != "green":
@@ -150,10 +237,35 @@ class QdrantBase:
         if isinstance(vectors, list):
             vectors = np.array(vectors)
         # Ensure vector is of correct dimensionality for collection
-        collection_info = client.get_collection(
-            collection_name=self.collection_name
-        )
+        # (collection metadata is cached by check_status)
+        collection_info = self.collection_status
         assert vectors.shape[1] == collection_info.config.params.vectors.size
+        if self.prefer_grpc:
+            # float32 rows are merged into the protobuf messages as packed
+            # bytes (see set_packed_floats)
+            if payloads is None:
+                payloads = [{}] * len(ids)
+            points = [
+                qdrant_grpc.PointStruct(
+                    id=get_grpc_point_id(point_id),
+                    vectors=qdrant_grpc.Vectors(
+                        vector=set_packed_floats(
+                            qdrant_grpc.Vector(), "data", vector
+                        )
+                    ),
+                    payload=RestToGrpc.convert_payload(payload),
+                )
+                for point_id, vector, payload in zip(ids, vectors, payloads)
+            ]
+            grpc_client.grpc_points.Upsert(
+                qdrant_grpc.UpsertPoints(
+                    collection_name=self.collection_name,
+                    wait=True,
+                    points=points,
+                ),
+                timeout=180,
+            )
+            return
         # do bulk uploading
         client.upsert(
             collection_name=self.collection_name,
@@ -174,17 +286,17 @@ class QdrantBase:
                 indexing_threshold=indexing_threshold
             ),
         )
-        collection_info = client.get_collection(
-            collection_name=self.collection_name
-        )
+        self._check_status()
         start = time.time()
-        while collection_info.status != CollectionStatus.GREEN:
+        while self.collection_status.status != CollectionStatus.GREEN:
             current = time.time()
             print(
                 f"Waiting for Collection to finish indexing. \
                 {round(current-start, 2)} seconds have elapsed..."
             )
             time.sleep(10)
+            # refresh status (otherwise this never finishes)
+            self._check_status()
         print("Indexing complete. Waiting 5 seconds for cleanup.")
         time.sleep(5)
 
@@ -193,54 +305,37 @@ class QdrantBase:
         return_embeds: bool = False,
         return_data: bool = False,
         data_filter: models.Filter = None,
-        limit: int = 100,
-    ):
-        if data_filter is None:
-            data = client.scroll(
-                collection_name=self.collection_name,
-                with_vectors=return_embeds,
-                with_payload=return_data,
-                limit=limit,
-            )
-        else:
-            data = client.scroll(
+        limit: int = None,  # max number of points (None for all)
+        page_size: int = 1000,
+    ) -> Iterator[models.Record]:
+        # streams points page by page (follows next_page_offset)
+        offset = None
+        num_points = 0
+        while limit is None or num_points < limit:
+            if limit is not None:
+                page_size = min(page_size, limit - num_points)
+            points, offset = client.scroll(
                 collection_name=self.collection_name,
                 scroll_filter=data_filter,
                 with_vectors=return_embeds,
                 with_payload=return_data,
-                limit=limit,
+                limit=page_size,
+                offset=offset,
             )
-        return data
+            for p in points:
+                yield p
+            num_points += len(points)
+            if offset is None:
+                break
 
     def delete_database(self):
+        # dropping the collection removes all points, vectors and payloads
+        # server side (nothing is pulled into memory)
         print(
             f"Permanently deleting collection {self.collection_name} and all associated data..."
         )
-        # get db ids
-        data = self.get_db_data(
-            return_data=False, return_embeds=False, limit=1000000000
-        )
-        ids = [x.id for x in data[0]]
-        if len(ids) != 0:
-            print(f"Deleting {len(ids)} vectors...")
-            client.delete_vectors(
-                collection_name=self.collection_name, points=ids, vectors=[""]
-            )
-            print(f"Deleting {len(ids)} payloads...")
-            for sub_ls in tqdm(batchify(ids, 1000)):
-                tmp = client.clear_payload(
-                    collection_name=self.collection_name,
-                    points_selector=models.PointIdsList(
-                        points=sub_ls,
-                    ),
-                )
-            print(f"Deleting {len(ids)} points...")
-            for sub_ls in tqdm(batchify(ids, 1000)):
-                tmp = client.delete(
-                    collection_name=self.collection_name,
-                    points_selector=models.PointIdsList(points=sub_ls),
-                )
         client.delete_collection(collection_name=self.collection_name)
+        self.collection_status = None
 
     def retrieve(
         self,
@@ -274,47 +369,426 @@ class QdrantBase:
         consistency=None,
         distance_cutoff: float = None,  # NOT squared distance!!!
         ignore_self_matches: bool = True,
+        max_in_flight: int = 1,  # > 1 enables pipelined async requests
+        max_retries: int = 3,
     ) -> List[SearchResponse]:
+        if self.local_index is not None:
+            if query_filter is not None:
+                raise NotImplementedError(
+                    "query_filter is not supported by the local backend"
+                )
+            return self.local_index.batch_search(
+                queries=queries,
+                batch_size=batch_size,
+                max_results=max_results,
+                return_embeds=return_embeds,
+                return_data=return_data,
+                distance_cutoff=distance_cutoff,
+                ignore_self_matches=ignore_self_matches,
+            )
+        if max_in_flight > 1:
+            # pipelined async requests, restored to query order
+            async def collect():
+                out = {}
+                async for batch_idx, responses in self._abatch_search(
+                    queries=queries,
+                    batch_size=batch_size,
+                    max_results=max_results,
+                    return_embeds=return_embeds,
+                    return_data=return_data,
+                    query_filter=query_filter,
+                    consistency=consistency,
+                    distance_cutoff=distance_cutoff,
+                    ignore_self_matches=ignore_self_matches,
+                    max_in_flight=max_in_flight,
+                    max_retries=max_retries,
+                ):
+                    out[batch_idx] = responses
+                return [r for batch_idx in sorted(out) for r in out[batch_idx]]
+
+            loop = get_async_loop()
+            # searches run on the background loop (also when the caller
+            # has a running loop), calls made on that loop search in sync
+            if get_running_loop() is not loop:
+                # blocking status check stays in the caller thread
+                self.check_status()
+                return asyncio.run_coroutine_threadsafe(
+                    collect(), loop
+                ).result()
         self.check_status()
-        search_params = models.SearchParams(**default_search_params)
         batches = batchify(queries, bs=batch_size)
         all_results = []
         for batch in tqdm(batches, leave=False):
-            batch_qids = []
-            batch_reshape = []
-            for entry in batch:
-                batch_qids.append(entry["query_id"])
-                batch_reshape.append(
-                    SearchRequest(
-                        vector=entry["embedding"].tolist(),
-                        limit=max_results,
-                        with_payload=True,
-                        with_vector=return_embeds,
-                        filter=query_filter,
-                        score_threshold=distance_cutoff,
-                        params=search_params,
-                    )
+            batch_qids, batch_reshape = self._get_search_requests(
+                batch=batch,
+                max_results=max_results,
+                return_embeds=return_embeds,
+                query_filter=query_filter,
+                distance_cutoff=distance_cutoff,
+            )
+            if self.prefer_grpc:
+                response = grpc_client.grpc_points.SearchBatch(
+                    self._get_grpc_batch_request(batch_reshape, consistency),
+                    timeout=30,
+                )
+                results = get_grpc_results(response)
+            else:
+                results = client.search_batch(
+                    collection_name=self.collection_name,
+                    requests=batch_reshape,
+                    consistency=consistency,
+                    timeout=30,
                 )
-            results = client.search_batch(
+            all_results.extend(
+                self._parse_search_results(
+                    batch_qids=batch_qids,
+                    results=results,
+                    return_data=return_data,
+                    ignore_self_matches=ignore_self_matches,
+                )
+            )
+        return all_results
+
+    def _get_search_requests(
+        self,
+        batch: List[DataQuery],
+        max_results: int,
+        return_embeds: bool = False,
+        query_filter: models.Filter = None,
+        distance_cutoff: float = None,
+    ) -> Tuple[List[int], list]:
+        search_params = models.SearchParams(**default_search_params)
+        if self.prefer_grpc:
+            return self._get_grpc_search_requests(
+                batch=batch,
+                max_results=max_results,
+                return_embeds=return_embeds,
+                query_filter=query_filter,
+                distance_cutoff=distance_cutoff,
+                search_params=search_params,
+            )
+        batch_qids = []
+        batch_reshape = []
+        for entry in batch:
+            batch_qids.append(entry["query_id"])
+            batch_reshape.append(
+                SearchRequest(
+                    vector=entry["embedding"].tolist(),
+                    limit=max_results,
+                    with_payload=True,
+                    with_vector=return_embeds,
+                    filter=query_filter,
+                    score_threshold=distance_cutoff,
+                    params=search_params,
+                )
+            )
+        return batch_qids, batch_reshape
+
+    def _get_grpc_search_requests(
+        self,
+        batch: List[DataQuery],
+        max_results: int,
+        return_embeds: bool,
+        query_filter: models.Filter,
+        distance_cutoff: float,
+        search_params: models.SearchParams,
+    ) -> Tuple[List[int], List[qdrant_grpc.SearchPoints]]:
+        grpc_params = RestToGrpc.convert_search_params(search_params)
+        grpc_filter = None
+        if query_filter is not None:
+            grpc_filter = RestToGrpc.convert_filter(query_filter)
+        batch_qids = []
+        batch_reshape = []
+        for entry in batch:
+            batch_qids.append(entry["query_id"])
+            request = qdrant_grpc.SearchPoints(
                 collection_name=self.collection_name,
-                requests=batch_reshape,
-                consistency=consistency,
-                timeout=30,
+                limit=max_results,
+                with_payload=qdrant_grpc.WithPayloadSelector(enable=True),
+                with_vectors=qdrant_grpc.WithVectorsSelector(
+                    enable=return_embeds
+                ),
+                filter=grpc_filter,
+                score_threshold=distance_cutoff,
+                params=grpc_params,
             )
-            for qid, result in zip(batch_qids, results):
-                hits = []
-                for r in result:
-                    dist = r.score
-                    data = r.payload if return_data else {}
-                    if r.id == qid and ignore_self_matches:
-                        continue
-                    hits.append(
-                        {
-                            "subject_id": r.id,
-                            "distance": r.score,
-                            "label": r.payload[self.label_alias],
-                            "data": data,
-                        }
-                    )
-                all_results.append({"query_id": qid, "hits": hits})
+            # float32 buffer is merged as packed bytes (no list conversion)
+            batch_reshape.append(
+                set_packed_floats(request, "vector", entry["embedding"])
+            )
+        return batch_qids, batch_reshape
+
+    def _get_grpc_batch_request(
+        self, batch_reshape: List[qdrant_grpc.SearchPoints], consistency=None
+    ) -> qdrant_grpc.SearchBatchPoints:
+        read_consistency = None
+        if consistency is not None:
+            read_consistency = RestToGrpc.convert_read_consistency(consistency)
+        return qdrant_grpc.SearchBatchPoints(
+            collection_name=self.collection_name,
+            search_points=batch_reshape,
+            read_consistency=read_consistency,
+        )
+
+    def _parse_search_results(
+        self,
+        batch_qids: List[int],
+        results: list,
+        return_data: bool = True,
+        ignore_self_matches: bool = True,
+    ) -> List[SearchResponse]:
+        all_results = []
+        for qid, result in zip(batch_qids, results):
+            hits = []
+            for r in result:
+                dist = r.score
+                data = r.payload if return_data else {}
+                if r.id == qid and ignore_self_matches:
+                    continue
+                hits.append(
+                    {
+                        "subject_id": r.id,
+                        "distance": r.score,
+                        "label": r.payload[self.label_alias],
+                        "data": data,
+                    }
+                )
+            all_results.append({"query_id": qid, "hits": hits})
         return all_results
+
+    async def abatch_search(
+        self,
+        queries: List[DataQuery],
+        batch_size: int,
+        max_results: int,
+        return_embeds: bool = False,
+        return_data: bool = True,
+        query_filter: models.Filter = None,
+        consistency=None,
+        distance_cutoff: float = None,  # NOT squared distance!!!
+        ignore_self_matches: bool = True,
+        max_in_flight: int = 4,
+        max_retries: int = 3,
+    ) -> AsyncIterator[List[SearchResponse]]:
+        # yields the responses of each batch as they arrive
+        # (batches are not returned in query order)
+        async for _, responses in self._abatch_search(
+            queries=queries,
+            batch_size=batch_size,
+            max_results=max_results,
+            return_embeds=return_embeds,
+            return_data=return_data,
+            query_filter=query_filter,
+            consistency=consistency,
+            distance_cutoff=distance_cutoff,
+            ignore_self_matches=ignore_self_matches,
+            max_in_flight=max_in_flight,
+            max_retries=max_retries,
+        ):
+            yield responses
+
+    async def _abatch_search(
+        self,
+        queries: List[DataQuery],
+        batch_size: int,
+        max_results: int,
+        return_embeds: bool = False,
+        return_data: bool = True,
+        query_filter: models.Filter = None,
+        consistency=None,
+        distance_cutoff: float = None,
+        ignore_self_matches: bool = True,
+        max_in_flight: int = 4,
+        max_retries: int = 3,
+    ) -> AsyncIterator[Tuple[int, List[SearchResponse]]]:
+        # blocking work (status check, building requests) runs in the
+        # default executor so the (shared) event loop is never stalled
+        loop = asyncio.get_running_loop()
+        await loop.run_in_executor(None, self.check_status)
+        aclient = get_async_client(self.prefer_grpc)
+
+        async def search(batch_idx: int, batch: List[DataQuery]):
+            batch_qids, batch_reshape = await loop.run_in_executor(
+                None,
+                functools.partial(
+                    self._get_search_requests,
+                    batch=batch,
+                    max_results=max_results,
+                    return_embeds=return_embeds,
+                    query_filter=query_filter,
+                    distance_cutoff=distance_cutoff,
+                ),
+            )
+            for attempt in range(max_retries + 1):
+                try:
+                    if self.prefer_grpc:
+                        response = await aclient.grpc_points.SearchBatch(
+                            self._get_grpc_batch_request(
+                                batch_reshape, consistency
+                            ),
+                            timeout=30,
+                        )
+                        results = get_grpc_results(response)
+                    else:
+                        results = await aclient.search_batch(
+                            collection_name=self.collection_name,
+                            requests=batch_reshape,
+                            consistency=consistency,
+                            timeout=30,
+                        )
+                    break
+                except Exception as e:
+                    if attempt == max_retries:
+                        raise
+                    if is_transient_error(e) == False:
+                        raise
+                    # exponential backoff before retrying
+                    await asyncio.sleep(2**attempt)
+            responses = self._parse_search_results(
+                batch_qids=batch_qids,
+                results=results,
+                return_data=return_data,
+                ignore_self_matches=ignore_self_matches,
+            )
+            return batch_idx, responses
+
+        batches = batchify(queries, bs=batch_size)
+        pbar = tqdm(total=len(batches), leave=False)
+        pending = set()
+        try:
+            for batch_idx, batch in enumerate(batches):
+                pending.add(asyncio.ensure_future(search(batch_idx, batch)))
+                # backpressure (wait for a slot before sending more)
+                if len(pending) >= max_in_flight:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    for task in done:
+                        pbar.update(1)
+                        yield task.result()
+            while len(pending) > 0:
+                done, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    pbar.update(1)
+                    yield task.result()
+        finally:
+            for task in pending:
+                task.cancel()
+            pbar.close()
+
+
+def get_grpc_point_id(point_id: Union[int, str]) -> qdrant_grpc.PointId:
+    if isinstance(point_id, str):
+        return qdrant_grpc.PointId(uuid=point_id)
+    return qdrant_grpc.PointId(num=int(point_id))
+
+
+def encode_varint(value: int) -> bytes:
+    out = bytearray()
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+    return bytes(out)
+
+
+def set_packed_floats(message, field_name: str, values: np.ndarray):
+    # assigning an array to a repeated float field converts it element by
+    # element in python, the wire format of the packed field is parsed in c
+    field_number = message.DESCRIPTOR.fields_by_name[field_name].number
+    data = np.asarray(values, dtype="<f4").tobytes()
+    message.MergeFromString(
+        encode_varint((field_number << 3) | 2)
+        + encode_varint(len(data))
+        + data
+    )
+    return message
+
+
+def get_grpc_results(
+    response: qdrant_grpc.SearchBatchResponse,
+) -> List[List[models.ScoredPoint]]:
+    # same hit objects as the REST interface
+    return [
+        [GrpcToRest.convert_scored_point(p) for p in batch.result]
+        for batch in response.result
+    ]
+
+
+transient_grpc_codes = {
+    grpc.StatusCode.UNAVAILABLE,
+    grpc.StatusCode.DEADLINE_EXCEEDED,
+    grpc.StatusCode.RESOURCE_EXHAUSTED,
+}
+
+
+def is_transient_error(e: Exception) -> bool:
+    # connection problems, timeouts, rate limits and server side errors
+    if isinstance(e, UnexpectedResponse):
+        return e.status_code == 429 or e.status_code >= 500
+    if isinstance(e, grpc.RpcError):
+        return e.code() in transient_grpc_codes
+    return isinstance(
+        e, (ResponseHandlingException, asyncio.TimeoutError, ConnectionError)
+    )
+
+
+# process wide registry of warmed collection handles
+# (collection metadata and health checks are cached on the handle)
+db_registry: Dict[Callable, QdrantBase] = {}
+
+
+def get_qdrant_db(qdrant_db: Callable[[], QdrantBase]) -> QdrantBase:
+    if qdrant_db not in db_registry:
+        db_registry[qdrant_db] = qdrant_db()
+    return db_registry[qdrant_db]
+
+
+def clear_db_registry():
+    db_registry.clear()
+
+
+# async clients are bound to the event loop they are created on
+# pipelined batch_search calls share one background loop per process, so
+# its clients (and connections) are reused like the collection handles
+async_loop: Dict[str, asyncio.AbstractEventLoop] = {}
+async_loop_lock = threading.Lock()
+async_clients: Dict[
+    Tuple[asyncio.AbstractEventLoop, bool], AsyncQdrantClient
+] = {}
+
+
+def get_async_loop() -> asyncio.AbstractEventLoop:
+    with async_loop_lock:
+        if "loop" not in async_loop:
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, daemon=True).start()
+            async_loop["loop"] = loop
+        return async_loop["loop"]
+
+
+def get_running_loop() -> Optional[asyncio.AbstractEventLoop]:
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+def get_async_client(prefer_grpc: bool) -> AsyncQdrantClient:
+    # called inside a running loop (one client per loop and transport)
+    loop = asyncio.get_running_loop()
+    key = (loop, prefer_grpc)
+    if key not in async_clients:
+        # drop clients of closed loops
+        for k in [k for k in async_clients if k[0].is_closed()]:
+            del async_clients[k]
+        async_clients[key] = AsyncQdrantClient(
+            host=qdrant_host,
+            port=qdrant_port,
+            grpc_port=qdrant_grpc_port,
+            prefer_grpc=prefer_grpc,
+            timeout=180,
+        )
+    return async_clients[key]
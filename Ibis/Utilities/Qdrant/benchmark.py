@@ -0,0 +1,69 @@
+import time
+from typing import Callable, Dict, List
+
+import numpy as np
+
+from Ibis.Utilities.Qdrant.base import QdrantBase, client
+from Ibis.Utilities.Qdrant.datastructs import DataQuery
+
+# compares query throughput of the REST and gRPC interfaces
+# usage: python -m Ibis.Utilities.Qdrant.benchmark
+
+
+def sample_queries(
+    db: QdrantBase, num_queries: int = 10000, seed: int = 0
+) -> List[DataQuery]:
+    # stored vectors (jittered) give realistic neighbourhoods
+    points, _ = client.scroll(
+        collection_name=db.collection_name,
+        limit=num_queries,
+        with_vectors=True,
+        with_payload=False,
+    )
+    rng = np.random.default_rng(seed)
+    vectors = np.array([p.vector for p in points], dtype=np.float32)
+    vectors += rng.normal(scale=0.01, size=vectors.shape).astype(np.float32)
+    return [{"query_id": idx, "embedding": v} for idx, v in enumerate(vectors)]
+
+
+def benchmark_transports(
+    qdrant_dbs: List[Callable[[], QdrantBase]],
+    num_queries: int = 10000,
+    batch_size: int = 100,
+    top_n: int = 5,
+    max_in_flight: int = 1,
+) -> Dict[str, Dict[str, float]]:
+    # queries per second for each collection and transport
+    report = {}
+    for qdrant_db in qdrant_dbs:
+        db = qdrant_db()
+        queries = sample_queries(db, num_queries=num_queries)
+        report[db.collection_name] = {}
+        for transport, prefer_grpc in [("rest", False), ("grpc", True)]:
+            db.prefer_grpc = prefer_grpc
+            # warm up connection and collection caches
+            db.batch_search(queries[:batch_size], batch_size, top_n)
+            start = time.time()
+            db.batch_search(
+                queries,
+                batch_size=batch_size,
+                max_results=top_n,
+                max_in_flight=max_in_flight,
+            )
+            elapsed = time.time() - start
+            report[db.collection_name][transport] = round(
+                len(queries) / elapsed, 1
+            )
+    return report
+
+
+if __name__ == "__main__":
+    from Ibis.ProteinDecoder.databases import IbisEC, IbisKO
+
+    report = benchmark_transports([IbisEC, IbisKO])
+    for collection_name, results in report.items():
+        speedup = round(results["grpc"] / results["rest"], 2)
+        print(
+            f"{collection_name}: rest {results['rest']} queries/s, "
+            f"grpc {results['grpc']} queries/s ({speedup}x)"
+        )
@@ -0,0 +1,281 @@
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, List, Optional
+
+import numpy as np
+import xxhash
+from dotenv import find_dotenv, get_key
+from qdrant_client import QdrantClient
+from qdrant_client.http import models
+
+from Ibis.Utilities.Qdrant.base import QdrantBase, client
+from Ibis.Utilities.Qdrant.datastructs import (
+    DataQuery,
+    DistHitResponse,
+    SearchResponse,
+)
+
+
+class KNNCache:
+    """Persistent cache of raw KNN hits shared across genomes
+    1. Keys are (collection, collection version, query hash, search params)
+    2. The query hash is taken over the float32 embedding bytes, so
+       identical proteins in different genomes share entries
+    3. Raw hit lists are stored (classification settings can change)
+    Entries of other versions are dropped the first time a new collection
+    version is seen. Restores and ingestions record a content identity
+    as a version alias on the server (see set_collection_version), so a
+    re-restored collection gets a new version in every process.
+    """
+
+    def __init__(self, cache_dir: str):
+        os.makedirs(cache_dir, exist_ok=True)
+        self.cache_fp = f"{cache_dir}/knn_cache.sqlite"
+        self.conn = sqlite3.connect(
+            self.cache_fp, timeout=60, check_same_thread=False
+        )
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS hits ("
+            "collection_name TEXT, version TEXT, query_key TEXT, hits TEXT, "
+            "PRIMARY KEY (collection_name, version, query_key))"
+        )
+        self.conn.commit()
+        # decoders share the cache from different threads
+        self.lock = threading.Lock()
+        self.checked_versions = {}
+        self.hits = {}
+        self.misses = {}
+
+    @property
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        # per collection (one collection per decoder)
+        stats = {}
+        for collection_name in sorted(set(self.hits) | set(self.misses)):
+            hits = self.hits.get(collection_name, 0)
+            misses = self.misses.get(collection_name, 0)
+            total = hits + misses
+            stats[collection_name] = {
+                "hits": hits,
+                "misses": misses,
+                "hit_rate": round(hits / total, 4) if total > 0 else 0.0,
+            }
+        return stats
+
+    @staticmethod
+    def get_version(db: QdrantBase) -> str:
+        # fingerprint of the collection (recorded content identity, point
+        # count and vector config)
+        if db.local_index is not None:
+            version = f"local:{db.local_index.get_version()}"
+        else:
+            db.check_status()
+            status = db.collection_status
+            aliases = get_collection_version_aliases(db.collection_name)
+            version = (
+                f"{aliases}:{status.points_count}:"
+                f"{status.config.params.vectors}"
+            )
+        return xxhash.xxh64(version.encode()).hexdigest()
+
+    @staticmethod
+    def get_query_keys(
+        queries: List[DataQuery],
+        max_results: int,
+        distance_cutoff: float,
+        ignore_self_matches: bool,
+    ) -> List[str]:
+        params = f"{max_results}:{distance_cutoff}:{ignore_self_matches}"
+        keys = []
+        for q in queries:
+            embedding = np.ascontiguousarray(q["embedding"], dtype=np.float32)
+            query_hash = xxhash.xxh3_128(embedding.tobytes()).hexdigest()
+            key = f"{query_hash}:{params}"
+            # self matches depend on the query id
+            if ignore_self_matches:
+                key = f"{key}:{q['query_id']}"
+            keys.append(key)
+        return keys
+
+    def check_version(self, collection_name: str, version: str):
+        if self.checked_versions.get(collection_name) != version:
+            with self.lock:
+                self.conn.execute(
+                    "DELETE FROM hits WHERE collection_name = ? "
+                    "AND version != ?",
+                    (collection_name, version),
+                )
+                self.conn.commit()
+            self.checked_versions[collection_name] = version
+
+    def lookup(
+        self, collection_name: str, version: str, keys: List[str]
+    ) -> Dict[str, List[DistHitResponse]]:
+        found = {}
+        unique_keys = list(set(keys))
+        with self.lock:
+            # sqlite limits the number of bound parameters
+            for start in range(0, len(unique_keys), 500):
+                batch = unique_keys[start : start + 500]
+                rows = self.conn.execute(
+                    "SELECT query_key, hits FROM hits "
+                    "WHERE collection_name = ? AND version = ? "
+                    f"AND query_key IN ({','.join('?' * len(batch))})",
+                    [collection_name, version] + batch,
+                )
+                for query_key, hits in rows:
+                    found[query_key] = json.loads(hits)
+        return found
+
+    def add(
+        self,
+        collection_name: str,
+        version: str,
+        entries: Dict[str, List[DistHitResponse]],
+    ):
+        with self.lock:
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO hits VALUES (?, ?, ?, ?)",
+                [
+                    (collection_name, version, k, json.dumps(v))
+                    for k, v in entries.items()
+                ],
+            )
+            self.conn.commit()
+
+    def invalidate(self, collection_name: str):
+        with self.lock:
+            self.conn.execute(
+                "DELETE FROM hits WHERE collection_name = ?",
+                (collection_name,),
+            )
+            self.conn.commit()
+        self.checked_versions.pop(collection_name, None)
+
+    def batch_search(
+        self,
+        db: QdrantBase,
+        queries: List[DataQuery],
+        batch_size: int,
+        max_results: int,
+        distance_cutoff: float = None,
+        ignore_self_matches: bool = True,
+        max_in_flight: int = 1,
+    ) -> List[SearchResponse]:
+        # same output as db.batch_search (with return_data=True)
+        # only queries missing from the cache are searched
+        collection_name = db.collection_name
+        version = self.get_version(db)
+        self.check_version(collection_name, version)
+        keys = self.get_query_keys(
+            queries,
+            max_results=max_results,
+            distance_cutoff=distance_cutoff,
+            ignore_self_matches=ignore_self_matches,
+        )
+        found = self.lookup(collection_name, version, keys)
+        # identical queries are only searched once
+        to_search = {}
+        for q, k in zip(queries, keys):
+            if k not in found and k not in to_search:
+                to_search[k] = q
+        num_hits = sum(1 for k in keys if k in found)
+        self.hits[collection_name] = (
+            self.hits.get(collection_name, 0) + num_hits
+        )
+        self.misses[collection_name] = (
+            self.misses.get(collection_name, 0) + len(keys) - num_hits
+        )
+        if len(to_search) > 0:
+            predictions = db.batch_search(
+                queries=list(to_search.values()),
+                batch_size=batch_size,
+                max_results=max_results,
+                return_embeds=False,
+                return_data=True,
+                distance_cutoff=distance_cutoff,
+                ignore_self_matches=ignore_self_matches,
+                max_in_flight=max_in_flight,
+            )
+            searched = {k: p["hits"] for k, p in zip(to_search, predictions)}
+            self.add(collection_name, version, searched)
+            found.update(searched)
+        return [
+            {"query_id": q["query_id"], "hits": found[k]}
+            for q, k in zip(queries, keys)
+        ]
+
+
+# optional cache, set QDRANT_CACHE_DIR in Ibis/.env or call use_knn_cache
+knn_cache = {"cache_dir": get_key(find_dotenv(), "QDRANT_CACHE_DIR")}
+knn_cache_handles: Dict[str, KNNCache] = {}
+
+
+def use_knn_cache(cache_dir: Optional[str]):
+    # cache_dir=None disables the cache
+    knn_cache["cache_dir"] = cache_dir
+
+
+def get_knn_cache() -> Optional[KNNCache]:
+    cache_dir = knn_cache["cache_dir"]
+    if cache_dir is None:
+        return None
+    if cache_dir not in knn_cache_handles:
+        knn_cache_handles[cache_dir] = KNNCache(cache_dir)
+    return knn_cache_handles[cache_dir]
+
+
+def get_version_alias_prefix(collection_name: str) -> str:
+    return f"{collection_name}-version-"
+
+
+def get_collection_version_aliases(
+    collection_name: str, node_client: Optional[QdrantClient] = None
+) -> List[str]:
+    if node_client is None:
+        node_client = client
+    prefix = get_version_alias_prefix(collection_name)
+    aliases = node_client.get_collection_aliases(
+        collection_name=collection_name
+    ).aliases
+    return sorted(
+        a.alias_name for a in aliases if a.alias_name.startswith(prefix)
+    )
+
+
+def set_collection_version(
+    collection_name: str,
+    version: str,
+    node_client: Optional[QdrantClient] = None,
+):
+    # the content identity of a (re-)restored collection is kept as an
+    # alias on the server, visible to processes without a shared cache dir
+    if node_client is None:
+        node_client = client
+    alias_name = f"{get_version_alias_prefix(collection_name)}{version}"
+    operations = [
+        models.DeleteAliasOperation(
+            delete_alias=models.DeleteAlias(alias_name=old_alias_name)
+        )
+        for old_alias_name in get_collection_version_aliases(
+            collection_name, node_client=node_client
+        )
+    ]
+    operations.append(
+        models.CreateAliasOperation(
+            create_alias=models.CreateAlias(
+                collection_name=collection_name, alias_name=alias_name
+            )
+        )
+    )
+    # alias changes are atomic
+    node_client.update_collection_aliases(change_aliases_operations=operations)
+
+
+def invalidate_knn_cache(collection_name: str):
+    # called when a collection is (re-)restored
+    cache = get_knn_cache()
+    if cache is not None:
+        cache.invalidate(collection_name)
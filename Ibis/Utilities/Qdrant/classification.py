@@ -1,12 +1,18 @@
 from collections import Counter
-from typing import Callable, Dict, List
+from itertools import chain
+from operator import itemgetter
+from typing import Callable, Dict, List, Tuple
 
-from Ibis.Utilities.Qdrant.base import QdrantBase
+import numpy as np
+
+from Ibis.Utilities.Qdrant.base import QdrantBase, get_qdrant_db
+from Ibis.Utilities.Qdrant.cache import get_knn_cache
 from Ibis.Utilities.Qdrant.datastructs import (
     DataQuery,
     DistHitResponse,
     KnnOutput,
 )
+from Ibis.Utilities.rounding import round_values
 
 
 def dist2sim(d: float) -> float:
@@ -174,6 +180,329 @@ def ontology_neighborhood_classification(
     return response
 
 
+########################################################################
+# Batched classification
+########################################################################
+
+# same outputs as the per query functions above, computed over all hits of
+# a batch at once (flattened into arrays of query, label id and distance)
+
+
+class LabelTable:
+    # label vocabulary kept across batches (one table per collection)
+    # ontology labels (e.g. EC numbers) are expanded once into their prefix
+    # hierarchy ("1", "1.2", "1.2.3", ...), stored as a padded id matrix
+
+    def __init__(self):
+        self.labels = []
+        self.label_ids = {}
+        self.prefix_ids = {}
+        self.prefix_rows = []
+        self.prefix_matrix = np.zeros((0, 0), dtype=np.int64)
+
+    def get_label_ids(self, labels: List) -> np.ndarray:
+        label_ids = list(map(self.label_ids.get, labels))
+        if None in label_ids:
+            for idx, label in enumerate(labels):
+                if label_ids[idx] is None:
+                    if label not in self.label_ids:
+                        self.label_ids[label] = len(self.labels)
+                        self.labels.append(label)
+                    label_ids[idx] = self.label_ids[label]
+        return np.array(label_ids, dtype=np.int64)
+
+    def get_prefix_matrix(self) -> np.ndarray:
+        # rows are padded with -1 (sorts below any observed frequency)
+        if len(self.prefix_rows) < len(self.labels):
+            for label in self.labels[len(self.prefix_rows) :]:
+                toks = label.split(".")
+                row = []
+                for l in range(1, len(toks) + 1):
+                    prefix = ".".join(toks[:l])
+                    if prefix not in self.prefix_ids:
+                        self.prefix_ids[prefix] = len(self.prefix_ids)
+                    row.append(self.prefix_ids[prefix])
+                self.prefix_rows.append(row)
+            max_depth = max(len(row) for row in self.prefix_rows)
+            self.prefix_matrix = np.full(
+                (len(self.prefix_rows), max_depth), -1, dtype=np.int64
+            )
+            for idx, row in enumerate(self.prefix_rows):
+                self.prefix_matrix[idx, : len(row)] = row
+        return self.prefix_matrix
+
+
+label_tables: Dict[str, LabelTable] = {}
+
+
+def get_label_table(collection_name: str) -> LabelTable:
+    if collection_name not in label_tables:
+        label_tables[collection_name] = LabelTable()
+    return label_tables[collection_name]
+
+
+def get_group_starts(keys: np.ndarray) -> np.ndarray:
+    # start positions of runs of equal keys (keys are already sorted)
+    change = np.ones(len(keys), dtype=bool)
+    change[1:] = keys[1:] != keys[:-1]
+    return np.flatnonzero(change)
+
+
+def get_group_positions(query_idx: np.ndarray) -> np.ndarray:
+    # position of every row within its query (rows sorted by query)
+    starts = np.searchsorted(query_idx, query_idx, side="left")
+    return np.arange(len(query_idx)) - starts
+
+
+def select_neighborhood(
+    hit_lists: List[List[DistHitResponse]],
+    top_n: int,
+    dist_cutoff: float,
+    apply_cutoff_before_homology: bool,
+) -> Tuple[np.ndarray, np.ndarray, List[DistHitResponse]]:
+    # top n hits per query (stable sort by distance) within the cutoff
+    # returns query index, distance and hit of the kept rows, in the order
+    # the per query functions iterate over them
+    hits = list(chain.from_iterable(hit_lists))
+    query_idx = np.repeat(np.arange(len(hit_lists)), list(map(len, hit_lists)))
+    distance = np.fromiter(
+        map(itemgetter("distance"), hits), dtype=np.float64, count=len(hits)
+    )
+    order = np.lexsort((distance, query_idx))
+    order = order[get_group_positions(query_idx[order]) < top_n]
+    if apply_cutoff_before_homology == True:
+        order = order[~(distance[order] > dist_cutoff)]
+    hits = list(map(hits.__getitem__, order.tolist()))
+    return query_idx[order], distance[order], hits
+
+
+def group_labels(
+    query_idx: np.ndarray, label_id: np.ndarray, distance: np.ndarray
+) -> Dict[str, np.ndarray]:
+    # group rows by (query, label), rows are in iteration order (sorted by
+    # distance within a query) which the stable sort keeps within groups
+    keys = query_idx * (label_id.max() + 1) + label_id
+    order = np.argsort(keys, kind="stable")
+    starts = get_group_starts(keys[order])
+    sorted_distance = distance[order]
+    min_distance = sorted_distance[starts]
+    # the reference is the last row sharing the minimum distance
+    is_min = sorted_distance == np.repeat(
+        min_distance, np.diff(np.append(starts, len(order)))
+    )
+    num_min = np.add.reduceat(is_min.astype(np.int64), starts)
+    return {
+        "query_idx": query_idx[order][starts],
+        "label_id": label_id[order][starts],
+        "count": np.diff(np.append(starts, len(order))),
+        "distance": min_distance,
+        "reference_row": order[starts + num_min - 1],
+        "first_row": order[starts],
+    }
+
+
+def format_predictions(
+    num_queries: int,
+    groups: Dict[str, np.ndarray],
+    order: np.ndarray,
+    labels: List,
+    reference_ids: List[int],
+    top_n: int,
+    dist_cutoff: float,
+    homology_cutoff: float,
+    apply_homology_cutoff: bool,
+    apply_cutoff_after_homology: bool,
+    return_distance: bool,
+    return_n: int,
+) -> List[List[dict]]:
+    # groups are ordered by query and rank, keep the top return_n labels
+    order = order[get_group_positions(groups["query_idx"][order]) < return_n]
+    # homology scores only depend on the count of a label
+    counts = groups["count"][order]
+    homology_scores = np.array(
+        [round(c / top_n, 2) for c in range(counts.max(initial=0) + 1)]
+    )
+    homology = homology_scores[counts]
+    distance = groups["distance"][order]
+    # filters based on homology score and final distance
+    if apply_homology_cutoff == True:
+        keep = ~(homology < homology_cutoff)
+        if apply_cutoff_after_homology == True:
+            keep &= ~(distance > dist_cutoff)
+        order, homology, distance = order[keep], homology[keep], distance[keep]
+    query_idx = groups["query_idx"][order]
+    rank = get_group_positions(query_idx) + 1
+    if return_distance == False:
+        score_key = "similarity"
+        score = round_values(1 / (1 + distance), 3)
+    else:
+        score_key = "distance"
+        score = distance
+    outputs = [
+        {
+            "label": labels[label_id],
+            "reference_id": reference_ids[reference_row],
+            "homology": h,
+            "rank": r,
+            score_key: sc,
+        }
+        for label_id, reference_row, h, r, sc in zip(
+            groups["label_id"][order].tolist(),
+            groups["reference_row"][order].tolist(),
+            homology.tolist(),
+            rank.tolist(),
+            score.tolist(),
+        )
+    ]
+    # split into predictions per query
+    bounds = np.searchsorted(query_idx, np.arange(num_queries + 1)).tolist()
+    return [outputs[a:b] for a, b in zip(bounds[:-1], bounds[1:])]
+
+
+def batch_neighborhood_classification(
+    hit_lists: List[List[DistHitResponse]],
+    top_n: int = 1,
+    dist_cutoff: float = 0.0,
+    apply_cutoff_before_homology: bool = True,
+    homology_cutoff: float = 1.0,
+    apply_homology_cutoff: bool = False,
+    apply_cutoff_after_homology: bool = False,
+    return_distance: bool = False,
+    return_n: int = 5,
+    label_table: LabelTable = None,
+) -> List[List[dict]]:
+    if label_table is None:
+        label_table = LabelTable()
+    query_idx, distance, hits = select_neighborhood(
+        hit_lists,
+        top_n=top_n,
+        dist_cutoff=dist_cutoff,
+        apply_cutoff_before_homology=apply_cutoff_before_homology,
+    )
+    if len(hits) == 0:
+        return [[] for _ in hit_lists]
+    label_id = label_table.get_label_ids(list(map(itemgetter("label"), hits)))
+    groups = group_labels(query_idx, label_id, distance)
+    # most frequent, then closest, then first observed
+    order = np.lexsort(
+        (
+            groups["first_row"],
+            groups["distance"],
+            -groups["count"],
+            groups["query_idx"],
+        )
+    )
+    return format_predictions(
+        num_queries=len(hit_lists),
+        groups=groups,
+        order=order,
+        labels=label_table.labels,
+        reference_ids=list(map(itemgetter("subject_id"), hits)),
+        top_n=top_n,
+        dist_cutoff=dist_cutoff,
+        homology_cutoff=homology_cutoff,
+        apply_homology_cutoff=apply_homology_cutoff,
+        apply_cutoff_after_homology=apply_cutoff_after_homology,
+        return_distance=return_distance,
+        return_n=return_n,
+    )
+
+
+def batch_ontology_neighborhood_classification(
+    hit_lists: List[List[DistHitResponse]],
+    top_n: int = 1,
+    dist_cutoff: float = 0.0,
+    apply_cutoff_before_homology: bool = True,
+    homology_cutoff: float = 1.0,
+    apply_homology_cutoff: bool = False,
+    apply_cutoff_after_homology: bool = False,
+    return_distance: bool = False,
+    return_n: int = 5,
+    label_table: LabelTable = None,
+) -> List[List[dict]]:
+    if label_table is None:
+        label_table = LabelTable()
+    if dist_cutoff == None:
+        apply_cutoff_before_homology = False
+    query_idx, distance, hits = select_neighborhood(
+        hit_lists,
+        top_n=top_n,
+        dist_cutoff=dist_cutoff,
+        apply_cutoff_before_homology=apply_cutoff_before_homology,
+    )
+    # some reference might have multiple labels - split these cases
+    hit_labels = [
+        [h["label"]] if isinstance(h["label"], str) else h["label"]
+        for h in hits
+    ]
+    if len(hits) == 0 or min(len(labels) for labels in hit_labels) == 0:
+        # empty label lists are only handled by the per query function
+        if len(hits) > 0:
+            return [
+                ontology_neighborhood_classification(
+                    hit_list,
+                    top_n=top_n,
+                    dist_cutoff=dist_cutoff,
+                    apply_cutoff_before_homology=apply_cutoff_before_homology,
+                    homology_cutoff=homology_cutoff,
+                    apply_homology_cutoff=apply_homology_cutoff,
+                    apply_cutoff_after_homology=apply_cutoff_after_homology,
+                    return_distance=return_distance,
+                    return_n=return_n,
+                )
+                for hit_list in hit_lists
+            ]
+        return [[] for _ in hit_lists]
+    num_labels = [len(labels) for labels in hit_labels]
+    hit_row = np.repeat(np.arange(len(hits)), num_labels)
+    label_id = label_table.get_label_ids(list(chain.from_iterable(hit_labels)))
+    prefix_matrix = label_table.get_prefix_matrix()
+    # frequency of every prefix in the neighborhood of a query
+    # (a hit contributes the breakdown of its last label)
+    last_row = np.cumsum(num_labels) - 1
+    num_prefixes = len(label_table.prefix_ids)
+    observed = prefix_matrix[label_id[last_row]]
+    observed_keys = query_idx[:, None] * num_prefixes + observed
+    observed_keys = observed_keys[observed >= 0]
+    freq_keys, freq_counts = np.unique(observed_keys, return_counts=True)
+    groups = group_labels(query_idx[hit_row], label_id, distance[hit_row])
+    # scores of each label (frequency of every level of its breakdown)
+    prefixes = prefix_matrix[groups["label_id"]]
+    keys = groups["query_idx"][:, None] * num_prefixes + prefixes
+    pos = np.minimum(np.searchsorted(freq_keys, keys), len(freq_keys) - 1)
+    scores = np.where(freq_keys[pos] == keys, freq_counts[pos], 0)
+    scores[prefixes < 0] = -1
+    # best observed by frequency and then by distance
+    order = np.lexsort(
+        (groups["first_row"], groups["distance"])
+        + tuple(-scores[:, col] for col in reversed(range(scores.shape[1])))
+        + (groups["query_idx"],)
+    )
+    return format_predictions(
+        num_queries=len(hit_lists),
+        groups=groups,
+        order=order,
+        labels=label_table.labels,
+        reference_ids=[hits[i]["subject_id"] for i in hit_row.tolist()],
+        top_n=top_n,
+        dist_cutoff=dist_cutoff,
+        homology_cutoff=homology_cutoff,
+        apply_homology_cutoff=apply_homology_cutoff,
+        apply_cutoff_after_homology=apply_cutoff_after_homology,
+        return_distance=return_distance,
+        return_n=return_n,
+    )
+
+
+# per query functions with a batched equivalent
+batch_classification_methods = {
+    neighborhood_classification: batch_neighborhood_classification,
+    ontology_neighborhood_classification: (
+        batch_ontology_neighborhood_classification
+    ),
+}
+
+
 def KNNClassification(
     query_list: List[DataQuery],
     qdrant_db: QdrantBase = None,
@@ -188,20 +517,53 @@ def KNNClassification(
     return_distance: bool = False,
     return_n: int = 5,
     ignore_self_matches: bool = False,
+    max_in_flight: int = 4,  # concurrent search requests
 ) -> List[KnnOutput]:
-    # Initialize Qdrant Database
-    db = qdrant_db()
-    # run KNN
-    predictions = db.batch_search(
-        queries=query_list,
-        batch_size=batch_size,
-        max_results=top_n,
-        return_embeds=False,
-        return_data=True,
-        distance_cutoff=dist_cutoff,
-        ignore_self_matches=ignore_self_matches,
-    )
+    # reuse warmed Qdrant Database handle
+    db = get_qdrant_db(qdrant_db)
+    # run KNN (raw hits are reused across genomes if a cache is set)
+    cache = get_knn_cache()
+    if cache is None:
+        predictions = db.batch_search(
+            queries=query_list,
+            batch_size=batch_size,
+            max_results=top_n,
+            return_embeds=False,
+            return_data=True,
+            distance_cutoff=dist_cutoff,
+            ignore_self_matches=ignore_self_matches,
+            max_in_flight=max_in_flight,
+        )
+    else:
+        predictions = cache.batch_search(
+            db,
+            queries=query_list,
+            batch_size=batch_size,
+            max_results=top_n,
+            distance_cutoff=dist_cutoff,
+            ignore_self_matches=ignore_self_matches,
+            max_in_flight=max_in_flight,
+        )
     # classification
+    # (batched over all queries when an equivalent batch method exists)
+    if classification_method in batch_classification_methods:
+        batch_method = batch_classification_methods[classification_method]
+        cls_results = batch_method(
+            [p["hits"] for p in predictions],
+            top_n=top_n,
+            dist_cutoff=dist_cutoff,
+            apply_cutoff_before_homology=apply_cutoff_before_homology,
+            homology_cutoff=homology_cutoff,
+            apply_homology_cutoff=apply_homology_cutoff,
+            apply_cutoff_after_homology=apply_cutoff_after_homology,
+            return_distance=return_distance,
+            return_n=return_n,
+            label_table=get_label_table(db.collection_name),
+        )
+        return [
+            {"query_id": p["query_id"], "predictions": cls_result}
+            for p, cls_result in zip(predictions, cls_results)
+        ]
     response = []
     for p in predictions:
         query, hits = p["query_id"], p["hits"]
@@ -220,6 +582,4 @@ def KNNClassification(
         else:
             cls_result = []
         response.append({"query_id": query, "predictions": cls_result})
-    # terminate connection
-    del db
     return response
@@ -0,0 +1,209 @@
+import os
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import pyarrow.parquet as pq
+import requests
+import xxhash
+from qdrant_client import QdrantClient
+from requests_toolbelt import MultipartEncoder
+from tqdm import tqdm
+
+from Ibis.Utilities.Qdrant.base import (
+    QdrantBase,
+    client,
+    qdrant_host,
+    qdrant_port,
+)
+from Ibis.Utilities.Qdrant.cache import (
+    invalidate_knn_cache,
+    set_collection_version,
+)
+
+# restore and ingestion of reference collections
+# 1. snapshots are uploaded in parallel, file bodies are streamed from disk
+#    (never read into memory) and collections are polled until green
+# 2. collections can also be built without snapshots from embedding dumps
+#    (float32 .npy matrix + aligned parquet table of ids and payloads)
+#    with parallel upserts, indexing is enabled once all points are in
+
+
+def get_node_url() -> str:
+    return f"http://{qdrant_host}:{qdrant_port}"
+
+
+def get_snapshot_collection_name(snapshot_path: str) -> str:
+    # {collection_name}-{snapshot id}.snapshot
+    return os.path.basename(snapshot_path).split("-")[0]
+
+
+def get_node_client(node_url: Optional[str] = None) -> QdrantClient:
+    # the default client for the .env host, a new client for other nodes
+    if node_url is None or node_url == get_node_url():
+        return client
+    return QdrantClient(url=node_url, timeout=180)
+
+
+def get_snapshot_version(snapshot_path: str) -> str:
+    # snapshot names carry the snapshot id, the size tells apart files
+    # that were rewritten under the same name
+    snapshot_name = os.path.basename(snapshot_path)
+    size = os.path.getsize(snapshot_path)
+    return xxhash.xxh64(f"{snapshot_name}:{size}".encode()).hexdigest()
+
+
+def wait_for_collection(
+    collection_name: str,
+    node_url: Optional[str] = None,
+    timeout: float = 3600,
+    poll_interval: float = 5,
+):
+    # status is refreshed on every poll (on the node the collection was
+    # restored to, the default client for the .env host)
+    node_client = get_node_client(node_url)
+    start = time.time()
+    while True:
+        status = node_client.get_collection(
+            collection_name=collection_name
+        ).status
+        if status.value == "green":
+            return
+        if time.time() - start > timeout:
+            raise TimeoutError(
+                f"{collection_name} did not return green status after "
+                f"{timeout} seconds (current status: {status.value})"
+            )
+        time.sleep(poll_interval)
+
+
+def upload_snapshot(
+    snapshot_path: str,
+    node_url: Optional[str] = None,
+    timeout: float = 3600,
+) -> str:
+    if node_url is None:
+        node_url = get_node_url()
+    snapshot_name = os.path.basename(snapshot_path)
+    collection_name = get_snapshot_collection_name(snapshot_path)
+    with open(snapshot_path, "rb") as f:
+        # multipart body is read from the file in chunks while sending
+        body = MultipartEncoder(
+            fields={"snapshot": (snapshot_name, f, "application/octet-stream")}
+        )
+        response = requests.post(
+            f"{node_url}/collections/{collection_name}/snapshots/upload",
+            params={"priority": "snapshot", "wait": "true"},
+            data=body,
+            headers={"Content-Type": body.content_type},
+            timeout=timeout,
+        )
+    response.raise_for_status()
+    wait_for_collection(collection_name, node_url=node_url, timeout=timeout)
+    # cached knn results of the previous collection are stale (in all
+    # processes, the version alias is part of the cache version)
+    set_collection_version(
+        collection_name,
+        get_snapshot_version(snapshot_path),
+        node_client=get_node_client(node_url),
+    )
+    invalidate_knn_cache(collection_name)
+    return collection_name
+
+
+def restore_snapshots(
+    snapshot_paths: List[str],
+    node_url: Optional[str] = None,
+    max_workers: int = 4,
+    timeout: float = 3600,
+) -> List[str]:
+    # returns names of the restored collections
+    with ThreadPoolExecutor(max_workers) as executor:
+        futures = [
+            executor.submit(
+                upload_snapshot,
+                snapshot_path,
+                node_url=node_url,
+                timeout=timeout,
+            )
+            for snapshot_path in snapshot_paths
+        ]
+        return [
+            future.result()
+            for future in tqdm(futures, desc="Restoring snapshots")
+        ]
+
+
+def load_embedding_dump(
+    matrix_fp: str, table_fp: str, id_key: str
+) -> Dict[str, Any]:
+    # vectors stay memory mapped, rows are aligned with the parquet table
+    vectors = np.load(matrix_fp, mmap_mode="r")
+    table = pq.read_table(table_fp, memory_map=True)
+    if len(table) != len(vectors):
+        raise ValueError(
+            f"{table_fp} has {len(table)} rows but {matrix_fp} has "
+            f"{len(vectors)} vectors"
+        )
+    ids = table[id_key].to_pylist()
+    payloads = table.drop([id_key]).to_pylist()
+    return {"ids": ids, "vectors": vectors, "payloads": payloads}
+
+
+def ingest_embeddings(
+    db: QdrantBase,
+    ids: List[int],
+    vectors: np.ndarray,
+    payloads: Optional[List[Dict[str, Any]]] = None,
+    batch_size: int = 1000,
+    max_workers: int = 4,
+    indexing_threshold: int = 20000,
+):
+    # collections are created with indexing disabled (see create_collection)
+    # so points are upserted first and indexed once at the end
+    if payloads is None:
+        payloads = [{} for _ in ids]
+    starts = range(0, len(ids), batch_size)
+
+    def upload(start: int):
+        stop = start + batch_size
+        db.upload_data_batch(
+            ids=ids[start:stop],
+            vectors=np.asarray(vectors[start:stop], dtype=np.float32),
+            payloads=payloads[start:stop],
+        )
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        for _ in tqdm(
+            executor.map(upload, starts),
+            total=len(starts),
+            leave=False,
+            desc=f"Uploading {db.collection_name}",
+        ):
+            pass
+    db.index_collection(indexing_threshold=indexing_threshold)
+    set_collection_version(db.collection_name, uuid.uuid4().hex)
+    invalidate_knn_cache(db.collection_name)
+
+
+def ingest_embedding_dump(
+    db: QdrantBase,
+    matrix_fp: str,
+    table_fp: str,
+    id_key: str,
+    batch_size: int = 1000,
+    max_workers: int = 4,
+    indexing_threshold: int = 20000,
+):
+    dump = load_embedding_dump(matrix_fp, table_fp, id_key)
+    ingest_embeddings(
+        db,
+        ids=dump["ids"],
+        vectors=dump["vectors"],
+        payloads=dump["payloads"],
+        batch_size=batch_size,
+        max_workers=max_workers,
+        indexing_threshold=indexing_threshold,
+    )
@@ -0,0 +1,280 @@
+import json
+import os
+from typing import List, Literal, Tuple
+
+import numpy as np
+from tqdm import tqdm
+
+from Ibis.Utilities.Qdrant.datastructs import DataQuery, SearchResponse
+
+# in-process knn backend
+# collections are exported once from a running qdrant server into
+# {export_dir}/{collection_name}/ and searched locally afterwards
+# vectors.npy: float32 matrix (memory mapped)
+# norms.npy: squared l2 norm of every vector
+# ids.npy: point ids (aligned with vectors)
+# label_ids.npy: label of every point as an index into labels.json
+# labels.json: label vocabulary (payload values of the label alias)
+# payloads.jsonl: point payloads, one json line per point (aligned with
+# vectors), payload_offsets.npy holds the byte offset of every line
+# metadata.json: collection name, label alias and embedding dim
+# all arrays are memory mapped, payloads are only decoded for hits that
+# return data
+
+export_files = [
+    "vectors.npy",
+    "norms.npy",
+    "ids.npy",
+    "label_ids.npy",
+    "labels.json",
+    "payloads.jsonl",
+    "payload_offsets.npy",
+]
+
+
+def get_export_dir(export_dir: str, collection_name: str) -> str:
+    return f"{export_dir}/{collection_name}"
+
+
+def export_exists(export_dir: str, collection_name: str) -> bool:
+    # metadata is written last, exports of older layouts are not used
+    collection_dir = get_export_dir(export_dir, collection_name)
+    return all(
+        os.path.exists(f"{collection_dir}/{fn}")
+        for fn in ["metadata.json"] + export_files
+    )
+
+
+def export_collection(db, export_dir: str, batch_size: int = 10000):
+    from Ibis.Utilities.Qdrant.base import client
+
+    collection_name = db.collection_name
+    collection_dir = get_export_dir(export_dir, collection_name)
+    os.makedirs(collection_dir, exist_ok=True)
+    # an interrupted re-export must not look complete
+    metadata_fp = f"{collection_dir}/metadata.json"
+    if os.path.exists(metadata_fp):
+        os.remove(metadata_fp)
+    db.check_status()
+    embedding_dim = db.collection_status.config.params.vectors.size
+    count = client.count(collection_name=collection_name, exact=True).count
+    vectors = np.lib.format.open_memmap(
+        f"{collection_dir}/vectors.npy",
+        mode="w+",
+        dtype=np.float32,
+        shape=(count, embedding_dim),
+    )
+    ids = np.zeros(count, dtype=np.uint64)
+    label_ids = np.zeros(count, dtype=np.int32)
+    payload_offsets = np.zeros(count + 1, dtype=np.int64)
+    # labels are json encoded to find unique values (labels can be lists)
+    label_vocab = {}
+    row = 0
+    points = db.get_db_data(
+        return_embeds=True, return_data=True, page_size=batch_size
+    )
+    with open(f"{collection_dir}/payloads.jsonl", "wb") as f:
+        for p in tqdm(
+            points,
+            total=count,
+            leave=False,
+            desc=f"Exporting {collection_name}",
+        ):
+            vectors[row] = p.vector
+            ids[row] = p.id
+            label = json.dumps(p.payload[db.label_alias])
+            label_ids[row] = label_vocab.setdefault(label, len(label_vocab))
+            line = (json.dumps(p.payload) + "\n").encode()
+            f.write(line)
+            payload_offsets[row + 1] = payload_offsets[row] + len(line)
+            row += 1
+    vectors.flush()
+    norms = np.einsum("ij,ij->i", vectors, vectors)
+    np.save(f"{collection_dir}/norms.npy", norms)
+    np.save(f"{collection_dir}/ids.npy", ids)
+    np.save(f"{collection_dir}/label_ids.npy", label_ids)
+    np.save(f"{collection_dir}/payload_offsets.npy", payload_offsets)
+    with open(f"{collection_dir}/labels.json", "w") as f:
+        json.dump([json.loads(label) for label in label_vocab], f)
+    # metadata is written last (marks the export as complete)
+    metadata = {
+        "collection_name": collection_name,
+        "label_alias": db.label_alias,
+        "embedding_dim": embedding_dim,
+        "count": row,
+    }
+    with open(metadata_fp, "w") as f:
+        json.dump(metadata, f)
+
+
+class LocalIndex:
+    def __init__(
+        self,
+        export_dir: str,
+        collection_name: str,
+        index_type: Literal["exact", "hnsw"] = "exact",
+        chunk_size: int = 65536,
+        hnsw_ef: int = 128,
+    ):
+        self.collection_dir = get_export_dir(export_dir, collection_name)
+        self.metadata = json.load(open(f"{self.collection_dir}/metadata.json"))
+        self.label_alias = self.metadata["label_alias"]
+        self.vectors = np.load(
+            f"{self.collection_dir}/vectors.npy", mmap_mode="r"
+        )
+        self.norms = np.load(f"{self.collection_dir}/norms.npy")
+        self.ids = np.load(f"{self.collection_dir}/ids.npy", mmap_mode="r")
+        self.label_ids = np.load(
+            f"{self.collection_dir}/label_ids.npy", mmap_mode="r"
+        )
+        self.labels = json.load(open(f"{self.collection_dir}/labels.json"))
+        self.payload_offsets = np.load(
+            f"{self.collection_dir}/payload_offsets.npy", mmap_mode="r"
+        )
+        # opened on first use (only needed for hits that return data)
+        self.payload_data = None
+        self.index_type = index_type
+        self.chunk_size = chunk_size
+        self.hnsw_ef = hnsw_ef
+        self.hnsw_index = None
+        if index_type == "hnsw":
+            self.load_hnsw_index()
+        elif index_type != "exact":
+            raise ValueError(
+                f"index_type expects one of 'exact' or 'hnsw'. "
+                f"You passed {index_type}"
+            )
+
+    def get_version(self) -> str:
+        # metadata, index type and file stats of the export (every
+        # re-export rewrites the files)
+        stats = []
+        for fn in export_files:
+            st = os.stat(f"{self.collection_dir}/{fn}")
+            stats.append(f"{fn}:{st.st_size}:{st.st_mtime_ns}")
+        metadata = json.dumps(self.metadata, sort_keys=True)
+        return f"{self.index_type}:{metadata}:{','.join(stats)}"
+
+    def get_payload(self, row: int) -> dict:
+        if self.payload_data is None:
+            self.payload_data = np.memmap(
+                f"{self.collection_dir}/payloads.jsonl",
+                dtype=np.uint8,
+                mode="r",
+            )
+        start = self.payload_offsets[row]
+        stop = self.payload_offsets[row + 1]
+        return json.loads(self.payload_data[start:stop].tobytes())
+
+    def load_hnsw_index(self, m: int = 16, ef_construction: int = 200):
+        try:
+            import hnswlib
+        except ImportError as e:
+            raise ImportError(
+                "index_type='hnsw' requires hnswlib (pip install hnswlib), "
+                "use index_type='exact' without it"
+            ) from e
+
+        index_fp = f"{self.collection_dir}/hnsw.bin"
+        num_elements, embedding_dim = self.vectors.shape
+        self.hnsw_index = hnswlib.Index(space="l2", dim=embedding_dim)
+        if os.path.exists(index_fp):
+            self.hnsw_index.load_index(index_fp, max_elements=num_elements)
+        else:
+            self.hnsw_index.init_index(
+                max_elements=num_elements, M=m, ef_construction=ef_construction
+            )
+            for start in range(0, num_elements, self.chunk_size):
+                stop = min(start + self.chunk_size, num_elements)
+                self.hnsw_index.add_items(
+                    np.asarray(self.vectors[start:stop]),
+                    np.arange(start, stop),
+                )
+            self.hnsw_index.save_index(index_fp)
+
+    def exact_search(
+        self, queries: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # blas based l2 search over chunks of the memory mapped matrix
+        # returns rows and squared distances sorted by distance
+        num_queries = len(queries)
+        query_norms = np.einsum("ij,ij->i", queries, queries)
+        best_dists = np.full((num_queries, 0), np.inf, dtype=np.float32)
+        best_rows = np.zeros((num_queries, 0), dtype=np.int64)
+        for start in range(0, len(self.vectors), self.chunk_size):
+            chunk = np.asarray(self.vectors[start : start + self.chunk_size])
+            dists = (
+                query_norms[:, None]
+                - 2 * queries @ chunk.T
+                + self.norms[start : start + len(chunk)][None, :]
+            )
+            # top k of the chunk first, only k columns are merged
+            if dists.shape[1] > k:
+                rows = np.argpartition(dists, k - 1, axis=1)[:, :k]
+                dists = np.take_along_axis(dists, rows, axis=1)
+            else:
+                rows = np.tile(np.arange(len(chunk)), (num_queries, 1))
+            best_dists = np.concatenate([best_dists, dists], axis=1)
+            best_rows = np.concatenate([best_rows, rows + start], axis=1)
+            if best_dists.shape[1] > k:
+                top = np.argpartition(best_dists, k - 1, axis=1)[:, :k]
+                best_dists = np.take_along_axis(best_dists, top, axis=1)
+                best_rows = np.take_along_axis(best_rows, top, axis=1)
+        order = np.argsort(best_dists, axis=1, kind="stable")
+        best_dists = np.take_along_axis(best_dists, order, axis=1)
+        best_rows = np.take_along_axis(best_rows, order, axis=1)
+        return best_rows, np.maximum(best_dists, 0)
+
+    def search(
+        self, queries: np.ndarray, k: int
+    ) -> Tuple[np.ndarray, np.ndarray]:
+        # returns rows and euclidean distances (qdrant EUCLID scores)
+        queries = np.asarray(queries, dtype=np.float32)
+        k = min(k, len(self.vectors))
+        if k == 0:
+            empty = np.zeros((len(queries), 0))
+            return empty.astype(np.int64), empty
+        if self.hnsw_index is not None:
+            self.hnsw_index.set_ef(max(self.hnsw_ef, k))
+            rows, dists = self.hnsw_index.knn_query(queries, k=k)
+            rows = rows.astype(np.int64)
+        else:
+            rows, dists = self.exact_search(queries, k)
+        return rows, np.sqrt(dists)
+
+    def batch_search(
+        self,
+        queries: List[DataQuery],
+        batch_size: int,
+        max_results: int,
+        return_embeds: bool = False,
+        return_data: bool = True,
+        distance_cutoff: float = None,  # NOT squared distance!!!
+        ignore_self_matches: bool = True,
+    ) -> List[SearchResponse]:
+        all_results = []
+        for start in tqdm(range(0, len(queries), batch_size), leave=False):
+            batch = queries[start : start + batch_size]
+            vectors = np.stack([entry["embedding"] for entry in batch])
+            batch_rows, batch_dists = self.search(vectors, max_results)
+            for entry, rows, dists in zip(batch, batch_rows, batch_dists):
+                qid = entry["query_id"]
+                hits = []
+                for row, dist in zip(rows, dists):
+                    if distance_cutoff is not None and dist > distance_cutoff:
+                        continue
+                    subject_id = int(self.ids[row])
+                    if subject_id == qid and ignore_self_matches:
+                        continue
+                    hits.append(
+                        {
+                            "subject_id": subject_id,
+                            "distance": float(dist),
+                            "label": self.labels[self.label_ids[row]],
+                            "data": (
+                                self.get_payload(row) if return_data else {}
+                            ),
+                        }
+                    )
+                all_results.append({"query_id": qid, "hits": hits})
+        return all_results
@@ -1,5 +1,7 @@
 from typing import List, TypedDict
 
+import numpy as np
+
 
 class TokenOutput(TypedDict):
     pos: int
@@ -7,6 +9,13 @@ class TokenOutput(TypedDict):
     score: float
 
 
+class ResidueClassification(TypedDict):
+    # residues passing the score threshold (aligned arrays)
+    pos: np.array
+    label: np.array
+    score: np.array
+
+
 class TokenRegionOutput(TypedDict):
     label: str
     protein_start: int
@@ -17,7 +26,7 @@ class TokenRegionOutput(TypedDict):
 class PipelineIntermediateOutput(TypedDict):
     protein_id: int
     sequence: str
-    residue_classification: List[TokenOutput]
+    residue_classification: ResidueClassification
 
 
 class PipelineOutput(TypedDict):
@@ -0,0 +1,241 @@
+import random
+from typing import Tuple
+
+import numpy as np
+from numba import njit
+
+# louvain community detection on csr graphs (compiled with numba)
+# reproduces networkx.algorithms.community.louvain_communities (networkx 3.x)
+# for undirected graphs with resolution = 1:
+# 1. nodes are visited in the same shuffled order (random.Random(seed))
+# 2. neighbours are visited in networkx adjacency order, so the neighbour
+#    community weights and ties between equal gains resolve the same way
+# 3. aggregated graphs are built in the same edge insertion order
+# 4. floating point operations are done in the same order (no fastmath)
+# the only difference is the modularity used for the stopping threshold,
+# which is computed from the aggregated graph (same value up to rounding)
+
+# csr graph: indptr, indices and weights, the neighbours of every node are
+# in networkx insertion order (self loops included)
+Graph = Tuple[np.array, np.array, np.array]
+
+
+@njit(cache=True)
+def get_degrees(
+    indptr: np.array, indices: np.array, weights: np.array
+) -> Tuple[np.array, np.array]:
+    # weighted degree as in networkx (self loops are counted twice)
+    # returns degrees and self loop weights
+    n = len(indptr) - 1
+    degrees = np.zeros(n)
+    self_loops = np.zeros(n)
+    for u in range(n):
+        deg = 0.0
+        for j in range(indptr[u], indptr[u + 1]):
+            deg += weights[j]
+            if indices[j] == u:
+                self_loops[u] = weights[j]
+        degrees[u] = deg + self_loops[u]
+    return degrees, self_loops
+
+
+@njit(cache=True)
+def get_sum(values: np.array) -> float:
+    # sequential sum (as python sum, np.sum is pairwise)
+    out = 0.0
+    for v in values:
+        out += v
+    return out
+
+
+@njit(cache=True)
+def get_modularity(
+    degrees: np.array, self_loops: np.array, m: float, norm: float
+) -> float:
+    # modularity of an aggregated graph (each node is a community)
+    out = 0.0
+    for u in range(len(degrees)):
+        out += self_loops[u] / m - degrees[u] * degrees[u] * norm
+    return out
+
+
+@njit(cache=True)
+def one_level(
+    indptr: np.array,
+    indices: np.array,
+    weights: np.array,
+    degrees: np.array,
+    m: float,
+    denom: float,
+    rand_nodes: np.array,
+) -> Tuple[np.array, bool]:
+    # local moving phase, returns the community of every node
+    n = len(indptr) - 1
+    node2com = np.arange(n)
+    stot = degrees.copy()
+    # weights to neighbour communities of the visited node
+    # (communities are kept in order of first visit)
+    com_weights = np.zeros(n)
+    com_seen = np.zeros(n, dtype=np.bool_)
+    nbr_coms = np.zeros(n, dtype=np.int64)
+    improvement = False
+    nb_moves = 1
+    while nb_moves > 0:
+        nb_moves = 0
+        for u in rand_nodes:
+            best_mod = 0.0
+            best_com = com = node2com[u]
+            num_coms = 0
+            for j in range(indptr[u], indptr[u + 1]):
+                v = indices[j]
+                if v == u:
+                    continue
+                c = node2com[v]
+                if com_seen[c]:
+                    com_weights[c] += weights[j]
+                else:
+                    com_seen[c] = True
+                    com_weights[c] = 0.0 + weights[j]
+                    nbr_coms[num_coms] = c
+                    num_coms += 1
+            degree = degrees[u]
+            stot[com] -= degree
+            com_weight = com_weights[com] if com_seen[com] else 0.0
+            remove_cost = -com_weight / m + (stot[com] * degree) / denom
+            for i in range(num_coms):
+                c = nbr_coms[i]
+                gain = (
+                    remove_cost
+                    + com_weights[c] / m
+                    - (stot[c] * degree) / denom
+                )
+                if gain > best_mod:
+                    best_mod = gain
+                    best_com = c
+            if com_seen[com] == False:
+                # own community is considered last
+                gain = remove_cost + 0.0 / m - (stot[com] * degree) / denom
+                if gain > best_mod:
+                    best_com = com
+            stot[best_com] += degree
+            if best_com != com:
+                node2com[u] = best_com
+                improvement = True
+                nb_moves += 1
+            for i in range(num_coms):
+                com_seen[nbr_coms[i]] = False
+    return node2com, improvement
+
+
+@njit(cache=True)
+def aggregate(
+    indptr: np.array, indices: np.array, weights: np.array, node2com: np.array
+) -> Tuple[np.array, np.array, np.array, np.array]:
+    # one node per (non empty) community, edges are summed
+    # returns the new graph and the new node of every old node
+    n = len(indptr) - 1
+    is_com = np.zeros(n, dtype=np.int64)
+    for u in range(n):
+        is_com[node2com[u]] = 1
+    com_ids = np.cumsum(is_com) - 1
+    num_coms = com_ids[-1] + 1
+    new_nodes = com_ids[node2com]
+    # every edge is seen once (from its first node), in networkx order
+    num_edges = 0
+    for u in range(n):
+        for j in range(indptr[u], indptr[u + 1]):
+            if indices[j] >= u:
+                num_edges += 1
+    edge_keys = np.zeros(num_edges, dtype=np.int64)
+    edge_coms = np.zeros((num_edges, 2), dtype=np.int64)
+    edge_weights = np.zeros(num_edges)
+    e = 0
+    for u in range(n):
+        for j in range(indptr[u], indptr[u + 1]):
+            v = indices[j]
+            if v < u:
+                continue
+            cu = new_nodes[u]
+            cv = new_nodes[v]
+            edge_keys[e] = min(cu, cv) * num_coms + max(cu, cv)
+            edge_coms[e, 0] = cu
+            edge_coms[e, 1] = cv
+            edge_weights[e] = weights[j]
+            e += 1
+    # weights of the same community pair are summed in edge order, the pair
+    # is inserted into both adjacencies when it is first seen
+    order = np.argsort(edge_keys, kind="mergesort")
+    nbr_keys = np.zeros(2 * num_edges, dtype=np.int64)
+    nbr_coms = np.zeros(2 * num_edges, dtype=np.int64)
+    nbr_weights = np.zeros(2 * num_edges)
+    num_nbrs = 0
+    start = 0
+    while start < num_edges:
+        first = order[start]
+        wt = edge_weights[first]
+        stop = start + 1
+        while stop < num_edges and edge_keys[order[stop]] == edge_keys[first]:
+            wt = edge_weights[order[stop]] + wt
+            stop += 1
+        cu = edge_coms[first, 0]
+        cv = edge_coms[first, 1]
+        nbr_keys[num_nbrs] = cu * num_edges + first
+        nbr_coms[num_nbrs] = cv
+        nbr_weights[num_nbrs] = wt
+        num_nbrs += 1
+        if cu != cv:
+            nbr_keys[num_nbrs] = cv * num_edges + first
+            nbr_coms[num_nbrs] = cu
+            nbr_weights[num_nbrs] = wt
+            num_nbrs += 1
+        start = stop
+    order = np.argsort(nbr_keys[:num_nbrs])
+    new_indptr = np.zeros(num_coms + 1, dtype=np.int64)
+    for i in order:
+        new_indptr[nbr_keys[i] // num_edges + 1] += 1
+    new_indptr = np.cumsum(new_indptr)
+    return new_indptr, nbr_coms[order], nbr_weights[order], new_nodes
+
+
+def get_level_modularity(degrees: np.array, self_loops: np.array) -> float:
+    # powers are taken in python (same rounding as the reference)
+    deg_sum = get_sum(degrees)
+    return get_modularity(degrees, self_loops, deg_sum / 2, 1 / deg_sum**2)
+
+
+def louvain_communities(
+    graph: Graph, seed: int = 42, threshold: float = 0.0000001
+) -> np.array:
+    # returns the community index of every node
+    indptr, indices, weights = graph
+    n = len(indptr) - 1
+    membership = np.arange(n)
+    if len(indices) == 0:
+        return membership
+    rng = random.Random(seed)
+    degrees, self_loops = get_degrees(indptr, indices, weights)
+    m = get_sum(degrees) / 2
+    denom = 2 * m**2
+    mod = get_level_modularity(degrees, self_loops)
+    rand_nodes = list(range(n))
+    rng.shuffle(rand_nodes)
+    node2com, _ = one_level(
+        indptr, indices, weights, degrees, m, denom, np.array(rand_nodes)
+    )
+    while True:
+        indptr, indices, weights, new_nodes = aggregate(
+            indptr, indices, weights, node2com
+        )
+        membership = new_nodes[membership]
+        degrees, self_loops = get_degrees(indptr, indices, weights)
+        new_mod = get_level_modularity(degrees, self_loops)
+        if new_mod - mod <= threshold:
+            return membership
+        mod = new_mod
+        rand_nodes = list(range(len(degrees)))
+        rng.shuffle(rand_nodes)
+        node2com, improvement = one_level(
+            indptr, indices, weights, degrees, m, denom, np.array(rand_nodes)
+        )
+        if improvement == False:
+            return membership
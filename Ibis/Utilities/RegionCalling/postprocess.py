@@ -1,201 +1,328 @@
+import functools
 from collections import Counter
 from multiprocessing import Pool
-from typing import List, Optional, Set
+from typing import Dict, List, Tuple
 
-import networkx as nx
 import numpy as np
 from tqdm import tqdm
 
 from Ibis.Utilities.RegionCalling.datastructs import (
     PipelineIntermediateOutput,
     PipelineOutput,
+    ResidueClassification,
     TokenOutput,
     TokenRegionOutput,
 )
+from Ibis.Utilities.RegionCalling.louvain import Graph, louvain_communities
+from Ibis.Utilities.rounding import round_values
 
 
-class TokenGraph:
-
-    def __init__(self):
-        self.G = nx.Graph()
-
-    def __getitem__(self, key) -> dict:
-        return self.G.nodes[key]
-
-    def __len__(self) -> int:
-        return len(self.nodes)
-
-    @property
-    def nodes(self) -> Set[int]:
-        return self.G.nodes
-
-    @property
-    def nodes_with_labels(self) -> List[int]:
-        return sorted([n for n in self.nodes if self[n]["label"] != None])
-
-    def add_node(
-        self,
-        pos: int,
-        label: Optional[str] = None,
-        score: Optional[float] = None,
-    ):
-        self.G.add_node(pos, label=label, score=score)
-
-    def add_edge(self, n1: int, n2: int, weight: float):
-        # weight = 1 for adjacent residues, = min(probability) for matching label
-        self.G.add_edge(n1, n2, weight=weight)
-
-    @property
-    def louvain_communities(self):
-        """Uses Louvain Communities for Label Correction
-        1. Draw edges between neighbouring residues with a weight of 1
-        2. Draw edges between residues with the same label
-        with a weight of the minimum of the two confidence scores
-        (Only if the residues are within n residues of each other)
-        3. Run Louvain Communities on the graph
-        """
-        # It is CRITICAL to set the seed for louvain communities or you WILL get inconsistencies.
-        # Please, please do NOT forget this.
-        try:
-            return nx.algorithms.community.louvain.louvain_communities(
-                self.G, seed=42
-            )
-        except ZeroDivisionError:
-            print(self.G.nodes, self.G.edges)
-            return []
-
-    def get_label_from_nodes(self, nodes: List[int]):
-        labels = [self[n]["label"] for n in nodes if self[n]["label"] != None]
-        if len(labels) == 0:
-            return None
-        else:
-            labels_counted = Counter(labels)
-            return max(set(labels), key=lambda x: labels_counted[x])
+def softmax(x):
+    return np.exp(x) / np.exp(x).sum(-1, keepdims=True)
+
+
+def merge_overlap_average(a, b, step=256):
+    overlapping_length = b.shape[0] - step
+    overlapping_arr_a = a[-overlapping_length:]
+    overlapping_arr_b = b[:overlapping_length]
+    a[-overlapping_length:] = np.mean(
+        [overlapping_arr_a, overlapping_arr_b], axis=0
+    )
+    out_arr = np.concatenate([a, b[overlapping_length:]], axis=0)
+    return out_arr
+
+
+@functools.lru_cache(maxsize=None)
+def get_window_weights(
+    num_windows: int, window_size: int, step: int = 256
+) -> np.array:
+    # weight of every window position in the folded merge_overlap_average
+    # a residue covered by windows k1 < ... < km is averaged pairwise in
+    # window order, so k1 gets 0.5^(m-1) and kj (j > 1) gets 0.5^(m-j+1)
+    k = np.arange(num_windows)[:, None]
+    pos = k * step + np.arange(window_size)[None, :]
+    first = np.maximum(0, (pos - window_size) // step + 1)
+    last = np.minimum(num_windows - 1, pos // step)
+    exponent = np.where(k == first, last - first, last - k + 1)
+    return 0.5**exponent
+
+
+def stitch_windows(window_logits: np.array, step: int = 256) -> np.array:
+    # same values as functools.reduce(merge_overlap_average, window_logits)
+    # in a single allocation (power of two weights keep it bit identical)
+    window_logits = np.asarray(window_logits)
+    num_windows, window_size = window_logits.shape[:2]
+    if num_windows == 1:
+        return window_logits[0]
+    weights = get_window_weights(num_windows, window_size, step)
+    weights = weights.astype(window_logits.dtype)
+    out = np.zeros(
+        (window_size + (num_windows - 1) * step,) + window_logits.shape[2:],
+        dtype=window_logits.dtype,
+    )
+    for k in range(num_windows):
+        start = k * step
+        out[start : start + window_size] += (
+            weights[k].reshape((-1,) + (1,) * (out.ndim - 1))
+            * window_logits[k]
+        )
+    return out
+
+
+def get_residue_predictions(
+    window_logits: np.array, sequence_length: int
+) -> Tuple[np.array, np.array]:
+    # average logits
+    logits = softmax(stitch_windows(window_logits))
+    # remove pad tokens
+    logits = logits[:sequence_length]
+    # top prediction per residue
+    labels = logits.argmax(axis=-1).astype(np.uint8)
+    top = np.take_along_axis(logits, labels[:, None].astype(np.intp), -1)
+    scores = round_values(top[:, 0], 2)
+    return labels, scores
+
+
+@functools.lru_cache(maxsize=None)
+def get_label_lookup(cls_dict_items: Tuple[Tuple[int, str], ...]) -> np.array:
+    # label ids are uint8, missing ids map to None
+    cls_dict = dict(cls_dict_items)
+    return np.array([cls_dict.get(i) for i in range(256)], dtype=object)
+
+
+def get_residue_classification(
+    labels: np.array,
+    scores: np.array,
+    cls_dict: Dict[int, str],
+    min_score: float = 0.5,
+) -> ResidueClassification:
+    # take top prediction that passes threshold
+    pos = np.flatnonzero(np.asarray(scores) >= min_score)
+    label_lookup = get_label_lookup(tuple(sorted(cls_dict.items())))
+    return {
+        "pos": pos,
+        "label": label_lookup[np.asarray(labels)[pos].astype(np.intp)],
+        "score": np.asarray(scores, dtype=np.float64)[pos],
+    }
+
+
+def get_token_outputs(
+    residue_classification: ResidueClassification,
+) -> List[TokenOutput]:
+    return [
+        {"pos": pos, "label": label, "score": score}
+        for pos, label, score in zip(
+            residue_classification["pos"].tolist(),
+            residue_classification["label"].tolist(),
+            residue_classification["score"].tolist(),
+        )
+    ]
+
+
+def get_token_graph(
+    label_ids: np.array, scores: np.array, max_dist: int = 10
+) -> Graph:
+    # banded residue graph (one node per residue between the first and last
+    # classified residue), neighbours are sorted by position
+    # 1. edges between neighbouring residues with a weight of 1
+    # 2. edges between residues with the same label within max_dist
+    #    with a weight of the minimum of the two confidence scores
+    num_nodes = len(label_ids)
+    src, dst, weights = [], [], []
+    for dist in range(1, min(max_dist, num_nodes - 1) + 1):
+        n1 = np.arange(num_nodes - dist)
+        n2 = n1 + dist
+        same_label = (label_ids[n1] >= 0) & (label_ids[n1] == label_ids[n2])
+        keep = same_label | (dist == 1)
+        weight = np.where(same_label, np.minimum(scores[n1], scores[n2]), 1.0)
+        weight = weight[keep]
+        src.extend([n1[keep], n2[keep]])
+        dst.extend([n2[keep], n1[keep]])
+        weights.extend([weight, weight])
+    if len(src) == 0:
+        return (
+            np.zeros(num_nodes + 1, dtype=np.int64),
+            np.zeros(0),
+            np.zeros(0),
+        )
+    src = np.concatenate(src)
+    dst = np.concatenate(dst)
+    weights = np.concatenate(weights)
+    order = np.lexsort((dst, src))
+    indptr = np.searchsorted(src[order], np.arange(num_nodes + 1))
+    return indptr, dst[order], weights[order].astype(np.float64)
 
 
 def token_region_calling(
     token_results: List[TokenOutput], min_nodes: int = 10, max_dist: int = 10
 ) -> TokenRegionOutput:
+    """Uses Louvain Communities for Label Correction
+    The residue graph (see get_token_graph) only has edges between
+    residues at most max_dist apart, communities are found with a compiled
+    reimplementation of networkx louvain_communities (same partitions).
+    Communities supported by at least min_nodes residues of their majority
+    label become regions, adjacent regions with the same label are combined.
+    """
     out = []
     # sort residue results by position
     token_results = sorted(token_results, key=lambda x: x["pos"])
-    # create graph
-    token_graph = TokenGraph()
     min_pos = token_results[0]["pos"]
     max_pos = token_results[-1]["pos"]
-    all_pos = list(range(min_pos, max_pos + 1))
-    # add nodes
-    [token_graph.add_node(n) for n in all_pos]
-    # add edges between adjacent residues
-    [
-        token_graph.add_edge(n1, n2, 1)
-        for n1, n2 in list(zip(all_pos, all_pos[1:]))
-    ]
-    # capture annotations that meet minimum probability cutoff
+    num_nodes = max_pos - min_pos + 1
+    labels = [None] * num_nodes
+    scores = np.zeros(num_nodes)
+    label_ids = np.full(num_nodes, -1)
+    label_to_id = {}
     for r in token_results:
-        token_graph.add_node(r["pos"], label=r["label"], score=r["score"])
-    # draw connections between neraby positions sharing label
-    nodes_to_examine = token_graph.nodes_with_labels
-    for idx, n1 in enumerate(nodes_to_examine):
-        for n2 in nodes_to_examine[idx + 1 :]:
-            # early break if distance not met
-            if n2 - n1 > max_dist:
-                break
-            # check if labels match
-            if token_graph[n2]["label"] == token_graph[n1]["label"]:
-                min_prob = min(
-                    [token_graph[n2]["score"], token_graph[n1]["score"]]
-                )
-                token_graph.add_edge(n1, n2, weight=min_prob)
+        idx = r["pos"] - min_pos
+        labels[idx] = r["label"]
+        scores[idx] = r["score"]
+        label_ids[idx] = label_to_id.setdefault(r["label"], len(label_to_id))
     # calculate communities
+    # It is CRITICAL to set the seed for louvain communities or you WILL get inconsistencies.
+    # Please, please do NOT forget this.
+    graph = get_token_graph(label_ids, scores, max_dist=max_dist)
+    membership = louvain_communities(graph, seed=42)
+    # nodes of every community sorted by position
+    order = np.argsort(membership, kind="stable")
+    bounds = np.flatnonzero(np.diff(membership[order])) + 1
     regions = []
-    communities = token_graph.louvain_communities
-    for community in communities:
-        community = list(community)
-        community.sort()
-        community_label = token_graph.get_label_from_nodes(community)
-        if community_label == None:
+    for community in np.split(order, bounds):
+        community_labels = [
+            labels[n] for n in community.tolist() if labels[n] != None
+        ]
+        if len(community_labels) == 0:
             continue
-        support = len(
-            [
-                n
-                for n in community
-                if token_graph[n]["label"] == community_label
-            ]
+        labels_counted = Counter(community_labels)
+        community_label = max(
+            set(community_labels), key=lambda x: labels_counted[x]
         )
+        support = labels_counted[community_label]
         if support < min_nodes:
             continue
         # cache
-        start = min(community)
-        stop = max(community)
+        start = int(community[0])
+        stop = int(community[-1])
         regions.append((community_label, start, stop))
     # sometimes there is adjavent duplication of regions - combine these regions
-    region_graph = nx.Graph()
     regions = sorted(regions, key=lambda x: x[1])
-    # add nodes
-    region_graph.add_nodes_from(regions)
-    # add edges
-    for idx, r in enumerate(regions[:-1]):
-        next_r = regions[idx + 1]
-        if r[0] == next_r[0]:
-            region_graph.add_edge(r, next_r)
-    # combine regions
-    for combined_r in nx.connected_components(region_graph):
-        combined_r = sorted(combined_r, key=lambda x: x[1])
-        label = combined_r[0][0]
-        start = combined_r[0][1]
-        stop = combined_r[-1][2]
-        nodes = list(range(start, stop + 1))
-        score_list = [
-            token_graph[n]["score"]
-            for n in nodes
-            if token_graph[n]["label"] == label
+    combined_regions = []
+    for r in regions:
+        if len(combined_regions) > 0 and combined_regions[-1][0] == r[0]:
+            combined_regions[-1] = (r[0], combined_regions[-1][1], r[2])
+        else:
+            combined_regions.append(r)
+    for label, start, stop in combined_regions:
+        region_labels = label_ids[start : stop + 1]
+        score_list = scores[start : stop + 1][
+            region_labels == label_to_id[label]
         ]
-        support = len(score_list)
         score = round(float(np.mean(score_list)), 2)
         # cache
         out.append(
             {
                 "label": label,
-                "protein_start": start,
-                "protein_stop": stop,
+                "protein_start": start + min_pos,
+                "protein_stop": stop + min_pos,
                 "score": score,
             }
         )
-    return sorted(out, key=lambda x: x["protein_start"])
+    return out
+
+
+def get_regions(
+    residue_classification: ResidueClassification,
+) -> List[TokenRegionOutput]:
+    if len(residue_classification["pos"]) == 0:
+        return []
+    return token_region_calling(get_token_outputs(residue_classification))
+
+
+def batch_get_regions(
+    residue_classifications: List[ResidueClassification],
+) -> List[List[TokenRegionOutput]]:
+    # worker task (one chunk of proteins)
+    return [get_regions(rc) for rc in residue_classifications]
 
 
 def pipeline_token_region_calling(
     pipeline_output: PipelineIntermediateOutput,
 ) -> PipelineOutput:
-    residue_classification = pipeline_output["residue_classification"]
-    if len(residue_classification) == 0:
-        regions = []
-    else:
-        regions = token_region_calling(residue_classification)
     return {
         "protein_id": pipeline_output["protein_id"],
         "sequence": pipeline_output["sequence"],
-        "regions": regions,
+        "regions": get_regions(pipeline_output["residue_classification"]),
     }
 
 
+class RegionCallingPool:
+    """Long lived workers for token region calling
+    1. Workers are started on first use and kept for the lifetime of the
+    pipeline (instead of a new Pool per genome), call close() when done
+    2. Proteins are submitted in chunks as soon as their residue
+    classification is ready, so region calling overlaps with inference
+    3. Only the residue classification arrays are sent to the workers
+    (sequences stay in the main process)
+    """
+
+    def __init__(self, cpu_cores: int = 1, chunk_size: int = 16):
+        self.cpu_cores = cpu_cores
+        self.chunk_size = chunk_size
+        self.pool = None
+        self.chunk: List[PipelineIntermediateOutput] = []
+        self.submitted = []
+
+    def submit(self, pipeline_output: PipelineIntermediateOutput):
+        self.chunk.append(pipeline_output)
+        if len(self.chunk) == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.chunk) == 0:
+            return
+        if self.pool is None:
+            self.pool = Pool(self.cpu_cores)
+        residue_classifications = [
+            p["residue_classification"] for p in self.chunk
+        ]
+        result = self.pool.apply_async(
+            batch_get_regions, (residue_classifications,)
+        )
+        self.submitted.append((self.chunk, result))
+        self.chunk = []
+
+    def collect(self) -> List[PipelineOutput]:
+        # outputs of all submitted proteins (in submission order)
+        self.flush()
+        out = []
+        for chunk, result in tqdm(
+            self.submitted, leave=False, desc="Token Region Calling"
+        ):
+            for p, regions in zip(chunk, result.get()):
+                out.append(
+                    {
+                        "protein_id": p["protein_id"],
+                        "sequence": p["sequence"],
+                        "regions": regions,
+                    }
+                )
+        self.submitted = []
+        return out
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
 def parallel_pipeline_token_region_calling(
     pipeline_outputs: List[PipelineIntermediateOutput],
     cpu_cores: int = 1,
 ) -> List[PipelineOutput]:
-    pool = Pool(cpu_cores)
-    process = pool.imap_unordered(
-        pipeline_token_region_calling, pipeline_outputs
-    )
-    out = [
-        p
-        for p in tqdm(
-            process,
-            total=len(pipeline_outputs),
-            leave=False,
-            desc="Token Region Calling",
-        )
-    ]
-    pool.close()
+    region_calling_pool = RegionCallingPool(cpu_cores=cpu_cores)
+    for p in pipeline_outputs:
+        region_calling_pool.submit(p)
+    out = region_calling_pool.collect()
+    region_calling_pool.close()
     return out
@@ -0,0 +1,243 @@
+import os
+import pickle
+from typing import Dict, List, Optional
+
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+# per genome columnar store ({output_dir}/{name}/store)
+# tables are parquet files that are memory mapped on read, so stages only
+# materialize the columns (and row groups) they request
+
+table_schemas = {
+    "orfs": pa.schema(
+        [
+            ("protein_id", pa.uint32()),
+            ("contig_id", pa.uint32()),
+            ("contig_start", pa.int64()),
+            ("contig_stop", pa.int64()),
+        ]
+    ),
+    "proteins": pa.schema(
+        [
+            ("protein_id", pa.uint32()),
+            ("sequence", pa.large_string()),
+        ]
+    ),
+}
+
+
+def get_store_dir(output_dir: str, name: str) -> str:
+    return f"{output_dir}/{name}/store"
+
+
+def get_table_fp(output_dir: str, name: str, table_name: str) -> str:
+    return f"{get_store_dir(output_dir, name)}/{table_name}.parquet"
+
+
+def table_exists(output_dir: str, name: str, table_name: str) -> bool:
+    return os.path.exists(get_table_fp(output_dir, name, table_name))
+
+
+class TableWriter:
+    # incrementally appends rows to a table (buffered into row groups)
+    # rows are written to a temporary file, readers only see closed tables
+
+    def __init__(
+        self,
+        output_dir: str,
+        name: str,
+        table_name: str,
+        row_group_size: int = 65536,
+    ):
+        os.makedirs(get_store_dir(output_dir, name), exist_ok=True)
+        self.schema = table_schemas[table_name]
+        self.table_fp = get_table_fp(output_dir, name, table_name)
+        self.tmp_fp = f"{self.table_fp}.tmp"
+        self.writer = pq.ParquetWriter(self.tmp_fp, self.schema)
+        self.row_group_size = row_group_size
+        self.buffer = []
+
+    def write(self, rows: List[dict]):
+        self.buffer.extend(rows)
+        if len(self.buffer) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if len(self.buffer) > 0:
+            self.writer.write_table(
+                pa.Table.from_pylist(self.buffer, schema=self.schema)
+            )
+            self.buffer = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+        os.replace(self.tmp_fp, self.table_fp)
+
+
+def write_table(output_dir: str, name: str, table_name: str, rows: List[dict]):
+    writer = TableWriter(output_dir, name, table_name)
+    writer.write(rows)
+    writer.close()
+
+
+def read_table(
+    output_dir: str,
+    name: str,
+    table_name: str,
+    columns: Optional[List[str]] = None,
+    protein_ids: Optional[List[int]] = None,
+) -> pa.Table:
+    filters = None
+    if protein_ids is not None:
+        filters = [("protein_id", "in", list(set(protein_ids)))]
+    return pq.read_table(
+        get_table_fp(output_dir, name, table_name),
+        columns=columns,
+        filters=filters,
+        memory_map=True,
+    )
+
+
+def read_rows(
+    output_dir: str,
+    name: str,
+    table_name: str,
+    columns: Optional[List[str]] = None,
+    protein_ids: Optional[List[int]] = None,
+) -> List[dict]:
+    return read_table(
+        output_dir,
+        name,
+        table_name,
+        columns=columns,
+        protein_ids=protein_ids,
+    ).to_pylist()
+
+
+########################################################################
+# Embedding matrices
+########################################################################
+
+# embeddings are stored as one contiguous float32 matrix ({table}.npy)
+# with rows aligned to a parquet table holding the remaining fields
+# sorted by id so rows can be located with a binary search
+
+legacy_embedding_files = {
+    "protein_embeddings": ("protein_embedding.pkl", ["protein_id"]),
+    "domain_embeddings": ("domain_embedding.pkl", ["domain_id"]),
+    "bgc_embeddings": (
+        "bgc_embedding.pkl",
+        ["contig_id", "contig_start", "contig_stop"],
+    ),
+}
+
+
+def get_matrix_fp(output_dir: str, name: str, table_name: str) -> str:
+    return f"{get_store_dir(output_dir, name)}/{table_name}.npy"
+
+
+def embeddings_exist(output_dir: str, name: str, table_name: str) -> bool:
+    return os.path.exists(get_matrix_fp(output_dir, name, table_name))
+
+
+def embeddings_created(output_dir: str, name: str, table_name: str) -> bool:
+    # includes pickled embeddings created before the genome store
+    legacy_fn, _ = legacy_embedding_files[table_name]
+    return embeddings_exist(output_dir, name, table_name) or os.path.exists(
+        f"{output_dir}/{name}/{legacy_fn}"
+    )
+
+
+def write_embeddings(
+    output_dir: str,
+    name: str,
+    table_name: str,
+    rows: List[dict],
+    sort_keys: List[str],
+):
+    os.makedirs(get_store_dir(output_dir, name), exist_ok=True)
+    rows = sorted(rows, key=lambda x: tuple(x[k] for k in sort_keys))
+    if len(rows) > 0:
+        matrix = np.stack([r["embedding"] for r in rows]).astype(np.float32)
+    else:
+        matrix = np.zeros((0, 0), dtype=np.float32)
+    fields = [{k: v for k, v in r.items() if k != "embedding"} for r in rows]
+    # metadata table first, matrix last (marks the embeddings as complete)
+    table = pa.Table.from_pylist(fields)
+    if len(fields) == 0:
+        table = pa.table({k: pa.array([], pa.int64()) for k in sort_keys})
+    table_fp = get_table_fp(output_dir, name, table_name)
+    pq.write_table(table, f"{table_fp}.tmp")
+    os.replace(f"{table_fp}.tmp", table_fp)
+    matrix_fp = get_matrix_fp(output_dir, name, table_name)
+    # np.save appends .npy to names without the extension
+    tmp_fp = f"{matrix_fp[:-4]}.tmp.npy"
+    np.save(tmp_fp, matrix)
+    os.replace(tmp_fp, matrix_fp)
+
+
+def load_legacy_embeddings(output_dir: str, name: str, table_name: str):
+    # convert pickled embeddings created before the genome store
+    if embeddings_exist(output_dir, name, table_name) == False:
+        legacy_fn, sort_keys = legacy_embedding_files[table_name]
+        legacy_fp = f"{output_dir}/{name}/{legacy_fn}"
+        rows = pickle.load(open(legacy_fp, "rb"))
+        write_embeddings(output_dir, name, table_name, rows, sort_keys)
+
+
+def load_embedding_matrix(
+    output_dir: str, name: str, table_name: str
+) -> np.ndarray:
+    load_legacy_embeddings(output_dir, name, table_name)
+    return np.load(get_matrix_fp(output_dir, name, table_name), mmap_mode="r")
+
+
+def get_embedding_lookup(
+    output_dir: str,
+    name: str,
+    table_name: str,
+    id_key: str,
+    ids: Optional[List[int]] = None,
+) -> Dict[int, np.ndarray]:
+    # only rows of the requested ids are read from the memory mapped matrix
+    matrix = load_embedding_matrix(output_dir, name, table_name)
+    sorted_ids = read_table(output_dir, name, table_name, columns=[id_key])[
+        id_key
+    ].to_numpy()
+    if ids is None:
+        rows = np.arange(len(sorted_ids))
+    else:
+        query = np.unique(np.asarray(list(ids), dtype=sorted_ids.dtype))
+        rows = np.searchsorted(sorted_ids, query)
+        rows = rows[rows < len(sorted_ids)]
+        rows = rows[np.isin(sorted_ids[rows], query)]
+    return {int(sorted_ids[r]): np.asarray(matrix[r]) for r in rows}
+
+
+def read_embedding_rows(
+    output_dir: str,
+    name: str,
+    table_name: str,
+    columns: Optional[List[str]] = None,
+) -> List[dict]:
+    # full rows (table fields + embedding), used for exports and uploads
+    matrix = load_embedding_matrix(output_dir, name, table_name)
+    rows = read_rows(output_dir, name, table_name, columns=columns)
+    for idx, r in enumerate(rows):
+        r["embedding"] = np.asarray(matrix[idx])
+    return rows
+
+
+def export_embeddings(output_dir: str, name: str, table_name: str):
+    # restore the pickled list of dicts layout
+    legacy_fn, _ = legacy_embedding_files[table_name]
+    legacy_fp = f"{output_dir}/{name}/{legacy_fn}"
+    if os.path.exists(legacy_fp) == False and embeddings_exist(
+        output_dir, name, table_name
+    ):
+        rows = read_embedding_rows(output_dir, name, table_name)
+        with open(legacy_fp, "wb") as f:
+            pickle.dump(rows, f)
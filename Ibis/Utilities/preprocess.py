@@ -1,7 +1,12 @@
 import math
 from collections import deque
 from itertools import islice
-from typing import List
+from typing import Dict, Iterator, List, Optional, Tuple
+
+import numpy as np
+import onnxruntime as ort
+from tqdm import tqdm
+from transformers import PreTrainedTokenizerFast
 
 
 def sliding_window(iterable, size=2, step=1, fillvalue=None):
@@ -50,3 +55,137 @@ def get_indices(min_slice_size: float, sequence: str, lengths: List[int]):
     if min_target_size >= 512:
         min_target_size = 512
     return [idx for idx, l in enumerate(lengths) if l >= min_target_size]
+
+
+def pool_protein_windows(
+    sequences: List[str], size: int = 512, step: int = 256
+) -> Tuple[List[str], List[int]]:
+    # windows from all proteins in one list
+    # windows of sequence i are windows[offsets[i]:offsets[i + 1]]
+    windows = []
+    offsets = [0]
+    for sequence in sequences:
+        protein_windows = slice_proteins(sequence, size=size, step=step)
+        windows.extend(protein_windows)
+        offsets.append(offsets[-1] + len(protein_windows))
+    return windows, offsets
+
+
+def get_length_buckets(
+    lengths: List[int], max_tokens: int = 16384, max_bs: int = 32
+) -> List[List[int]]:
+    # sort by length so windows in a batch are padded to a similar length
+    # every window gets a [CLS] and [SEP] token
+    order = sorted(range(len(lengths)), key=lambda idx: lengths[idx])
+    buckets = []
+    bucket = []
+    for idx in order:
+        padded_length = lengths[idx] + 2
+        if len(bucket) > 0 and (
+            len(bucket) == max_bs
+            or (len(bucket) + 1) * padded_length > max_tokens
+        ):
+            buckets.append(bucket)
+            bucket = []
+        bucket.append(idx)
+    if len(bucket) > 0:
+        buckets.append(bucket)
+    return buckets
+
+
+def batchify_bucketed_windows(
+    windows: List[str],
+    tokenizer: PreTrainedTokenizerFast,
+    max_tokens: int = 16384,
+    max_bs: int = 32,
+) -> Iterator[Tuple[List[int], Dict[str, np.array]]]:
+    # yields window indices with tokenized inputs (padded to bucket length)
+    buckets = get_length_buckets(
+        [len(w) for w in windows], max_tokens=max_tokens, max_bs=max_bs
+    )
+    for bucket in buckets:
+        tokenized_inputs = tokenizer(
+            [" ".join(windows[idx]) for idx in bucket],
+            padding=True,
+            return_tensors="np",
+        )
+        yield bucket, dict(tokenized_inputs)
+
+
+def forward_bucketed_windows(
+    windows: List[str],
+    tokenizer: PreTrainedTokenizerFast,
+    model: ort.InferenceSession,
+    output_names: List[str],
+    residue_heads: Optional[Dict[str, ort.InferenceSession]] = None,
+    max_tokens: int = 16384,
+    max_bs: int = 32,
+    desc: str = "Running on window batches",
+) -> Iterator[Tuple[List[int], Dict[str, np.array]]]:
+    # windows of similar length are batched together
+    # yields window indices of each batch with the named model outputs
+    # residue heads run on last_hidden_state (add it to output_names)
+    residue_heads = {} if residue_heads == None else residue_heads
+    for bucket, inp in tqdm(
+        batchify_bucketed_windows(
+            windows, tokenizer, max_tokens=max_tokens, max_bs=max_bs
+        ),
+        leave=False,
+        desc=desc,
+    ):
+        model_out = dict(zip(output_names, model.run(output_names, inp)))
+        for head_name, head in residue_heads.items():
+            # first and last token correspond to [CLS] and [SEP]
+            predictions = head.run(
+                ["output"],
+                {"input": model_out["last_hidden_state"][:, 1:-1, :]},
+            )[0]
+            # remove pad tokens
+            model_out[head_name] = [
+                p[: len(windows[idx])] for idx, p in zip(bucket, predictions)
+            ]
+        yield bucket, model_out
+
+
+def restore_bucket_order(
+    buckets: List[List[int]], bucket_outputs: List[np.array]
+) -> List[np.array]:
+    # rows of each bucket output are placed back at their window index
+    out = [None] * sum(len(b) for b in buckets)
+    for bucket, bucket_output in zip(buckets, bucket_outputs):
+        for idx, row in zip(bucket, bucket_output):
+            out[idx] = row
+    return out
+
+
+def collect_protein_windows(
+    bucket_outputs: Iterator[Tuple[List[int], List[np.array]]],
+    offsets: List[int],
+) -> Iterator[Tuple[int, List[np.array]]]:
+    # yields (protein index, window outputs) as soon as every window of a
+    # protein is done (see pool_protein_windows for offsets)
+    window_proteins = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    remaining = np.diff(offsets).tolist()
+    window_outputs = {}
+    for bucket, bucket_output in bucket_outputs:
+        for idx, row in zip(bucket, bucket_output):
+            window_outputs[idx] = row
+            protein_idx = int(window_proteins[idx])
+            remaining[protein_idx] -= 1
+            if remaining[protein_idx] == 0:
+                start, stop = offsets[protein_idx], offsets[protein_idx + 1]
+                yield protein_idx, [
+                    window_outputs.pop(w) for w in range(start, stop)
+                ]
+
+
+def stack_window_outputs(window_outputs: List[np.array]) -> np.array:
+    # token level outputs of a protein padded to its longest window
+    max_length = max(x.shape[0] for x in window_outputs)
+    out = np.zeros(
+        (len(window_outputs), max_length) + window_outputs[0].shape[1:],
+        dtype=window_outputs[0].dtype,
+    )
+    for idx, x in enumerate(window_outputs):
+        out[idx, : x.shape[0]] = x
+    return out
@@ -0,0 +1,13 @@
+import numpy as np
+
+
+def round_values(values: np.ndarray, ndigits: int) -> np.ndarray:
+    # same results as the builtin round (exact decimal rounding)
+    # np.round differs only next to a tie, these values use the builtin
+    values = np.asarray(values, dtype=np.float64)
+    scaled = values * 10**ndigits
+    rounded = np.round(values, ndigits)
+    near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for idx in np.flatnonzero(near_tie):
+        rounded[idx] = round(float(values[idx]), ndigits)
+    return rounded